@@ -0,0 +1,90 @@
+"""Microbenchmark of parsing, intersecting and testing membership of compat specifiers.
+
+The specifiers and versions are typical of those in a registry. For parsing we time
+both the first parse of each string (clearing the cache) and parsing it again. For
+membership we time testing each version in turn and filtering the packed versions at
+once.
+
+Usage: python benchmarks/bench_compat.py
+"""
+
+import timeit
+
+import juliapkg.compat
+from juliapkg.compat import Compat, Version, pack_versions
+
+SPECS = [
+    "1",
+    "1.6",
+    "0.7, 1",
+    "1.2.3 - 1.9",
+    "~0.4.5",
+    "=1.10.2",
+    "0.21, 0.22, 0.23, 1",
+    "^1.3, 2",
+]
+VERSIONS = [f"{a}.{b}.{c}" for a in range(3) for b in range(12) for c in range(4)]
+
+
+def clear_caches():
+    for name in ["_parse_compat", "_parse_version"]:
+        cache = getattr(juliapkg.compat, name, None)
+        if cache is not None and hasattr(cache, "cache_clear"):
+            cache.cache_clear()
+
+
+def bench(name, func, number):
+    t = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:>24}: {t * 1e6:9.2f}us")
+
+
+def main():
+    def parse_cold():
+        clear_caches()
+        for spec in SPECS:
+            Compat.parse(spec)
+
+    def parse_warm():
+        for spec in SPECS:
+            Compat.parse(spec)
+
+    def parse_versions_cold():
+        clear_caches()
+        for ver in VERSIONS:
+            Version.parse(ver)
+
+    def parse_versions_warm():
+        for ver in VERSIONS:
+            Version.parse(ver)
+
+    compats = [Compat.parse(spec) for spec in SPECS]
+    versions = [Version.parse(ver) for ver in VERSIONS]
+
+    def intersect():
+        for c1 in compats:
+            for c2 in compats:
+                c1 & c2
+
+    def contains():
+        for c in compats:
+            for v in versions:
+                v in c
+
+    packed = pack_versions(versions)
+
+    def mask():
+        for c in compats:
+            c.mask(packed)
+
+    print(f"{len(SPECS)} specifiers, {len(VERSIONS)} versions")
+    bench("parse specifiers (cold)", parse_cold, 200)
+    bench("parse specifiers (warm)", parse_warm, 2000)
+    bench("parse versions (cold)", parse_versions_cold, 200)
+    bench("parse versions (warm)", parse_versions_warm, 2000)
+    bench("intersect all pairs", intersect, 200)
+    bench("membership all pairs", contains, 200)
+    bench("mask packed versions", mask, 200)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Benchmark many processes calling resolve() at once on an already resolved project.
+
+This is what happens when, say, a pool of web server workers start at the same time.
+Julia is replaced by a fake executable which reports its version and otherwise sleeps
+for a moment, as if installing packages. The project is resolved once, then N processes
+are started which all call resolve() at the same moment, each reporting how long it
+took.
+
+We time two modes:
+- lock-free: resolve() as it is, which checks whether it can skip resolving without
+  taking the lock;
+- exclusive: each process holds the exclusive lock around resolve(), as every process
+  used to, so they take turns.
+
+For comparison, in each mode there is also a run where another process holds the lock
+(as if it is resolving) for the first second after they start.
+
+Usage: python benchmarks/bench_concurrent_resolve.py [N ...]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+FAKE_JULIA = """\
+#!{python}
+import sys, time
+if sys.argv[1:] == ["--version"]:
+    print("julia version 1.10.0")
+else:
+    time.sleep(0.5)
+"""
+
+CHILD = """
+import sys, time
+exclusive = sys.argv[1] == "exclusive"
+import juliapkg
+from juliapkg.state import STATE
+from filelock import FileLock
+print("ready", flush=True)
+start = float(sys.stdin.readline())
+while time.time() < start:
+    time.sleep(0.001)
+t0 = time.perf_counter()
+if exclusive:
+    with FileLock(STATE["lock"]):
+        juliapkg.resolve()
+else:
+    juliapkg.resolve()
+print(time.perf_counter() - t0)
+"""
+
+HOLDER = """
+import sys, time
+import juliapkg
+from juliapkg.state import STATE
+from filelock import FileLock
+with FileLock(STATE["lock"]):
+    print("locked", flush=True)
+    end = float(sys.stdin.readline())
+    time.sleep(max(0, end - time.time()))
+"""
+
+
+def setup(tmp):
+    exe = os.path.join(tmp, "julia")
+    with open(exe, "w") as fp:
+        fp.write(FAKE_JULIA.format(python=sys.executable))
+    os.chmod(exe, 0o755)
+    env = dict(
+        os.environ,
+        PYTHON_JULIAPKG_EXE=exe,
+        PYTHON_JULIAPKG_PROJECT=os.path.join(tmp, "project"),
+        JULIA_DEPOT_PATH=os.path.join(tmp, "depot"),
+    )
+    env.pop("PYTHON_JULIAPKG_OFFLINE", None)
+    # resolve once, so the processes below can all skip resolving
+    subprocess.run(
+        [sys.executable, "-c", "import juliapkg; juliapkg.resolve()"],
+        env=env,
+        check=True,
+        capture_output=True,
+    )
+    return env
+
+
+def run(env, n, mode, hold=0):
+    holder = None
+    if hold:
+        holder = subprocess.Popen(
+            [sys.executable, "-c", HOLDER],
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        holder.stdout.readline()
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-c", CHILD, mode],
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        for _ in range(n)
+    ]
+    # wait until every process has imported juliapkg, then start them together
+    for proc in procs:
+        proc.stdout.readline()
+    start = time.time() + 0.1
+    if holder is not None:
+        holder.stdin.write(f"{start + hold}\n")
+        holder.stdin.flush()
+    for proc in procs:
+        proc.stdin.write(f"{start}\n")
+        proc.stdin.flush()
+    times = [float(proc.communicate()[0]) for proc in procs]
+    if holder is not None:
+        holder.communicate()
+    return sum(times) / n, max(times)
+
+
+def main(sizes):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = setup(tmp)
+        print(f"{'N':>4} {'mode':>10} {'held':>5} {'mean':>8} {'max':>8}")
+        for n in sizes:
+            for mode in ["lock-free", "exclusive"]:
+                for hold in [0, 1]:
+                    mean, worst = run(env, n, mode, hold)
+                    print(
+                        f"{n:>4} {mode:>10} {hold:>4}s {mean:>7.3f}s {worst:>7.3f}s",
+                        flush=True,
+                    )
+
+
+if __name__ == "__main__":
+    main([int(x) for x in sys.argv[1:]] or [1, 8, 32, 64])
@@ -0,0 +1,134 @@
+"""Benchmark the pure-Python pre-resolver on synthetic registries.
+
+Each registry has N packages, each with 5 versions. Each package depends on up to 4
+packages with a lower index. Newer versions have looser compat bounds, and a few bounds
+exclude the newest version of the dependency, so the solver must sometimes choose an
+older version. Compat is written in the registry format, where "1-2.0" means 1.0.0 up to
+any 2.0.x. We resolve 10 packages from the top of the registry.
+
+For each size, we time:
+- solve: resolve_versions() with the registry in memory;
+- cold: the same from a registry tarball in a fresh depot, including reading the
+  registry and writing the per-registry version cache;
+- warm: the same again, which reads the versions from the on-disk cache.
+
+Usage: python benchmarks/bench_preresolve.py [N ...]
+"""
+
+import io
+import os
+import random
+import sys
+import tarfile
+import tempfile
+import time
+
+import juliapkg.registry
+from juliapkg.compat import Version
+from juliapkg.preresolve import resolve_versions
+from juliapkg.registry import _parse_version_spec
+from juliapkg.state import STATE
+
+VERSIONS = ["1.0.0", "1.1.0", "1.2.0", "2.0.0", "2.1.0"]
+JULIA = Version.parse("1.10.0")
+
+
+def make_registry(n, seed=0):
+    rng = random.Random(seed)
+    uuids = [f"{i:08x}-0000-4000-8000-000000000000" for i in range(n)]
+    registry = {}
+    for i, uuid in enumerate(uuids):
+        depidxs = rng.sample(range(i), min(i, rng.randint(0, 4)))
+        deps = {}
+        compat = {}
+        for k, ver in enumerate(VERSIONS):
+            deps[ver] = {f"P{j}": uuids[j] for j in depidxs}
+            compat[ver] = {"julia": "1.6-1" if k < 3 else "1.9-1"}
+            for j in depidxs:
+                if k < 3:
+                    compat[ver][f"P{j}"] = "1"
+                elif rng.random() < 0.05:
+                    compat[ver][f"P{j}"] = "1-2.0"
+                else:
+                    compat[ver][f"P{j}"] = "1-2"
+        registry[uuid] = {"versions": VERSIONS, "deps": deps, "compat": compat}
+    return uuids, registry
+
+
+def normalize(registry):
+    # compat as returned by _find_package_versions()
+    return {
+        uuid: dict(
+            info,
+            compat={
+                ver: {k: str(_parse_version_spec(v)) for (k, v) in compat.items()}
+                for (ver, compat) in info["compat"].items()
+            },
+        )
+        for (uuid, info) in registry.items()
+    }
+
+
+def write_registry(depot, registry):
+    # the same registry as a tarball in the format of the General registry
+    files = {"Registry.toml": ["[packages]"]}
+    for i, (uuid, info) in enumerate(registry.items()):
+        path = f"P/P{i}"
+        files["Registry.toml"].append(f'{uuid} = {{ name = "P{i}", path = "{path}" }}')
+        files[f"{path}/Versions.toml"] = [f'["{ver}"]' for ver in info["versions"]]
+        deps = files[f"{path}/Deps.toml"] = []
+        comp = files[f"{path}/Compat.toml"] = []
+        for ver in info["versions"]:
+            deps.append(f'["{ver}"]')
+            deps.extend(f'{k} = "{v}"' for (k, v) in info["deps"][ver].items())
+            comp.append(f'["{ver}"]')
+            comp.extend(f'{k} = "{v}"' for (k, v) in info["compat"][ver].items())
+    regdir = os.path.join(depot, "registries")
+    os.makedirs(regdir)
+    with tarfile.open(os.path.join(regdir, "Bench.tar.gz"), "w:gz") as tf:
+        for fn, lines in files.items():
+            data = "\n".join(lines).encode("utf8")
+            info = tarfile.TarInfo(fn)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    with open(os.path.join(regdir, "Bench.toml"), "w") as fp:
+        fp.write(f'git-tree-sha1 = "{"0" * 40}"\npath = "Bench.tar.gz"\n')
+
+
+def timeit(func):
+    t0 = time.perf_counter()
+    ans = func()
+    return ans, time.perf_counter() - t0
+
+
+def bench(n):
+    uuids, registry = make_registry(n)
+    reqs = {uuid: None for uuid in uuids[-10:]}
+
+    normalized = normalize(registry)
+
+    def provider(uuids):
+        return {uuid: normalized[uuid] for uuid in uuids if uuid in normalized}
+
+    ans, tsolve = timeit(lambda: resolve_versions(reqs, JULIA, provider))
+    nold = sum(ver != VERSIONS[-1] for ver in ans.values())
+    with tempfile.TemporaryDirectory() as depot:
+        write_registry(depot, registry)
+        os.environ["JULIA_DEPOT_PATH"] = depot
+        os.environ["HOME"] = os.environ["USERPROFILE"] = depot
+        STATE["prefix"] = os.path.join(depot, "prefix")
+        ans2, tcold = timeit(lambda: resolve_versions(reqs, JULIA))
+        juliapkg.registry._VERSIONS_CACHE.clear()
+        ans3, twarm = timeit(lambda: resolve_versions(reqs, JULIA))
+        juliapkg.registry._VERSIONS_CACHE.clear()
+        juliapkg.registry._REGISTRY_INDEX_CACHE.clear()
+    assert ans == ans2 == ans3
+    print(
+        f"{n:>6} packages: {len(ans):>5} resolved ({nold} held back),"
+        f" solve {tsolve:.3f}s, cold {tcold:.3f}s, warm {twarm:.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    for n in [int(x) for x in sys.argv[1:]] or [1_000, 10_000, 50_000]:
+        bench(n)
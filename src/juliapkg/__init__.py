@@ -3,6 +3,7 @@ from .deps import (
     add,
     executable,
     offline,
+    precompile,
     project,
     require_julia,
     resolve,
@@ -22,4 +23,5 @@ __all__ = [
     "rm",
     "offline",
     "update",
+    "precompile",
 ]
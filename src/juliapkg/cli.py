@@ -4,7 +4,7 @@ import os
 import subprocess
 import sys
 
-from .deps import STATE, add, resolve, rm, status, update
+from .deps import STATE, add, precompile, resolve, rm, status, update
 
 try:
     import click
@@ -53,7 +53,7 @@ else:
     cli = JuliaPkgGroup(help="JuliaPkg - Manage your Julia dependencies from Python.")
 
     @cli.command(name="add")
-    @click.argument("package")
+    @click.argument("packages", nargs=-1, required=True)
     @click.option("--uuid", help="UUID of the package")
     @click.option("--version", help="Version constraint")
     @click.option("--dev", is_flag=True, help="Add as development dependency")
@@ -62,20 +62,30 @@ else:
     @click.option("--url", help="Git URL for the package")
     @click.option("--rev", help="Git revision/branch/tag")
     @click.option("--target", help="Target environment")
-    def add_cli(package, uuid, version, dev, path, subdir, url, rev, target):
-        """Add a Julia package to the project."""
-        add(
-            package,
-            uuid=uuid,
-            version=version,
-            dev=dev,
-            path=path,
-            subdir=subdir,
-            url=url,
-            rev=rev,
-            target=target,
+    def add_cli(packages, uuid, version, dev, path, subdir, url, rev, target):
+        """Add Julia packages to the project."""
+        if len(packages) == 1:
+            add(
+                packages[0],
+                uuid=uuid,
+                version=version,
+                dev=dev,
+                path=path,
+                subdir=subdir,
+                url=url,
+                rev=rev,
+                target=target,
+            )
+        elif any(x is not None for x in [uuid, version, path, subdir, url, rev]) or dev:
+            raise click.UsageError(
+                "--uuid, --version, --dev, --path, --subdir, --url and --rev can only"
+                " be used when adding a single package"
+            )
+        else:
+            add(list(packages), target=target)
+        click.echo(
+            f"Queued addition of {', '.join(packages)}. Run `resolve` to apply changes."
         )
-        click.echo(f"Queued addition of {package}. Run `resolve` to apply changes.")
 
     @cli.command(name="resolve")
     @click.option("--force", is_flag=True, help="Force resolution")
@@ -106,6 +116,12 @@ else:
         """Update Julia packages in the project."""
         update(dry_run=dry_run)
 
+    @cli.command(name="precompile")
+    def precompile_cli():
+        """Precompile Julia packages, including any deferred precompilation."""
+        precompile()
+        click.echo("Precompiled packages.")
+
     @cli.command(name="run", context_settings=dict(ignore_unknown_options=True))
     @click.argument("args", nargs=-1)
     def run_cli(args):
@@ -1,182 +1,451 @@
+import array
+import bisect
+import functools
+import heapq
 import re
 
-from semver import Version
+import semver
+
+# the most parsed values of each type to keep
+PARSE_CACHE_SIZE = 4096
+
+
+class Version(semver.Version):
+    """A semantic version, as semver.Version but parsing is cached."""
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, version, optional_minor_and_patch=False):
+        return _parse_version(cls, version, optional_minor_and_patch)
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_version(cls, version, optional_minor_and_patch):
+    return super(Version, cls).parse(version, optional_minor_and_patch)
+
 
 _re_partial_version = re.compile(r"^([0-9]+)(?:\.([0-9]+)(?:\.([0-9]+))?)?$")
 
 
-def _parse_partial_version(x):
+def _parse_partial(x):
+    # parse a partial version like "1.2" as ((1, 2, 0), 2), or return (None, None)
     m = _re_partial_version.match(x)
     if m is None:
         return None, None
     major, minor, patch = m.groups()
-    v = Version(major, minor or 0, patch or 0)
+    v = (int(major), int(minor or 0), int(patch or 0))
     n = 1 if minor is None else 2 if patch is None else 3
     return (v, n)
 
 
+def _parse_partial_version(x):
+    v, n = _parse_partial(x)
+    return (None if v is None else Version(*v), n)
+
+
 class Compat:
-    """A Julia compat specifier."""
+    """A Julia compat specifier.
+
+    The clauses are kept as a sorted list of disjoint non-adjacent ranges, so that
+    intersection and union are linear merges, membership is a binary search and equal
+    specifiers compare equal. Compats are immutable and hashable.
+    """
+
+    __slots__ = ("clauses", "_los")
+
+    def __init__(self, clauses=()):
+        clauses = sorted(
+            (clause for clause in clauses if not clause.is_empty()),
+            key=lambda clause: clause._lo,
+        )
+        self._init(_coalesce(clauses))
+
+    def _init(self, clauses):
+        object.__setattr__(self, "clauses", tuple(clauses))
+        object.__setattr__(self, "_los", tuple(clause._lo for clause in self.clauses))
+
+    @classmethod
+    def _canonical(cls, clauses):
+        # construct from clauses already in canonical form
+        self = cls.__new__(cls)
+        self._init(clauses)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
 
-    def __init__(self, clauses=[]):
-        self.clauses = [clause for clause in clauses if not clause.is_empty()]
+    def __reduce__(self):
+        # for copy and pickle, which otherwise try to set the slots
+        return (type(self), (self.clauses,))
 
     def __str__(self):
         return ", ".join(str(clause) for clause in self.clauses)
 
     def __repr__(self):
-        return f"{type(self).__name__}({self.clauses!r})"
+        return f"{type(self).__name__}({list(self.clauses)!r})"
 
     def __contains__(self, v):
-        return any(v in clause for clause in self.clauses)
+        v = _bound(v)
+        i = bisect.bisect_right(self._los, v) - 1
+        return i >= 0 and v < self.clauses[i]._hi
 
     def __and__(self, other):
         clauses = []
-        for clause1 in self.clauses:
-            for clause2 in other.clauses:
-                clause = clause1 & clause2
-                if not clause.is_empty():
-                    clauses.append(clause)
-        return Compat(clauses)
+        clauses1 = self.clauses
+        clauses2 = other.clauses
+        i = j = 0
+        while i < len(clauses1) and j < len(clauses2):
+            clause1 = clauses1[i]
+            clause2 = clauses2[j]
+            clause = clause1 & clause2
+            if not clause.is_empty():
+                clauses.append(clause)
+            if clause1._hi < clause2._hi:
+                i += 1
+            else:
+                j += 1
+        return Compat._canonical(clauses)
+
+    def __or__(self, other):
+        clauses = heapq.merge(
+            self.clauses, other.clauses, key=lambda clause: clause._lo
+        )
+        return Compat._canonical(_coalesce(clauses))
+
+    def bounds(self):
+        """The (lo, hi) Versions of each clause in increasing order, so that the
+        versions v with lo <= v < hi for some (lo, hi) are those in this compat.
+
+        This finds the versions in a sorted list by binary search, whereas `mask()`
+        tests each version in turn.
+        """
+        return [(clause.lo, clause.hi) for clause in self.clauses]
+
+    def mask(self, versions):
+        """For each of the packed versions (see `pack_versions()`), whether it is in
+        this compat, as a list of bools."""
+        los = self._los
+        his = [clause._hi for clause in self.clauses]
+        ans = []
+        for v in _unpack_versions(versions):
+            i = bisect.bisect_right(los, v) - 1
+            ans.append(i >= 0 and v < his[i])
+        return ans
+
+    def filter(self, versions):
+        """The indices of the packed versions (see `pack_versions()`) which are in this
+        compat."""
+        return [i for (i, ok) in enumerate(self.mask(versions)) if ok]
+
+    def max_satisfying(self, versions):
+        """The index of the highest of the packed versions (see `pack_versions()`) which
+        is in this compat, or None if there are none."""
+        ans = None
+        best = None
+        vers = _unpack_versions(versions)
+        for i in self.filter(vers):
+            if best is None or vers[i] > best:
+                ans = i
+                best = vers[i]
+        return ans
 
     def __bool__(self):
         return bool(self.clauses)
 
     def __eq__(self, other):
+        if not isinstance(other, Compat):
+            return NotImplemented
         return self.clauses == other.clauses
 
+    def __hash__(self):
+        return hash(self.clauses)
+
     @classmethod
     def parse(cls, verstr):
         """Parse a Julia compat specifier from a string.
 
         A specifier is a comma-separated list of clauses. The prefixes '^', '~' and '='
         are supported. No prefix is equivalent to '^'.
+
+        The most recent results are cached.
         """
-        clauses = []
-        if verstr.strip():
-            for part in verstr.split(","):
-                clause = Range.parse(part)
-                clauses.append(clause)
-        return cls(clauses)
+        return _parse_compat(cls, verstr)
+
+
+# conflict_set() looks for a conflicting pair among up to this many compats
+_PAIRWISE_MAX = 32
+
+
+def conflict_set(compats):
+    """Find a minimal set of compats with no version in common.
+
+    Args:
+        compats: A dict mapping keys (such as the files they come from) to Compats.
+
+    Returns:
+        A list of keys, in the order given, whose compats have no version in common but
+        any fewer of them do. Returns None if all the compats have a version in common.
+
+    When every compat is a single range, the conflict is the range with the highest
+    lower bound and the one with the lowest upper bound, which is the smallest possible.
+    Otherwise, for up to `_PAIRWISE_MAX` compats, a conflicting pair is looked for
+    first, which is also the smallest possible. Failing that, compats are intersected
+    one at a time until the intersection is empty, and the last one is kept and the
+    search repeated on those before it, so a conflict of k compats takes O(k n)
+    intersections. This conflict is minimal, but there may be a smaller one.
+    """
+    items = list(compats.items())
+    for key, compat in items:
+        if not compat:
+            return [key]
+    if all(len(compat.clauses) == 1 for (_, compat) in items):
+        if not items:
+            return None
+        key1, compat1 = max(items, key=lambda item: item[1].clauses[0]._lo)
+        key2, compat2 = min(items, key=lambda item: item[1].clauses[0]._hi)
+        if compat1.clauses[0]._lo < compat2.clauses[0]._hi:
+            return None
+        return [key for key in compats if key in (key1, key2)]
+    if len(items) <= _PAIRWISE_MAX:
+        for i, (key1, compat1) in enumerate(items):
+            for key2, compat2 in items[i + 1 :]:
+                if not (compat1 & compat2):
+                    return [key1, key2]
+    # the keys known to be in the conflict, and the candidates for the rest
+    found = []
+    candidates = items
+    while True:
+        common = None
+        for key in found:
+            common = compats[key] if common is None else common & compats[key]
+        if found and not common:
+            return [key for key in compats if key in found]
+        for i, (key, compat) in enumerate(candidates):
+            common = compat if common is None else common & compat
+            if not common:
+                break
+        else:
+            assert not found
+            return None
+        found.append(key)
+        candidates = candidates[:i]
+
+
+def _triple(v):
+    return (v.major, v.minor, v.patch)
+
+
+def _bound(v):
+    # the internal form of a version in a Range: a (major, minor, patch) tuple, which
+    # is much faster to compare than a Version, except for prereleases which are kept
+    # as a Version (which can be compared with tuples)
+    if isinstance(v, str):
+        v = Version.parse(v)
+    elif isinstance(v, dict):
+        v = Version(**v)
+    if isinstance(v, tuple) or v.prerelease:
+        return v
+    return (v.major, v.minor, v.patch)
+
+
+def _bump(v, n):
+    # increment part n (0, 1 or 2) of the version tuple v, zeroing the later parts
+    if n == 0:
+        return (v[0] + 1, 0, 0)
+    elif n == 1:
+        return (v[0], v[1] + 1, 0)
+    else:
+        return (v[0], v[1], v[2] + 1)
+
+
+def _truncate(v, n):
+    # keep the first n parts of the version tuple v
+    return (v[0], v[1] if n >= 2 else 0, v[2] if n >= 3 else 0)
+
+
+def _tilde_bounds(v, n):
+    hi = _bump(v, 0 if n < 2 else 1 if v[0] != 0 or v[1] != 0 or n < 3 else 2)
+    return (_truncate(v, n), hi)
+
+
+def _caret_bounds(v, n):
+    hi = _bump(v, 0 if v[0] != 0 or n < 2 else 1 if v[1] != 0 or n < 3 else 2)
+    return (_truncate(v, n), hi)
+
+
+def pack_versions(versions):
+    """Pack many versions into an array of integers, for `Compat.mask()`,
+    `Compat.filter()` and `Compat.max_satisfying()`.
+
+    The versions may be Versions or (major, minor, patch) tuples, and are packed as
+    consecutive (major, minor, patch) triples. Any prerelease or build is dropped.
+    """
+    ans = array.array("q")
+    for v in versions:
+        ans.extend(v if isinstance(v, tuple) else _triple(v))
+    return ans
+
+
+def _unpack_versions(versions):
+    # a list of (major, minor, patch) tuples from packed versions, which may be a flat
+    # sequence of triples (such as from pack_versions) or a NumPy array of shape (n, 3)
+    if isinstance(versions, list) and (not versions or isinstance(versions[0], tuple)):
+        return versions
+    if hasattr(versions, "tolist"):
+        versions = versions.tolist()
+    if versions and isinstance(versions[0], (list, tuple)):
+        return [tuple(v) for v in versions]
+    if len(versions) % 3:
+        raise ValueError("packed versions must have a multiple of 3 integers")
+    return list(zip(versions[0::3], versions[1::3], versions[2::3]))
+
+
+def _coalesce(clauses):
+    # merge overlapping or adjacent ranges, which are non-empty and sorted by lo
+    ans = []
+    for clause in clauses:
+        if ans and clause._lo <= ans[-1]._hi:
+            if clause._hi > ans[-1]._hi:
+                ans[-1] = Range(ans[-1]._lo, clause._hi)
+        else:
+            ans.append(clause)
+    return ans
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_compat(cls, verstr):
+    clauses = []
+    if verstr.strip():
+        for part in verstr.split(","):
+            clause = Range.parse(part)
+            clauses.append(clause)
+    return cls(clauses)
 
 
 class Range:
+    """The versions v with lo <= v < hi.
+
+    Ranges are immutable and hashable. Internally the bounds are kept as tuples (see
+    `_bound()`), and are only converted to Versions by the lo and hi properties.
+    """
+
+    __slots__ = ("_lo", "_hi")
+
     def __init__(self, lo, hi):
-        self.lo = lo
-        self.hi = hi
+        object.__setattr__(self, "_lo", _bound(lo))
+        object.__setattr__(self, "_hi", _bound(hi))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __reduce__(self):
+        # for copy and pickle, which otherwise try to set the slots
+        return (type(self), (self.lo, self.hi))
+
+    @property
+    def lo(self):
+        lo = self._lo
+        return Version(*lo) if isinstance(lo, tuple) else lo
+
+    @property
+    def hi(self):
+        hi = self._hi
+        return Version(*hi) if isinstance(hi, tuple) else hi
 
     @classmethod
     def tilde(cls, v, n):
-        lo = Version(
-            v.major,
-            v.minor if n >= 2 else 0,
-            v.patch if n >= 3 else 0,
-        )
-        hi = (
-            v.bump_major()
-            if n < 2
-            else v.bump_minor()
-            if v.major != 0 or v.minor != 0 or n < 3
-            else v.bump_patch()
-        )
-        return Range(lo, hi)
+        return Range(*_tilde_bounds(_triple(v) if not isinstance(v, tuple) else v, n))
 
     @classmethod
     def caret(cls, v, n):
-        lo = Version(
-            v.major,
-            v.minor if n >= 2 else 0,
-            v.patch if n >= 3 else 0,
-        )
-        hi = (
-            v.bump_major()
-            if v.major != 0 or n < 2
-            else v.bump_minor()
-            if v.minor != 0 or n < 3
-            else v.bump_patch()
-        )
-        return Range(lo, hi)
+        return Range(*_caret_bounds(_triple(v) if not isinstance(v, tuple) else v, n))
 
     @classmethod
     def equality(cls, v):
-        lo = v
-        hi = v.bump_patch()
-        return Range(lo, hi)
+        return Range(v, _bump(_triple(v) if not isinstance(v, tuple) else v, 2))
 
     @classmethod
     def hyphen(cls, v1, v2, n):
-        lo = v1
-        hi = v2.bump_major() if n < 2 else v2.bump_minor() if n < 3 else v2.bump_patch()
-        return Range(lo, hi)
+        v2 = _triple(v2) if not isinstance(v2, tuple) else v2
+        return Range(v1, _bump(v2, min(n, 3) - 1))
 
     @classmethod
     def parse(cls, x):
         x = x.strip()
         if x.startswith("~"):
             # tilde specifier
-            v, n = _parse_partial_version(x[1:])
+            v, n = _parse_partial(x[1:])
             if v is not None:
                 return cls.tilde(v, n)
         elif x.startswith("="):
             # equality specifier
-            v, n = _parse_partial_version(x[1:])
+            v, n = _parse_partial(x[1:])
             if v is not None and n == 3:
                 return cls.equality(v)
         elif " - " in x:
             # range specifier
             part1, part2 = x.split(" - ", 1)
-            v1, _ = _parse_partial_version(part1.strip())
-            v2, n = _parse_partial_version(part2.strip())
+            v1, _ = _parse_partial(part1.strip())
+            v2, n = _parse_partial(part2.strip())
             if v1 is not None and v2 is not None:
                 return cls.hyphen(v1, v2, n)
         else:
             # caret specifier
-            v, n = _parse_partial_version(x[1:] if x.startswith("^") else x)
+            v, n = _parse_partial(x[1:] if x.startswith("^") else x)
             if v is not None:
                 return cls.caret(v, n)
         raise ValueError(f"invalid version specifier: {x}")
 
     def __str__(self):
-        lo = self.lo
-        hi = self.hi
-        if self == Range.equality(lo):
-            return f"={lo.major}.{lo.minor}.{lo.patch}"
-        if self == Range.caret(lo, 1):
-            return f"^{lo.major}"
-        if self == Range.caret(lo, 2):
-            return f"^{lo.major}.{lo.minor}"
-        if self == Range.caret(lo, 3):
-            return f"^{lo.major}.{lo.minor}.{lo.patch}"
-        if self == Range.tilde(lo, 1):
-            return f"~{lo.major}"
-        if self == Range.tilde(lo, 2):
-            return f"~{lo.major}.{lo.minor}"
-        if self == Range.tilde(lo, 3):
-            return f"~{lo.major}.{lo.minor}.{lo.patch}"
-        lostr = f"{lo.major}.{lo.minor}.{lo.patch}"
-        if hi.major > 0 and hi.minor == 0 and hi.patch == 0:
-            return f"{lostr} - {hi.major - 1}"
-        if hi.minor > 0 and hi.patch == 0:
-            return f"{lostr} - {hi.major}.{hi.minor - 1}"
-        if hi.patch > 0:
-            return f"{lostr} - {hi.major}.{hi.minor}.{hi.patch - 1}"
+        lo = self._lo
+        hi = self._hi
+        lo3 = lo if isinstance(lo, tuple) else _triple(lo)
+        hi3 = hi if isinstance(hi, tuple) else _triple(hi)
+        bounds = (lo, hi)
+        if bounds == (lo3, _bump(lo3, 2)):
+            return "={}.{}.{}".format(*lo3)
+        if bounds == _caret_bounds(lo3, 1):
+            return "^{}".format(*lo3)
+        if bounds == _caret_bounds(lo3, 2):
+            return "^{}.{}".format(*lo3)
+        if bounds == _caret_bounds(lo3, 3):
+            return "^{}.{}.{}".format(*lo3)
+        if bounds == _tilde_bounds(lo3, 1):
+            return "~{}".format(*lo3)
+        if bounds == _tilde_bounds(lo3, 2):
+            return "~{}.{}".format(*lo3)
+        if bounds == _tilde_bounds(lo3, 3):
+            return "~{}.{}.{}".format(*lo3)
+        lostr = "{}.{}.{}".format(*lo3)
+        major, minor, patch = hi3
+        if major > 0 and minor == 0 and patch == 0:
+            return f"{lostr} - {major - 1}"
+        if minor > 0 and patch == 0:
+            return f"{lostr} - {major}.{minor - 1}"
+        if patch > 0:
+            return f"{lostr} - {major}.{minor}.{patch - 1}"
         raise ValueError("invalid range")
 
     def __repr__(self):
         return f"{type(self).__name__}({self.lo!r}, {self.hi!r})"
 
     def __contains__(self, v):
-        return self.lo <= v < self.hi
+        return self._lo <= _bound(v) < self._hi
 
     def __and__(self, other):
-        lo = max(self.lo, other.lo)
-        hi = min(self.hi, other.hi)
-        return Range(lo, hi)
+        return Range(max(self._lo, other._lo), min(self._hi, other._hi))
 
     def __eq__(self, other):
-        return (self.lo == other.lo and self.hi == other.hi) or (
+        if not isinstance(other, Range):
+            return NotImplemented
+        return (self._lo == other._lo and self._hi == other._hi) or (
             self.is_empty() and other.is_empty()
         )
 
+    def __hash__(self):
+        # all empty ranges are equal
+        return hash(None) if self.is_empty() else hash((self._lo, self._hi))
+
     def is_empty(self):
-        return not (self.lo < self.hi)
+        return not (self._lo < self._hi)
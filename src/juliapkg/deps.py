@@ -1,51 +1,114 @@
 import hashlib
+import importlib.metadata
 import json
 import logging
 import os
 import re
+import stat
 import sys
-from subprocess import run
+import time
+from subprocess import DEVNULL, Popen, run
 from typing import Union
 
+import semver
 import tomlkit
 from filelock import FileLock
 
-from .compat import Compat, Version
-from .find_julia import find_julia, julia_version
+from .compat import Compat, Version, conflict_set
+from .find_julia import find_julia, julia_fingerprint, julia_version
 from .install_julia import log, log_script
-from .registry import _find_uuid
-from .state import STATE
+from .preresolve import manifest_is_current
+from .registry import (
+    _find_package_versions,
+    _find_uuid,
+    _find_uuids,
+    registries_age,
+)
+from .state import STATE, get_config, write_atomic
+from .worker import (
+    WorkerUnavailable,
+    _detached,
+    run_in_worker,
+    worker_enabled,
+    worker_supported,
+)
 
 logger = logging.getLogger("juliapkg")
 
 ### META
 
-META_VERSION = 5  # increment whenever the format changes
+META_VERSION = 8  # increment whenever the format changes
+
+# The meta file has two lines: a small header, with which can_skip_resolve() can usually
+# decide on its own, followed by the details. The header has these keys from the meta,
+# plus "deps_digest", a digest of the names and timestamps of the deps files.
+META_HEADER_KEYS = [
+    "meta_version",
+    "dev",
+    "version",
+    "executable",
+    "executable_fingerprint",
+    "offline",
+    "override_executable",
+]
+
+
+def _deps_digest(timestamps):
+    # a digest of the deps files, given as a dict mapping filenames to timestamps
+    data = json.dumps(sorted(timestamps.items()))
+    return hashlib.sha256(data.encode("utf8")).hexdigest()
+
 
+def _meta_header(meta):
+    header = {key: meta[key] for key in META_HEADER_KEYS}
+    header["deps_digest"] = _deps_digest(
+        {fn: info["timestamp"] for (fn, info) in meta["deps_files"].items()}
+    )
+    return header
+
+
+def load_meta(details=True):
+    """Load the meta file, or return None if there is none (of the current version).
 
-def load_meta():
+    If details is False, only the header is read.
+    """
     fn = STATE["meta"]
-    if os.path.exists(fn):
+    try:
         with open(fn) as fp:
-            meta = json.load(fp)
-            if meta.get("meta_version") == META_VERSION:
-                return meta
+            meta = json.loads(fp.readline())
+            if not (
+                isinstance(meta, dict) and meta.get("meta_version") == META_VERSION
+            ):
+                return None
+            if details:
+                meta.update(json.loads(fp.readline()))
+                del meta["deps_digest"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return meta
 
 
 def save_meta(meta):
     assert isinstance(meta, dict)
     assert meta.get("meta_version") == META_VERSION
+    header = _meta_header(meta)
+    details = {key: value for (key, value) in meta.items() if key not in header}
+    meta_json = json.dumps(header) + "\n" + json.dumps(details) + "\n"
     fn = STATE["meta"]
-    os.makedirs(os.path.dirname(fn), exist_ok=True)
-    if os.path.exists(fn):
-        with open(fn) as fp:
-            old_meta_json = fp.read()
-        meta_json = json.dumps(meta)
-        if meta_json == old_meta_json:
-            # No need to write out if nothing changed
-            return
-    with open(fn, "w") as fp:
-        json.dump(meta, fp)
+    if _read_file(fn) == meta_json:
+        # No need to write out if nothing changed
+        return
+    # written atomically so that can_skip_resolve() can read it without the lock
+    write_atomic(fn, meta_json)
+
+
+def _invalidate_meta():
+    # called with the lock held before changing the project, so that other processes
+    # do not skip resolving (without the lock) while it is being changed
+    try:
+        os.remove(STATE["meta"])
+    except FileNotFoundError:
+        pass
 
 
 ### RESOLVE
@@ -67,7 +130,7 @@ class PkgSpec:
         name: str,
         uuid: str,
         dev: bool = False,
-        version: Union[str, Version, None] = None,
+        version: Union[str, semver.Version, None] = None,
         path: Union[str, None] = None,
         subdir: Union[str, None] = None,
         url: Union[str, None] = None,
@@ -117,7 +180,7 @@ class PkgSpec:
         self.dev = dev
 
         # Validate version (string, Version, or None)
-        if version is not None and not isinstance(version, (str, Version)):
+        if version is not None and not isinstance(version, (str, semver.Version)):
             raise TypeError(
                 "package version must be a 'str', 'Version', or 'None', got "
                 f"'{type(version).__name__}'"
@@ -196,6 +259,15 @@ class PkgSpec:
         return ans
 
 
+def _read_file(filename):
+    # the contents of the file, or None if it cannot be read
+    try:
+        with open(filename) as fp:
+            return fp.read()
+    except OSError:
+        return None
+
+
 def _get_hash(filename):
     with open(filename, "rb") as f:
         return hashlib.sha256(f.read()).hexdigest()
@@ -203,7 +275,7 @@ def _get_hash(filename):
 
 def can_skip_resolve():
     # resolve if we haven't resolved before
-    deps = load_meta()
+    deps = load_meta(details=False)
     if deps is None:
         logger.debug("no meta file")
         return False
@@ -215,13 +287,19 @@ def can_skip_resolve():
             STATE["override_executable"],
         )
         return False
-    # resolve whenever Julia changes
+    # resolve whenever Julia changes (only run it when its fingerprint changes)
     exe = deps["executable"]
     ver = deps["version"]
-    exever = julia_version(exe)
-    if exever is None or ver != str(exever):
-        logger.debug("changed version %s to %s", ver, exever)
-        return False
+    fingerprint = julia_fingerprint(exe)
+    fingerprint_changed = (
+        fingerprint is None or fingerprint != deps["executable_fingerprint"]
+    )
+    if fingerprint_changed:
+        logger.debug("executable fingerprint changed, checking version")
+        exever = julia_version(exe)
+        if exever is None or ver != str(exever):
+            logger.debug("changed version %s to %s", ver, exever)
+            return False
     # resolve when going from offline to online
     offline = deps["offline"]
     if offline and not STATE["offline"]:
@@ -233,25 +311,73 @@ def can_skip_resolve():
         logger.debug("changed dev %s to %s", isdev, STATE["dev"])
         return False
     # resolve whenever any deps files change
-    files0 = set(deps_files())
-    files = deps["deps_files"]
-    filesdiff = set(files.keys()).difference(files0)
-    if filesdiff:
-        logger.debug("deps files added %s", filesdiff)
-        return False
-    filesdiff = files0.difference(files.keys())
-    if filesdiff:
-        logger.debug("deps files removed %s", filesdiff)
-        return False
-    for filename, fileinfo in files.items():
-        if not os.path.isfile(filename):
-            logger.debug("deps file no longer exists %r", filename)
+    updates = {}
+    details = None
+    dists = None
+    if STATE["discovery"] == "metadata":
+        details = load_meta()
+        if details is None:
             return False
-        if os.path.getmtime(filename) > fileinfo["timestamp"]:
-            if _get_hash(filename) != fileinfo["hash_sha256"]:
-                logger.debug("deps file has changed %r", filename)
+        dists = distributions_info(details.get("dists"))
+        if dists is not details.get("dists"):
+            updates["dists"] = dists
+    files0 = set(deps_files(dists=dists))
+    try:
+        timestamps = {filename: os.path.getmtime(filename) for filename in files0}
+    except OSError:
+        timestamps = None
+    if timestamps is None or _deps_digest(timestamps) != deps["deps_digest"]:
+        # the header does not match, so check each file in detail
+        if details is None:
+            details = load_meta()
+            if details is None:
                 return False
-    return deps
+        files = details["deps_files"]
+        filesdiff = set(files.keys()).difference(files0)
+        if filesdiff:
+            logger.debug("deps files added %s", filesdiff)
+            return False
+        filesdiff = files0.difference(files.keys())
+        if filesdiff:
+            logger.debug("deps files removed %s", filesdiff)
+            return False
+        for filename, fileinfo in files.items():
+            if not os.path.isfile(filename):
+                logger.debug("deps file no longer exists %r", filename)
+                return False
+            if os.path.getmtime(filename) > fileinfo["timestamp"]:
+                if _get_hash(filename) != fileinfo["hash_sha256"]:
+                    logger.debug("deps file has changed %r", filename)
+                    return False
+        # the files are unchanged, so record their timestamps to match the header next
+        # time
+        updates["deps_files"] = {
+            filename: dict(fileinfo, timestamp=os.path.getmtime(filename))
+            for (filename, fileinfo) in files.items()
+        }
+    # record anything which changed without affecting the resolve, so the next check
+    # is faster
+    if fingerprint_changed and fingerprint is not None:
+        updates["executable_fingerprint"] = fingerprint
+    if updates:
+        _update_meta(deps, updates)
+    return dict(deps, **updates)
+
+
+def _update_meta(header, updates):
+    # apply the updates to the meta file, unless its header is no longer the given one
+    # or another process holds the lock (in which case it may be resolving)
+    lock = FileLock(STATE["lock"], is_singleton=True)
+    try:
+        lock.acquire(timeout=0)
+    except (TimeoutError, OSError):
+        return
+    try:
+        meta = load_meta()
+        if meta is not None and _meta_header(meta) == header:
+            save_meta(dict(meta, **updates))
+    finally:
+        lock.release()
 
 
 def editable_deps_files():
@@ -274,28 +400,164 @@ def editable_deps_files():
     return ans
 
 
-def deps_files():
+# counts of sys.path directories listed by deps_files() and those served from the index
+DEPS_INDEX_STATS = {"rescanned": 0, "indexed": 0}
+
+
+def _deps_index_file():
+    return os.path.join(os.path.dirname(STATE["meta"]), "deps_index.json")
+
+
+def _load_deps_index():
+    try:
+        with open(_deps_index_file()) as fp:
+            index = json.load(fp)
+        if index.get("meta_version") == META_VERSION and index.get("format") == 2:
+            return index["dirs"]
+    except Exception:
+        pass
+    return {}
+
+
+def _save_deps_index(dirs):
+    try:
+        write_atomic(
+            _deps_index_file(),
+            json.dumps({"meta_version": META_VERSION, "format": 2, "dirs": dirs}),
+        )
+    except OSError:
+        pass
+
+
+def _deps_candidates(path):
+    # the places a deps file may be in the directory path
+    ans = [os.path.join(path, "juliapkg.json")]
+    for subdir in os.listdir(path):
+        ans.append(os.path.join(path, subdir, "juliapkg.json"))
+    return ans
+
+
+def _scan_deps_dir(path):
+    return [fn for fn in _deps_candidates(path) if os.path.isfile(fn)]
+
+
+def _sys_path_mtimes():
+    ans = {}
+    for path in sys.path:
+        path = path or os.getcwd()
+        try:
+            ans[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+    return ans
+
+
+def distributions_info(cached=None):
+    """Find the deps files of the installed distributions from their metadata.
+
+    Returns a dict with keys "paths" (the mtime of each directory in `sys.path`),
+    "fingerprint" (a hash of the name, version and RECORD of every distribution) and
+    "files" (the deps files listed in a RECORD, at the top level or one directory down).
+
+    If cached is a previous return value and no directory in `sys.path` has changed
+    since, then it is returned without looking at any distributions. Otherwise if the
+    fingerprint is unchanged, its files are reused without parsing any RECORD.
+    """
+    paths = _sys_path_mtimes()
+    if cached is not None and cached.get("paths") == paths:
+        return cached
+    dists = []
+    entries = []
+    for dist in importlib.metadata.distributions():
+        try:
+            record = dist.read_text("RECORD") or ""
+            entries.append(
+                (
+                    dist.metadata["Name"] or "",
+                    dist.version or "",
+                    hashlib.sha256(record.encode("utf8")).hexdigest(),
+                )
+            )
+            dists.append(dist)
+        except Exception:
+            logger.debug("could not read metadata of distribution %r", dist)
+    fingerprint = hashlib.sha256(json.dumps(sorted(entries)).encode("utf8")).hexdigest()
+    if cached is not None and cached.get("fingerprint") == fingerprint:
+        logger.debug("installed distributions unchanged")
+        return {"paths": paths, "fingerprint": fingerprint, "files": cached["files"]}
+    files = []
+    for dist in dists:
+        try:
+            for file in dist.files or []:
+                if file.name == "juliapkg.json" and len(file.parts) <= 2:
+                    files.append(str(dist.locate_file(file)))
+        except Exception:
+            logger.debug("could not read files of distribution %r", dist)
+    return {"paths": paths, "fingerprint": fingerprint, "files": files}
+
+
+def deps_files(dists=None):
+    """Find all deps files.
+
+    In "metadata" discovery mode, dists may be a value from `distributions_info()` to
+    save computing it again.
+    """
     ans = []
     # the default deps file
     ans.append(cur_deps_file())
+    if STATE["discovery"] == "metadata":
+        # look in the metadata of installed distributions
+        if dists is None:
+            dists = distributions_info()
+        ans += dists["files"]
+        ans += editable_deps_files()
+        return _normalize_deps_files(ans)
     # look in sys.path
+    # Directories are only listed again if their mtime has changed since they were last
+    # listed, otherwise the listing is taken from the index. Adding a deps file to an
+    # existing subdirectory does not change the mtime of the directory, so we still
+    # check for a deps file in each subdirectory.
+    index = _load_deps_index()
+    new_index = {}
+    now = time.time_ns()
     for path in sys.path:
         if not path:
+            # the current directory is always listed, and not indexed
             path = os.getcwd()
-        if not os.path.isdir(path):
+            if os.path.isdir(path):
+                ans += _scan_deps_dir(path)
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
             continue
-        fn = os.path.join(path, "juliapkg.json")
-        ans.append(fn)
-        for subdir in os.listdir(path):
-            fn = os.path.join(path, subdir, "juliapkg.json")
-            ans.append(fn)
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        entry = index.get(path)
+        if entry is not None and entry.get("mtime") == st.st_mtime_ns:
+            DEPS_INDEX_STATS["indexed"] += 1
+            candidates = entry["candidates"]
+        else:
+            DEPS_INDEX_STATS["rescanned"] += 1
+            candidates = _deps_candidates(path)
+        ans += [fn for fn in candidates if os.path.isfile(fn)]
+        # don't index a directory modified very recently, in case it is modified again
+        # within the resolution of the mtime
+        if now - st.st_mtime_ns > 2_000_000_000:
+            new_index[path] = {"mtime": st.st_mtime_ns, "candidates": candidates}
+    if new_index != index:
+        _save_deps_index(new_index)
 
     ans += editable_deps_files()
 
+    return _normalize_deps_files(ans)
+
+
+def _normalize_deps_files(files):
     return list(
         set(
             os.path.normcase(os.path.normpath(os.path.abspath(fn)))
-            for fn in ans
+            for fn in files
             if os.path.isfile(fn)
         )
     )
@@ -320,15 +582,14 @@ def openssl_compat(version=None):
     return compat, julia_compat
 
 
-def find_requirements():
+def _read_requirements(quiet=False):
     # read all dependencies into a dict: name -> key -> file -> value
     # read all julia compats into a dict: file -> compat
-    import json
-
     compats = {}
     all_deps = {}
     for fn in deps_files():
-        log("Found dependencies: {}".format(fn))
+        if not quiet:
+            log("Found dependencies: {}".format(fn))
         with open(fn) as fp:
             deps = json.load(fp)
         for name, kvs in deps.get("packages", {}).items():
@@ -353,6 +614,44 @@ def find_requirements():
         c = deps.get("julia")
         if c is not None:
             compats[fn] = Compat.parse(c)
+    return compats, all_deps
+
+
+def _conflict_message(what, values, compats):
+    # describe compat entries with empty intersection, where values and compats map
+    # files to the values given and their parsed compats
+    lines = [f"{what} have empty intersection:"]
+    lines += ["- {!r} at {}".format(str(v), f) for (f, v) in values.items()]
+    conflict = conflict_set(compats)
+    if conflict is not None and len(conflict) < len(values):
+        lines.append("of which these conflict:")
+        lines += ["- {!r} at {}".format(str(values[f]), f) for f in conflict]
+    return "\n".join(lines)
+
+
+def find_conflicts():
+    """Find the compat entries in the deps files which have no version in common.
+
+    Returns a list of descriptions of each conflict, including a minimal set of entries
+    involved (see `conflict_set()`).
+    """
+    compats, all_deps = _read_requirements(quiet=True)
+    ans = []
+    for name, kfvs in all_deps.items():
+        fvs = kfvs.get("version")
+        if fvs:
+            pkgcompats = {f: Compat.parse(v) for (f, v) in fvs.items()}
+            if conflict_set(pkgcompats) is not None:
+                ans.append(
+                    _conflict_message(f"'version' entries for {name}", fvs, pkgcompats)
+                )
+    if compats and conflict_set(compats) is not None:
+        ans.append(_conflict_message("'julia' compat entries", compats, compats))
+    return ans
+
+
+def find_requirements():
+    compats, all_deps = _read_requirements()
 
     # merges non-unique values
     def merge_unique(dep, kfvs, k):
@@ -375,18 +674,13 @@ def find_requirements():
     def merge_compat(dep, kfvs, k):
         fvs = kfvs.pop(k, None)
         if fvs is not None:
-            compats = list(map(Compat.parse, fvs.values()))
-            compat = compats[0]
-            for c in compats[1:]:
-                compat &= c
+            compats = {f: Compat.parse(v) for (f, v) in fvs.items()}
+            compat = None
+            for c in compats.values():
+                compat = c if compat is None else compat & c
             if not compat:
                 raise Exception(
-                    "'{}' entries have empty intersection:\n{}".format(
-                        k,
-                        "\n".join(
-                            ["- {!r} at {}".format(str(v), f) for (f, v) in fvs.items()]
-                        ),
-                    )
+                    _conflict_message(f"'{k}' entries for {dep['name']}", fvs, compats)
                 )
             else:
                 dep[k] = str(compat)
@@ -409,6 +703,7 @@ def find_requirements():
         merge_compat(kw, kfvs, "version")
         merge_any(kw, kfvs, "dev")
         deps.append(PkgSpec(**kw))
+    check_registered_versions(deps)
     # julia compat
     compat = None
     for c in compats.values():
@@ -417,16 +712,51 @@ def find_requirements():
         else:
             compat &= c
     if compat is not None and not compat:
-        raise Exception(
-            "'julia' compat entries have empty intersection:\n{}".format(
-                "\n".join(
-                    ["- {!r} at {}".format(str(v), f) for (f, v) in compats.items()]
-                )
-            )
-        )
+        raise Exception(_conflict_message("'julia' compat entries", compats, compats))
     return compat, deps
 
 
+def check_registered_versions(pkgs):
+    """Check that some registered version of each package satisfies its compat.
+
+    This catches impossible constraints without starting Julia. Packages which are not
+    in any local registry, or are not installed from a registry, are not checked.
+
+    The local registries may be missing recently registered versions, so this only
+    raises if we are offline or the registries will not be updated before resolving.
+    Otherwise it logs a warning and leaves it to Julia.
+    """
+    pkgs = [
+        pkg
+        for pkg in pkgs
+        if pkg.version and not pkg.dev and pkg.path is None and pkg.url is None
+    ]
+    if not pkgs:
+        return
+    try:
+        infos = _find_package_versions([pkg.uuid for pkg in pkgs])
+    except Exception:
+        logger.debug("could not read the registries", exc_info=True)
+        return
+    for pkg in pkgs:
+        info = infos.get(pkg.uuid)
+        if info is None:
+            continue
+        compat = Compat.parse(str(pkg.version))
+        if not any(Version.parse(ver) in compat for ver in info["versions"]):
+            vers = info["versions"]
+            versstr = ", ".join(vers[-10:])
+            if len(vers) > 10:
+                versstr = "..., " + versstr
+            msg = (
+                f"no registered version of '{pkg.name}' is compatible with"
+                f" {str(compat)!r} (registered versions: {versstr or 'none'})"
+            )
+            if STATE["offline"] or registries_fresh():
+                raise Exception(msg)
+            log(f"WARNING: {msg}, but the registries may be out of date")
+
+
 def resolve(force=False, dry_run=False, update=False):
     """
     Resolve the dependencies.
@@ -447,11 +777,16 @@ def resolve(force=False, dry_run=False, update=False):
     if (not force) and STATE["resolved"]:
         return True
     STATE["resolved"] = False
-    # use a lock to prevent concurrent resolution
+    # see if we can skip resolving, without taking the lock: the meta file is written
+    # atomically and removed before the project is changed, so if it says we can skip
+    # then the project is resolved
+    if (not force) and _skip_resolve(dry_run):
+        return True
+    # otherwise use a lock to prevent concurrent resolution
     project = STATE["project"]
     os.makedirs(project, exist_ok=True)
-    lock_file = os.path.join(project, "lock.pid")
-    lock = FileLock(lock_file)
+    lock_file = STATE["lock"]
+    lock = FileLock(lock_file, is_singleton=True)
     try:
         lock.acquire(timeout=3)
     except TimeoutError:
@@ -462,14 +797,9 @@ def resolve(force=False, dry_run=False, update=False):
         )
         lock.acquire()
     try:
-        # see if we can skip resolving
-        if not force:
-            deps = can_skip_resolve()
-            if deps:
-                STATE["resolved"] = True
-                STATE["executable"] = deps["executable"]
-                STATE["version"] = Version.parse(deps["version"])
-                return True
+        # check again, in case another process resolved while we waited for the lock
+        if (not force) and _skip_resolve(dry_run):
+            return True
         if dry_run:
             return False
         # get julia compat and required packages
@@ -483,6 +813,9 @@ def resolve(force=False, dry_run=False, update=False):
         # set up the project
         shared = STATE["project_is_shared"]
         log(f"Using {'shared ' if shared else ''}Julia project at {project}")
+        skip_install = False
+        changes = None
+        registry_updated = registry_age = None
         if not STATE["offline"]:
             # load the existing Project.toml if the project is shared
             projtoml = None
@@ -499,19 +832,34 @@ def resolve(force=False, dry_run=False, update=False):
             if not foundprojtoml:
                 projfile = os.path.join(project, "Project.toml")
                 projtoml = tomlkit.document()
-            # add/update the deps table
-            projdeps = projtoml.setdefault("deps", tomlkit.table())
-            for pkg in pkgs:
-                projdeps[pkg.name] = pkg.uuid
-            # add/update the compat table
-            projcompat = projtoml.setdefault("compat", tomlkit.table())
-            for pkg in pkgs:
-                if pkg.version:
-                    projcompat[pkg.name] = pkg.version
-                else:
-                    projcompat.pop(pkg.name, None)
+            projtomlstr = _update_project(projtoml, pkgs)
+            oldmeta = load_meta() or {}
+            # if the project is unchanged and the manifest already has the versions
+            # that resolving would give, then there is nothing to do
+            if not (force or shared):
+                if (
+                    oldmeta.get("executable") == exe
+                    and oldmeta.get("version") == str(ver)
+                    and _read_file(projfile) == projtomlstr
+                    and manifest_is_current(project, pkgs, ver)
+                ):
+                    log("Julia packages are up to date")
+                    skip_install = True
+            # in incremental mode, only add and remove the packages which changed
+            changes = None
+            if STATE["incremental"] and not (force or shared or skip_install):
+                changes = _package_changes(oldmeta, exe, ver, project, pkgs)
+        installed = False
+        if changes is not None or not (STATE["offline"] or skip_install):
+            _invalidate_meta()
+        if changes is not None:
+            try:
+                installed = _resolve_incremental(exe, project, projfile, pkgs, *changes)
+            except Exception as err:
+                log(f"Incremental resolve failed ({err}), resolving from scratch")
+                changes = None
+        if changes is None and not (STATE["offline"] or skip_install):
             # write it out
-            projtomlstr = tomlkit.dumps(projtoml)
             log_script(
                 projtomlstr.splitlines(),
                 ("Updating" if foundprojtoml else "Writing")
@@ -519,8 +867,7 @@ def resolve(force=False, dry_run=False, update=False):
                 + os.path.basename(projfile)
                 + ":",
             )
-            with open(projfile, "wt") as fp:
-                fp.write(projtomlstr)
+            write_atomic(projfile, projtomlstr)
             # remove Manifest.toml
             if not shared:
                 manifest_path = os.path.join(project, "Manifest.toml")
@@ -529,7 +876,11 @@ def resolve(force=False, dry_run=False, update=False):
             # install the packages
             dev_pkgs = [pkg for pkg in pkgs if pkg.dev]
             add_pkgs = [pkg for pkg in pkgs if not pkg.dev]
-            script = ["import Pkg", "Pkg.Registry.update()"]
+            precompile_before, precompile_after = precompile_script()
+            script = ["import Pkg", *precompile_before]
+            registry_updated, registry_age = registry_update_needed()
+            if registry_updated:
+                script.append("Pkg.Registry.update()")
             if dev_pkgs:
                 script.append("Pkg.develop([")
                 for pkg in dev_pkgs:
@@ -544,26 +895,36 @@ def resolve(force=False, dry_run=False, update=False):
                 script.append("Pkg.update()")
             else:
                 script.append("Pkg.resolve()")
-            script.append("Pkg.precompile()")
+            script.extend(precompile_after)
             log_script(script, "Installing packages:")
             run_julia(script, executable=exe, project=project)
+            installed = True
+        if installed:
+            _after_install(exe, project)
         # record that we resolved
+        dists = None
+        if STATE["discovery"] == "metadata":
+            dists = distributions_info()
         save_meta(
             {
                 "meta_version": META_VERSION,
                 "dev": STATE["dev"],
                 "version": str(ver),
                 "executable": exe,
+                "executable_fingerprint": julia_fingerprint(exe),
                 "deps_files": {
                     filename: {
                         "timestamp": os.path.getmtime(filename),
                         "hash_sha256": _get_hash(filename),
                     }
-                    for filename in deps_files()
+                    for filename in deps_files(dists=dists)
                 },
+                "dists": dists,
                 "pkgs": [pkg.dict() for pkg in pkgs],
                 "offline": bool(STATE["offline"]),
                 "override_executable": STATE["override_executable"],
+                "registry_updated": registry_updated,
+                "registry_age": registry_age,
             }
         )
         STATE["resolved"] = True
@@ -574,6 +935,337 @@ def resolve(force=False, dry_run=False, update=False):
         lock.release()
 
 
+def _skip_resolve(dry_run=False):
+    # if can_skip_resolve() then record the resolved state and return True
+    deps = can_skip_resolve()
+    if not deps:
+        return False
+    # pick up precompilation deferred by an earlier resolve, unless it failed or
+    # deferring has since been turned off
+    if not dry_run and _deferred_precompile_pending():
+        if precompile_policy() == "deferred":
+            _start_deferred_precompile()
+        else:
+            _remove_precompile_marker()
+    STATE["resolved"] = True
+    STATE["executable"] = deps["executable"]
+    STATE["version"] = Version.parse(deps["version"])
+    return True
+
+
+def registry_max_age():
+    value, key = get_config("registry_max_age")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{key} must be a number of seconds")
+
+
+def _registries_freshness():
+    # (fresh, age) where fresh is True if the registries were updated within the
+    # maximum age, so will not be updated before resolving
+    max_age = registry_max_age()
+    if max_age is None:
+        return (False, None)
+    age = registries_age()
+    return (age is not None and age <= max_age, age)
+
+
+def registries_fresh():
+    """True if the registries were updated recently enough not to be updated before
+    resolving (see `PYTHON_JULIAPKG_REGISTRY_MAX_AGE`)."""
+    return _registries_freshness()[0]
+
+
+def registry_update_needed():
+    """Whether to update the registries before installing packages.
+
+    Returns (needed, age) where age is the time in seconds since the registries were
+    last updated, if this was checked.
+    """
+    fresh, age = _registries_freshness()
+    if not fresh:
+        return (True, age)
+    log(f"Registries were updated {age:.0f} seconds ago, not updating them")
+    return (False, age)
+
+
+def _update_project(projtoml, pkgs):
+    # add/update the deps table
+    projdeps = projtoml.setdefault("deps", tomlkit.table())
+    for pkg in pkgs:
+        projdeps[pkg.name] = pkg.uuid
+    # add/update the compat table
+    projcompat = projtoml.setdefault("compat", tomlkit.table())
+    for pkg in pkgs:
+        if pkg.version:
+            projcompat[pkg.name] = pkg.version
+        else:
+            projcompat.pop(pkg.name, None)
+    return tomlkit.dumps(projtoml)
+
+
+def _package_changes(oldmeta, exe, ver, project, pkgs):
+    """The packages removed and changed since the last resolve.
+
+    Returns None if the last resolve was with a different Julia or there is no manifest
+    to keep, in which case we must resolve from scratch.
+    """
+    if not (
+        oldmeta.get("executable") == exe
+        and oldmeta.get("version") == str(ver)
+        and "pkgs" in oldmeta
+        and os.path.isfile(os.path.join(project, "Manifest.toml"))
+    ):
+        return None
+    oldpkgs = {pkg["uuid"]: pkg for pkg in oldmeta["pkgs"]}
+    newuuids = {pkg.uuid for pkg in pkgs}
+    removed = [
+        PkgSpec(**pkg) for pkg in oldpkgs.values() if pkg["uuid"] not in newuuids
+    ]
+    changed = [pkg for pkg in pkgs if oldpkgs.get(pkg.uuid) != pkg.dict()]
+    return (removed, changed)
+
+
+def _resolve_incremental(exe, project, projfile, pkgs, removed, changed):
+    # update the packages in place, keeping Manifest.toml
+    if not (removed or changed):
+        log("No Julia packages changed")
+        return False
+    # removed packages stay in the project until Pkg.rm removes them
+    projtomlstr = _update_project(tomlkit.document(), pkgs + removed)
+    log_script(projtomlstr.splitlines(), "Updating Project.toml:")
+    write_atomic(projfile, projtomlstr)
+    dev_pkgs = [pkg for pkg in changed if pkg.dev]
+    add_pkgs = [pkg for pkg in changed if not pkg.dev]
+    precompile_before, precompile_after = precompile_script()
+    script = ["import Pkg", *precompile_before]
+    if removed:
+        script.append("Pkg.rm([")
+        for pkg in removed:
+            script.append(f'  Pkg.PackageSpec(name="{pkg.name}", uuid="{pkg.uuid}"),')
+        script.append("])")
+    if dev_pkgs:
+        script.append("Pkg.develop([")
+        for pkg in dev_pkgs:
+            script.append(f"  {pkg.jlstr()},")
+        script.append("])")
+    if add_pkgs:
+        script.append("Pkg.add([")
+        for pkg in add_pkgs:
+            script.append(f"  {pkg.jlstr()},")
+        script.append("])")
+    script.extend(precompile_after)
+    log_script(script, "Updating packages:")
+    run_julia(script, executable=exe, project=project)
+    return True
+
+
+### PRECOMPILE
+
+
+def precompile_policy():
+    """How to precompile packages after installing them.
+
+    Returns "yes", "no", "deferred" or a list of package names to precompile.
+    """
+    value, key = get_config("precompile")
+    if value is None:
+        return "yes"
+    if value in ("yes", "no", "deferred"):
+        return value
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    if not names:
+        raise ValueError(
+            f"{key} must be yes, no, deferred or a comma-separated list of packages"
+        )
+    return names
+
+
+def precompile_tasks():
+    value, key = get_config("precompile_tasks")
+    if value is None:
+        return None
+    try:
+        value = int(value)
+        if value < 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f"{key} must be a positive integer")
+    return value
+
+
+def precompile_script(policy=None):
+    """The lines to put before and after installing packages, to precompile them
+    according to the policy (default `precompile_policy()`)."""
+    if policy is None:
+        policy = precompile_policy()
+    before = []
+    tasks = precompile_tasks()
+    if tasks is not None:
+        before.append(f'ENV["JULIA_NUM_PRECOMPILE_TASKS"] = "{tasks}"')
+    if policy != "yes":
+        # otherwise Pkg.add precompiles everything
+        before.append('ENV["JULIA_PKG_PRECOMPILE_AUTO"] = "0"')
+    if policy == "yes":
+        after = ["Pkg.precompile()"]
+    elif isinstance(policy, list):
+        # Pkg can only precompile some packages since Julia 1.8
+        names = ", ".join(json.dumps(name) for name in policy)
+        after = [f'VERSION < v"1.8" ? Pkg.precompile() : Pkg.precompile([{names}])']
+    else:
+        after = []
+    return before, after
+
+
+# how long to wait for a deferred precompile to start in the background before another
+# process may start it instead
+PRECOMPILE_START_TIMEOUT = 60
+
+
+def _precompile_marker():
+    return os.path.join(STATE["prefix"], "precompile.json")
+
+
+def _deferred_precompile_pending():
+    # whether there is a deferred precompile to start in the background, which is not
+    # the case if it already failed (it is then only retried by precompile())
+    marker_data = _read_file(_precompile_marker())
+    if marker_data is None:
+        return False
+    try:
+        return not json.loads(marker_data).get("failed", False)
+    except ValueError:
+        return False
+
+
+def _remove_precompile_marker():
+    try:
+        os.remove(_precompile_marker())
+    except FileNotFoundError:
+        pass
+
+
+def _after_install(exe, project):
+    policy = precompile_policy()
+    marker = _precompile_marker()
+    if policy == "deferred":
+        # record what to precompile, and start doing it in the background
+        before, after = precompile_script("yes")
+        marker_data = {
+            "executable": exe,
+            "project": project,
+            "script": ["import Pkg", *before, *after],
+        }
+        write_atomic(marker, json.dumps(marker_data))
+        log("Precompiling in the background")
+        _start_deferred_precompile()
+    else:
+        # either already precompiled everything, or deferring has been turned off
+        _remove_precompile_marker()
+
+
+def _start_deferred_precompile():
+    # start a background process to run the deferred precompilation, unless one is
+    # already running or being started
+    marker = _precompile_marker()
+    lock = FileLock(marker + ".lock")
+    try:
+        lock.acquire(timeout=0)
+    except TimeoutError:
+        return
+    lock.release()
+    # only the process which creates this file starts it, and the background process
+    # removes it once it holds the lock (or it is ignored after a while, in case the
+    # background process did not start)
+    starting = marker + ".starting"
+    try:
+        os.close(os.open(starting, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(starting) < PRECOMPILE_START_TIMEOUT:
+                return
+            os.remove(starting)
+            os.close(os.open(starting, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return
+    with open(marker + ".log", "ab") as logfile:
+        Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys, juliapkg.deps;"
+                " juliapkg.deps.run_deferred_precompile("
+                "sys.argv[1], wait=False, retry=False)",
+                marker,
+            ],
+            stdin=DEVNULL,
+            stdout=logfile,
+            stderr=logfile,
+            **_detached(),
+        )
+
+
+def run_deferred_precompile(marker=None, wait=True, retry=True):
+    """Run the precompilation deferred by an earlier resolve, if any.
+
+    Returns True if it was run. If wait is False and it is already being run by another
+    process, returns False immediately.
+
+    If it fails, this is recorded so that it is not started again in the background,
+    and it is only run again if retry is True.
+    """
+    if marker is None:
+        marker = _precompile_marker()
+    lock = FileLock(marker + ".lock")
+    try:
+        lock.acquire(timeout=-1 if wait else 0)
+    except TimeoutError:
+        return False
+    finally:
+        # either we hold the lock, or another process does, so it has started
+        try:
+            os.remove(marker + ".starting")
+        except FileNotFoundError:
+            pass
+    try:
+        marker_data = _read_file(marker)
+        if marker_data is None:
+            return False
+        info = json.loads(marker_data)
+        if info.get("failed", False) and not retry:
+            return False
+        try:
+            run_julia(
+                info["script"], executable=info["executable"], project=info["project"]
+            )
+        except Exception:
+            if _read_file(marker) == marker_data:
+                write_atomic(marker, json.dumps({**info, "failed": True}))
+            raise
+        # remove the marker, unless a newer one was written meanwhile
+        if _read_file(marker) == marker_data:
+            os.remove(marker)
+        return True
+    finally:
+        lock.release()
+
+
+def precompile():
+    """
+    Precompile the Julia packages now.
+
+    This resolves first, and also completes any deferred precompilation (see the
+    `PYTHON_JULIAPKG_PRECOMPILE` option).
+    """
+    resolve()
+    if not run_deferred_precompile():
+        before, after = precompile_script("yes")
+        run_julia(["import Pkg", *before, *after])
+
+
 def run_julia(script, executable=None, project=None):
     """
     Run a Julia script with the specified executable and project.
@@ -582,12 +1274,22 @@ def run_julia(script, executable=None, project=None):
         executable (str): Path to the Julia executable.
         project (str): Path to the Julia project.
         script (list): List of strings representing the Julia script to run.
+
+    If the worker is enabled (and Julia is at least 1.9), the script is run in a
+    long-lived Julia process instead of starting a new one.
     """
     if executable is None:
         executable = STATE["executable"]
     if project is None:
         project = STATE["project"]
 
+    if worker_enabled() and worker_supported(executable):
+        try:
+            run_in_worker(script, executable, project)
+            return
+        except WorkerUnavailable as err:
+            log(f"Julia worker unavailable ({err}), running Julia directly")
+
     env = os.environ.copy()
     if sys.executable:
         # prefer PythonCall to use the current Python executable
@@ -660,9 +1362,7 @@ def load_cur_deps(target=None):
 def write_cur_deps(deps, target=None):
     fn = cur_deps_file(target=target)
     if deps:
-        os.makedirs(os.path.dirname(fn), exist_ok=True)
-        with open(fn, "w") as fp:
-            json.dump(deps, fp)
+        write_atomic(fn, json.dumps(deps))
     else:
         if os.path.exists(fn):
             os.remove(fn)
@@ -684,6 +1384,12 @@ def status(target=None):
         ver = STATE["version"]
     else:
         print("Not resolved (resolve for more information)")
+        try:
+            conflicts = find_conflicts()
+        except Exception as err:
+            conflicts = [f"could not read requirements: {err}"]
+        for conflict in conflicts:
+            print("Conflict: " + conflict.replace("\n", "\n  "))
     jl = deps.get("julia")
     if res or jl:
         print("Julia", end="")
@@ -723,30 +1429,40 @@ def add(pkg, *args, target=None, **kwargs):
     STATE["resolved"] = False
 
 
+def _unique_uuid(pkg, uuids):
+    if len(uuids) == 0:
+        raise TypeError(
+            f"Could not find package '{pkg}' in any registry. Are you sure the "
+            "name is correct? If so, pass the UUID explicitly."
+        )
+    elif len(uuids) == 1:
+        return list(uuids.keys())[0]
+    else:
+        raise TypeError(
+            f"Multiple UUIDs found for '{pkg}' ({uuids}), pass the UUID "
+            "explicitly to specify."
+        )
+
+
 def _add(deps, pkg, uuid=None, **kwargs):
     if isinstance(pkg, PkgSpec):
         pkgs = deps.setdefault("packages", {})
         pkgs[pkg.name] = pkg.depsdict()
     elif isinstance(pkg, str):
         if uuid is None:
-            uuids = _find_uuid(pkg)
-            if len(uuids) == 0:
-                raise TypeError(
-                    f"Could not find package '{pkg}' in any registry. Are you sure the "
-                    "name is correct? If so, pass the UUID explicitly."
-                )
-            elif len(uuids) == 1:
-                uuid = list(uuids.keys())[0]
-            else:
-                raise TypeError(
-                    f"Multiple UUIDs found for '{pkg}' ({uuids}), pass the UUID "
-                    "explicitly to specify."
-                )
+            uuid = _unique_uuid(pkg, _find_uuid(pkg))
         pkg = PkgSpec(pkg, uuid, **kwargs)
         _add(deps, pkg)
     else:
+        pkg = list(pkg)
+        # look up all the names at once
+        names = [p for p in pkg if isinstance(p, str)]
+        uuids = _find_uuids(names) if names else {}
         for p in pkg:
-            _add(deps, p)
+            if isinstance(p, str):
+                _add(deps, p, uuid=_unique_uuid(p, uuids[p]))
+            else:
+                _add(deps, p)
 
 
 def rm(pkg, target=None):
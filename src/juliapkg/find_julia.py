@@ -1,14 +1,117 @@
 import json
 import os
 import shutil
+import stat
 from subprocess import PIPE, run
 
-from .compat import Compat, Version
+from filelock import FileLock
+
+from .compat import Compat, Version, pack_versions
 from .install_julia import best_julia_version, get_short_arch, install_julia, log
-from .state import STATE
+from .state import STATE, write_atomic
+
+JULIA_VERSION_CACHE_SIZE = 32  # most recently used executables to remember
+
+
+def julia_fingerprint(exe):
+    """A cheap fingerprint of the Julia executable exe, without running it.
+
+    Returns a dict of the real path, size, modification time and inode of the file, or
+    None if it cannot be determined or is not a regular file. A name without a
+    directory is looked up in PATH. Two equal fingerprints are taken to mean the same
+    Julia, so that its version need not be checked again.
+
+    The JuliaUp launcher is never fingerprinted because which Julia it runs depends on
+    the JuliaUp configuration, not on the launcher file itself.
+    """
+    try:
+        # a bare name is run from PATH, not from the current directory
+        if not os.path.dirname(exe):
+            exe = shutil.which(exe)
+            if exe is None:
+                return None
+        path = os.path.realpath(exe)
+        if os.path.basename(path).lower().startswith("julialauncher"):
+            return None
+        st = os.stat(path)
+    except Exception:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return {
+        "realpath": path,
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "inode": st.st_ino,
+    }
+
+
+def _julia_version_cache_file():
+    return os.path.join(STATE["prefix"], "julia_versions.json")
+
+
+def _load_julia_version_cache():
+    # a list of {"fingerprint": ..., "version": ...}, most recently used last
+    try:
+        with open(_julia_version_cache_file()) as fp:
+            cache = json.load(fp)
+        if isinstance(cache, list):
+            return cache
+    except Exception:
+        pass
+    return []
+
+
+def _update_julia_version_cache(fingerprint, version):
+    # Only update the cache if we can take the lock immediately: either we already hold
+    # it (we are resolving) or nobody does. Otherwise another process is resolving and
+    # the cache is not worth waiting for.
+    lock = FileLock(STATE["lock"], is_singleton=True)
+    try:
+        os.makedirs(os.path.dirname(STATE["lock"]), exist_ok=True)
+        lock.acquire(timeout=0)
+    except (TimeoutError, OSError):
+        return
+    try:
+        cache = [
+            entry
+            for entry in _load_julia_version_cache()
+            if entry.get("fingerprint") != fingerprint
+        ]
+        cache.append({"fingerprint": fingerprint, "version": str(version)})
+        cache = cache[-JULIA_VERSION_CACHE_SIZE:]
+        write_atomic(_julia_version_cache_file(), json.dumps(cache))
+    except OSError:
+        pass
+    finally:
+        lock.release()
+
+
+def _cached_julia_version(fingerprint):
+    cache = _load_julia_version_cache()
+    for i, entry in enumerate(cache):
+        if entry.get("fingerprint") == fingerprint:
+            try:
+                version = Version.parse(entry["version"])
+            except Exception:
+                return None
+            if i != len(cache) - 1:
+                # mark as most recently used
+                _update_julia_version_cache(fingerprint, version)
+            return version
 
 
 def julia_version(exe):
+    """The version of the Julia executable exe, or None if it is not Julia.
+
+    Versions are cached on disk keyed by the fingerprint of the executable, so Julia is
+    only run the first time a particular executable is seen.
+    """
+    fingerprint = julia_fingerprint(exe) if exe else None
+    if fingerprint is not None:
+        version = _cached_julia_version(fingerprint)
+        if version is not None:
+            return version
     try:
         words = (
             run([exe, "--version"], check=True, capture_output=True, encoding="utf8")
@@ -16,9 +119,14 @@ def julia_version(exe):
             .split()
         )
         if words[0].lower() == "julia" and words[1].lower() == "version":
-            return Version.parse(words[2])
+            version = Version.parse(words[2])
+        else:
+            return None
     except Exception:
-        pass
+        return None
+    if fingerprint is not None:
+        _update_julia_version_cache(fingerprint, version)
+    return version
 
 
 def find_julia(compat=None, prefix=None, install=False, upgrade=False):
@@ -113,7 +221,7 @@ def find_julia(compat=None, prefix=None, install=False, upgrade=False):
 
 def ju_list_julia_versions(compat=None):
     proc = run(["juliaup", "list"], check=True, stdout=PIPE)
-    vers = {}
+    channels = []
     arch = get_short_arch()
     for line in proc.stdout.decode("utf-8").splitlines():
         words = line.strip().split()
@@ -127,9 +235,13 @@ def ju_list_julia_versions(compat=None):
                 continue
             if arch not in ver.build:
                 continue
-            ver = Version(ver.major, ver.minor, ver.patch)
-            if compat is None or ver in compat:
-                vers.setdefault(f"{ver.major}.{ver.minor}.{ver.patch}", []).append(c)
+            channels.append(((ver.major, ver.minor, ver.patch), c))
+    if compat is not None:
+        mask = compat.mask(pack_versions(ver for (ver, _) in channels))
+        channels = [channel for (channel, ok) in zip(channels, mask) if ok]
+    vers = {}
+    for ver, c in channels:
+        vers.setdefault("{}.{}.{}".format(*ver), []).append(c)
     return vers
 
 
@@ -191,16 +303,18 @@ def ju_find_julia_noinstall(compat=None):
             if ver.prerelease or arch not in ver.build:
                 continue
             ver = Version(ver.major, ver.minor, ver.patch)
-            if compat is None or ver in compat:
-                if "BinaryPath" in info:
-                    exe = os.path.abspath(os.path.join(judir, info["BinaryPath"]))
-                    versions.append((exe, ver))
-                elif "Path" in info:
-                    ext = ".exe" if os.name == "nt" else ""
-                    exe = os.path.abspath(
-                        os.path.join(judir, info["Path"], "bin", "julia" + ext)
-                    )
-                    versions.append((exe, ver))
+            if "BinaryPath" in info:
+                exe = os.path.abspath(os.path.join(judir, info["BinaryPath"]))
+                versions.append((exe, ver))
+            elif "Path" in info:
+                ext = ".exe" if os.name == "nt" else ""
+                exe = os.path.abspath(
+                    os.path.join(judir, info["Path"], "bin", "julia" + ext)
+                )
+                versions.append((exe, ver))
+        if compat is not None:
+            mask = compat.mask(pack_versions(ver for (_, ver) in versions))
+            versions = [x for (x, ok) in zip(versions, mask) if ok]
         versions.sort(key=lambda x: x[1], reverse=True)
         for exe, _ in versions:
             ver = julia_version(exe)
@@ -1,6 +1,6 @@
-import gzip
+import bisect
+import concurrent.futures
 import hashlib
-import io
 import json
 import os
 import platform
@@ -8,16 +8,26 @@ import shutil
 import subprocess
 import tarfile
 import tempfile
+import threading
 import time
+import urllib.error
 import urllib.request
 import warnings
 import zipfile
 
 from .compat import Version
+from .state import STATE, get_config, write_atomic
 
 _all_julia_versions = None
+_all_julia_versions_sha256 = None
+_julia_versions_index = None
 _julia_versions_url = "https://julialang-s3.julialang.org/bin/versions.json"
 
+JULIA_VERSIONS_TTL = 24 * 60 * 60  # seconds to use versions.json before revalidating
+DOWNLOAD_WORKERS = 4  # default number of concurrent downloads
+DOWNLOAD_CHUNK_SIZE = 8 << 20  # bytes per range request
+DOWNLOAD_RETRIES = 3  # attempts per range request
+
 
 def log(*args, cont=False):
     prefix = "          " if cont else "[juliapkg]"
@@ -31,13 +41,108 @@ def log_script(script, title=None):
         log("|", line, cont=True)
 
 
+def julia_versions_ttl():
+    value, key = get_config("versions_ttl")
+    if value is None:
+        return JULIA_VERSIONS_TTL
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{key} must be a number of seconds")
+
+
+def _julia_versions_cache_files():
+    return (
+        os.path.join(STATE["prefix"], "versions.json"),
+        os.path.join(STATE["prefix"], "versions.meta.json"),
+    )
+
+
+def _load_julia_versions_cache():
+    # returns (versions, meta) or (None, None)
+    datafile, metafile = _julia_versions_cache_files()
+    try:
+        with open(metafile) as fp:
+            meta = json.load(fp)
+        with open(datafile, "rb") as fp:
+            data = fp.read()
+        if hashlib.sha256(data).hexdigest() == meta["sha256"]:
+            return json.loads(data), meta
+    except Exception:
+        pass
+    return None, None
+
+
+def _save_julia_versions_cache(data, meta):
+    # data may be None to only update the meta
+    datafile, metafile = _julia_versions_cache_files()
+    try:
+        if data is not None:
+            write_atomic(datafile, data)
+        write_atomic(metafile, json.dumps(meta))
+    except OSError:
+        pass
+
+
 def all_julia_versions():
-    global _all_julia_versions
+    """All Julia releases, as given by versions.json on the Julia download server.
+
+    A copy is kept on disk and used for PYTHON_JULIAPKG_VERSIONS_TTL seconds, after
+    which it is revalidated with the server. If the server cannot be reached, a stale
+    copy is used.
+    """
+    global _all_julia_versions, _all_julia_versions_sha256
     if _all_julia_versions is None:
         url = _julia_versions_url
+        versions, meta = _load_julia_versions_cache()
+        if versions is not None and meta.get("url") != url:
+            versions, meta = None, None
+        if (
+            versions is not None
+            and 0 <= time.time() - meta["fetched"] < julia_versions_ttl()
+        ):
+            _all_julia_versions = versions
+            _all_julia_versions_sha256 = meta["sha256"]
+            return versions
+        headers = {}
+        if versions is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
         log(f"Querying Julia versions from {url}")
-        with urllib.request.urlopen(url) as fp:
-            _all_julia_versions = json.load(fp)
+        try:
+            req = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(req) as fp:
+                data = fp.read()
+                etag = fp.headers.get("ETag")
+                last_modified = fp.headers.get("Last-Modified")
+            _all_julia_versions = json.loads(data)
+            _all_julia_versions_sha256 = hashlib.sha256(data).hexdigest()
+            meta = {
+                "url": url,
+                "fetched": time.time(),
+                "etag": etag,
+                "last_modified": last_modified,
+                "sha256": _all_julia_versions_sha256,
+            }
+            _save_julia_versions_cache(data, meta)
+        except OSError as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code == 304 and headers:
+                # not modified
+                _all_julia_versions = versions
+                _all_julia_versions_sha256 = meta["sha256"]
+                meta["fetched"] = time.time()
+                _save_julia_versions_cache(None, meta)
+            elif versions is None:
+                raise
+            else:
+                log(
+                    f"WARNING: could not query Julia versions ({e}), using a cached"
+                    " copy"
+                )
+                _all_julia_versions = versions
+                _all_julia_versions_sha256 = meta["sha256"]
     return _all_julia_versions
 
 
@@ -85,7 +190,8 @@ def get_libc():
     return libc_aliases.get(libc, libc)
 
 
-def compatible_julia_versions(compat=None):
+def get_platform():
+    """The (os, arch, libc) of this platform, as named in versions.json."""
     os = get_os()
     arch = get_arch()
     libc = get_libc()
@@ -94,11 +200,19 @@ def compatible_julia_versions(compat=None):
         libc = "gnu"
     if libc == "gnu" and os == "linux" and arch == "armv7l":
         libc = "gnueabihf"
-    ans = {}
-    for k, v in all_julia_versions().items():
-        v = v.copy()
+    return (os, arch, libc)
+
+
+def _build_julia_versions_index(versions, platform):
+    os, arch, libc = platform
+    entries = []
+    for k, v in versions.items():
         if not v["stable"]:
             continue
+        try:
+            ver = Version.parse(k)
+        except Exception:
+            continue
         files = []
         for f in v["files"]:
             assert f["version"] == k
@@ -110,16 +224,69 @@ def compatible_julia_versions(compat=None):
                 continue
             if os == "linux" and f["triplet"].split("-")[2] != libc:
                 continue
-            if compat is not None:
-                try:
-                    ver = Version.parse(f["version"])
-                except Exception:
-                    continue
-                if ver not in compat:
-                    continue
             files.append(f)
-        if not files:
-            continue
+        if files:
+            entries.append((ver, k, files))
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+
+def julia_versions_index():
+    """Index of the stable Julia releases installable on this platform.
+
+    Returns a list of (version, key, files) sorted by version, where key is the version
+    string in versions.json and files are the matching installers. The index is built
+    once per versions.json snapshot and saved alongside the cached copy on disk.
+    """
+    global _julia_versions_index
+    versions = all_julia_versions()
+    key = [_all_julia_versions_sha256, list(get_platform())]
+    if (
+        _julia_versions_index is not None
+        and _julia_versions_index[0] == key
+        and _julia_versions_index[1] is versions
+    ):
+        return _julia_versions_index[2]
+    fn = os.path.join(STATE["prefix"], "versions.index.json")
+    entries = None
+    if key[0] is not None:
+        try:
+            with open(fn) as fp:
+                index = json.load(fp)
+            if index["key"] == key:
+                entries = [
+                    (Version.parse(k), k, files) for (k, files) in index["entries"]
+                ]
+        except Exception:
+            pass
+    if entries is None:
+        entries = _build_julia_versions_index(versions, get_platform())
+        if key[0] is not None:
+            index = {"key": key, "entries": [[k, files] for (_, k, files) in entries]}
+            try:
+                write_atomic(fn, json.dumps(index))
+            except OSError:
+                pass
+    _julia_versions_index = (key, versions, entries)
+    return entries
+
+
+def compatible_julia_versions(compat=None):
+    index = julia_versions_index()
+    if compat is None:
+        selected = index
+    else:
+        # each clause of compat is a range of versions, so find it by binary search
+        vers = [ver for (ver, _, _) in index]
+        idxs = []
+        for lo, hi in compat.bounds():
+            i = bisect.bisect_left(vers, lo)
+            j = bisect.bisect_left(vers, hi)
+            idxs.extend(range(i, j))
+        selected = [index[i] for i in idxs]
+    ans = {}
+    for _, k, files in selected:
+        v = all_julia_versions()[k].copy()
         v["files"] = files
         ans[k] = v
     triplets = {f["triplet"] for (k, v) in ans.items() for f in v["files"]}
@@ -150,90 +317,349 @@ def install_julia(ver, prefix):
                 break
         if installer is None:
             continue
-        # download julia
-        buf = download_julia(f)
-        # include the version in the prefix
+        # Julia is installed into a staging directory next to the prefix, which is then
+        # renamed to the prefix, so the prefix never contains a partial installation
         v = f["version"]
-        log(f"Installing Julia {v} to {prefix}")
-        if os.path.exists(prefix):
-            shutil.rmtree(prefix)
-        if os.path.dirname(prefix):
-            os.makedirs(os.path.dirname(prefix), exist_ok=True)
-        installer(f, buf, prefix)
+        t0 = time.time()
+        parent = os.path.dirname(os.path.abspath(prefix))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent, prefix=".juliapkg-staging-")
+        try:
+            dest = os.path.join(staging, "julia")
+            # partial downloads are kept here so they can be resumed
+            download_dir = os.path.join(parent, ".juliapkg-download")
+            filename = download_julia_ranged(
+                f,
+                os.path.join(download_dir, os.path.basename(url)),
+                workers=download_workers(),
+            )
+            if filename is None and ext in julia_streaming_installers:
+                # no range requests, so extract while downloading instead
+                with JuliaDownload(f) as src:
+                    log(f"Installing Julia {v} to {prefix}")
+                    installer(f, src, dest)
+                    src.verify()
+                log(f"  downloaded and extracted in {time.time() - t0:.1f}s", cont=True)
+            else:
+                if filename is None:
+                    filename = download_julia(
+                        f, os.path.join(staging, "download" + ext)
+                    )
+                t1 = time.time()
+                log(f"Installing Julia {v} to {prefix}")
+                installer(f, filename, dest)
+                log(f"  extracted in {time.time() - t1:.1f}s", cont=True)
+                if os.path.dirname(filename) == download_dir:
+                    shutil.rmtree(download_dir, ignore_errors=True)
+            t1 = time.time()
+            old = None
+            if os.path.exists(prefix):
+                # move the old installation out of the way, it is deleted with staging
+                old = os.path.join(staging, "old")
+                os.rename(prefix, old)
+            try:
+                os.rename(dest, prefix)
+            except BaseException:
+                # put the old installation back
+                if old is not None:
+                    os.rename(old, prefix)
+                raise
+            log(
+                f"  moved into place in {time.time() - t1:.1f}s"
+                f" (total {time.time() - t0:.1f}s)",
+                cont=True,
+            )
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
         return
     raise Exception("no installable Julia version found")
 
 
-def download_julia(f):
+class JuliaDownload:
+    """Context manager giving a readable file-like object streaming the Julia installer
+    described by f.
+
+    The data is hashed as it is read and `verify()` checks the hash at the end.
+    """
+
+    def __init__(self, f):
+        self.url = f["url"]
+        self.sha256 = f["sha256"]
+        self.size = f["size"]
+        self.hash = hashlib.sha256()
+        self.nbytes = 0
+
+    def __enter__(self):
+        log(f"Downloading Julia from {self.url}")
+        self.freq = 5
+        self.t0 = time.time()
+        self.t = self.t0 + self.freq
+        self.src = urllib.request.urlopen(self.url)
+        return self
+
+    def __exit__(self, *args):
+        self.src.close()
+
+    def read(self, n=-1):
+        data = self.src.read(n)
+        self.hash.update(data)
+        self.nbytes += len(data)
+        if time.time() > self.t:
+            log(
+                f"  downloaded {self.nbytes / (1 << 20):.1f} MB of"
+                f" {self.size / (1 << 20):.1f} MB",
+                cont=True,
+            )
+            self.t = time.time() + self.freq
+        return data
+
+    def verify(self):
+        # read anything not yet read, such as padding after the end of an archive
+        while self.read(1 << 16):
+            pass
+        log(f"  download complete in {time.time() - self.t0:.1f}s", cont=True)
+        log("Verifying download")
+        sha256actual = self.hash.hexdigest()
+        if sha256actual != self.sha256:
+            raise Exception(
+                f"SHA-256 hash does not match, got {sha256actual}, expecting"
+                f" {self.sha256}"
+            )
+
+
+def download_julia(f, filename):
+    """Download the Julia installer described by f to filename.
+
+    The file is streamed to disk and hashed as it arrives, so memory use does not depend
+    on the size of the download.
+    """
+    with JuliaDownload(f) as src, open(filename, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 16)
+        src.verify()
+    return filename
+
+
+def download_workers():
+    value, key = get_config("download_workers")
+    if value is None:
+        return DOWNLOAD_WORKERS
+    try:
+        value = int(value)
+        if value < 1:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f"{key} must be a positive integer")
+    return value
+
+
+def _journal_ok(journal, f, chunk_size, filename):
+    return (
+        isinstance(journal, dict)
+        and journal.get("url") == f["url"]
+        and journal.get("sha256") == f["sha256"]
+        and journal.get("size") == f["size"]
+        and journal.get("chunk_size") == chunk_size
+        and os.path.isfile(filename)
+        and os.path.getsize(filename) == f["size"]
+    )
+
+
+def _download_range(url, start, stop):
+    # returns the response, or None if the server ignored the range
+    req = urllib.request.Request(url, headers={"Range": f"bytes={start}-{stop - 1}"})
+    resp = urllib.request.urlopen(req)
+    if resp.status != 206:
+        resp.close()
+        return None
+    return resp
+
+
+def download_julia_ranged(f, filename, workers=DOWNLOAD_WORKERS):
+    """Download the Julia installer described by f to filename using range requests.
+
+    The file is split into chunks of DOWNLOAD_CHUNK_SIZE bytes which are downloaded by
+    `workers` concurrent threads. The chunks completed so far are recorded in a journal
+    file next to filename, so that an interrupted download is resumed by calling this
+    again. The SHA-256 hash of the whole file is checked at the end.
+
+    Returns filename, or None if the server does not support range requests.
+    """
     url = f["url"]
     sha256 = f["sha256"]
     size = f["size"]
+    chunk_size = DOWNLOAD_CHUNK_SIZE
+    nchunks = max(1, -(-size // chunk_size))
+    journal_file = filename + ".journal"
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    # load the journal of a previous download, if any
+    try:
+        with open(journal_file) as fp:
+            journal = json.load(fp)
+    except Exception:
+        journal = None
+    if _journal_ok(journal, f, chunk_size, filename):
+        done = set(journal["done"])
+    else:
+        done = set()
+        journal = {
+            "url": url,
+            "sha256": sha256,
+            "size": size,
+            "chunk_size": chunk_size,
+            "done": [],
+        }
+    todo = [i for i in range(nchunks) if i not in done]
     log(f"Downloading Julia from {url}")
-    buf = io.BytesIO()
-    freq = 5
-    t = time.time() + freq
-    with urllib.request.urlopen(url) as f:
+    t0 = time.time()
+    if todo:
+        # check the server supports range requests with the first chunk
+        i = todo[0]
+        resp = _download_range(url, i * chunk_size, min(size, (i + 1) * chunk_size))
+        if resp is None:
+            log("  server does not support range requests", cont=True)
+            return None
+        if done:
+            log(
+                f"  resuming, {len(done) * chunk_size / (1 << 20):.1f} MB already"
+                " downloaded",
+                cont=True,
+            )
+        elif not os.path.isfile(filename) or os.path.getsize(filename) != size:
+            with open(filename, "wb") as fp:
+                fp.truncate(size)
+        lock = threading.Lock()
+        freq = 5
+        progress = {"t": time.time() + freq}
+
+        def download_chunk(i, resp=None):
+            start = i * chunk_size
+            stop = min(size, start + chunk_size)
+            for attempt in range(DOWNLOAD_RETRIES):
+                try:
+                    if resp is None:
+                        resp = _download_range(url, start, stop)
+                        if resp is None:
+                            raise Exception("server stopped supporting range requests")
+                    with resp, open(filename, "r+b") as fp:
+                        fp.seek(start)
+                        nbytes = 0
+                        while True:
+                            data = resp.read(1 << 16)
+                            if not data:
+                                break
+                            fp.write(data)
+                            nbytes += len(data)
+                    if nbytes != stop - start:
+                        raise Exception(
+                            f"expecting {stop - start} bytes, got {nbytes} bytes"
+                        )
+                    break
+                except Exception:
+                    resp = None
+                    if attempt + 1 == DOWNLOAD_RETRIES:
+                        raise
+            with lock:
+                done.add(i)
+                journal["done"] = sorted(done)
+                write_atomic(journal_file, json.dumps(journal))
+                if time.time() > progress["t"]:
+                    log(
+                        f"  downloaded {len(done) * chunk_size / (1 << 20):.1f} MB of"
+                        f" {size / (1 << 20):.1f} MB",
+                        cont=True,
+                    )
+                    progress["t"] = time.time() + freq
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(download_chunk, todo[0], resp)]
+            futures += [pool.submit(download_chunk, i) for i in todo[1:]]
+            for future in concurrent.futures.as_completed(futures):
+                # raises any error, the journal records what was completed
+                future.result()
+    log(f"  download complete in {time.time() - t0:.1f}s", cont=True)
+    log("Verifying download")
+    m = hashlib.sha256()
+    with open(filename, "rb") as fp:
         while True:
-            data = f.read(1 << 16)
+            data = fp.read(1 << 20)
             if not data:
                 break
-            buf.write(data)
-            if time.time() > t:
-                log(
-                    f"  downloaded {buf.tell() / (1 << 20):.1f} MB of"
-                    f" {size / (1 << 20):.1f} MB",
-                    cont=True,
-                )
-                t = time.time() + freq
-    log("  download complete", cont=True)
-    log("Verifying download")
-    buf.seek(0)
-    m = hashlib.sha256()
-    m.update(buf.read())
+            m.update(data)
     sha256actual = m.hexdigest()
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
     if sha256actual != sha256:
+        os.remove(filename)
         raise Exception(
             f"SHA-256 hash does not match, got {sha256actual}, expecting {sha256}"
         )
-    buf.seek(0)
-    return buf
+    return filename
 
 
-def install_julia_zip(f, buf, prefix):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # extract all files
-        with zipfile.ZipFile(buf) as zf:
-            zf.extractall(tmpdir)
-        # copy stuff out
-        srcdirs = [d for d in os.listdir(tmpdir) if d.startswith("julia")]
-        if len(srcdirs) != 1:
-            raise Exception("expecting one julia* directory")
-        shutil.copytree(os.path.join(tmpdir, srcdirs[0]), prefix, symlinks=True)
+def _move_julia_dir(srcdir, dest):
+    # move the single julia* directory in srcdir to dest
+    juliadirs = [d for d in os.listdir(srcdir) if d.startswith("julia")]
+    if len(juliadirs) != 1:
+        raise Exception("expecting one julia* directory")
+    os.rename(os.path.join(srcdir, juliadirs[0]), dest)
 
 
-def install_julia_tar_gz(f, buf, prefix):
-    with tempfile.TemporaryDirectory() as tmpdir:
+def install_julia_zip(f, filename, dest):
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(dest)) as tmpdir:
         # extract all files
-        with gzip.GzipFile(fileobj=buf) as gf:
-            with tarfile.TarFile(fileobj=gf) as tf:
-                tf.extractall(tmpdir)
-        # copy stuff out
-        srcdirs = [d for d in os.listdir(tmpdir) if d.startswith("julia")]
-        if len(srcdirs) != 1:
-            raise Exception("expecting one julia* directory")
-        shutil.copytree(os.path.join(tmpdir, srcdirs[0]), prefix, symlinks=True)
+        with zipfile.ZipFile(filename) as zf:
+            zf.extractall(tmpdir)
+        _move_julia_dir(tmpdir, dest)
+
 
+def _checked_members(tf, dest):
+    # the members of the tar file, checking that none is written or links outside dest,
+    # as the "data" extraction filter does, for Pythons without it
+    dest = os.path.abspath(dest)
 
-def install_julia_dmg(f, buf, prefix):
+    def check(path):
+        try:
+            if os.path.commonpath([dest, os.path.normpath(path)]) == dest:
+                return
+        except ValueError:
+            # on different drives
+            pass
+        raise Exception(f"unsafe member in Julia archive: {member.name!r}")
+
+    for member in tf:
+        check(os.path.join(dest, member.name))
+        if member.issym():
+            check(os.path.join(dest, os.path.dirname(member.name), member.linkname))
+        elif member.islnk():
+            check(os.path.join(dest, member.linkname))
+        elif not (member.isfile() or member.isdir()):
+            raise Exception(f"unsafe member in Julia archive: {member.name!r}")
+        yield member
+
+
+def install_julia_tar_gz(f, src, dest):
+    # src is a file name or a (non-seekable) readable file, which may be extracted
+    # before its hash is verified, so members outside the directory are rejected
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(dest)) as tmpdir:
+        # extract all files
+        if isinstance(src, str):
+            tf = tarfile.open(src, "r|gz")
+        else:
+            tf = tarfile.open(fileobj=src, mode="r|gz")
+        with tf:
+            if hasattr(tarfile, "data_filter"):
+                tf.extractall(tmpdir, filter="data")
+            else:
+                tf.extractall(tmpdir, members=_checked_members(tf, tmpdir))
+        _move_julia_dir(tmpdir, dest)
+
+
+def install_julia_dmg(f, filename, dest):
     with tempfile.TemporaryDirectory() as tmpdir:
-        # write the dmg file out
-        dmg = os.path.join(tmpdir, "dmg")
-        with open(dmg, "wb") as f:
-            f.write(buf.read())
         # mount it
         mount = os.path.join(tmpdir, "mount")
         subprocess.run(
-            ["hdiutil", "mount", "-mount", "required", "-mountpoint", mount, dmg],
+            ["hdiutil", "mount", "-mount", "required", "-mountpoint", mount, filename],
             check=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -248,7 +674,7 @@ def install_julia_dmg(f, buf, prefix):
             if len(appdirs) != 1:
                 raise Exception("expecting one Julia*.app directory")
             srcdir = os.path.join(mount, appdirs[0], "Contents", "Resources", "julia")
-            shutil.copytree(srcdir, prefix, symlinks=True)
+            shutil.copytree(srcdir, dest, symlinks=True)
         finally:
             # unmount
             subprocess.run(
@@ -264,3 +690,6 @@ julia_installers = {
     ".zip": install_julia_zip,
     ".dmg": install_julia_dmg,
 }
+
+# installers which can extract while downloading, reading from a JuliaDownload
+julia_streaming_installers = {".tar.gz"}
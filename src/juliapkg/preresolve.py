@@ -0,0 +1,290 @@
+"""Predict the result of resolving Julia packages, without starting Julia.
+
+This uses the versions, dependencies and compat bounds of packages in the local
+registries to find the versions that Pkg would install, so that resolving can be skipped
+when the Manifest.toml already has these versions.
+"""
+
+import heapq
+import logging
+import os
+
+# we can switch to tomllib when we require python 3.11+
+import tomli
+
+from .compat import Compat, Version
+from .registry import _find_package_versions
+
+logger = logging.getLogger("juliapkg")
+
+
+def _fetch_closure(uuids, provider):
+    # fetch the given packages and all their possible dependencies
+    infos = {}
+    fetched = set()
+    todo = set(uuids)
+    while todo:
+        infos.update(provider(sorted(todo)))
+        fetched.update(todo)
+        todo = {
+            dep
+            for info in infos.values()
+            for deps in info["deps"].values()
+            for dep in deps.values()
+        }
+        todo -= fetched
+        todo -= infos.keys()
+    return infos
+
+
+def _registry_provider(uuids):
+    return _find_package_versions(uuids, recursive=True)
+
+
+_UNCONSTRAINED = object()
+
+# the most steps (package versions tried) to take before giving up
+MAX_STEPS = 100_000
+
+
+def resolve_versions(requirements, julia_version=None, provider=None, max_steps=None):
+    """Choose a version of every package needed to satisfy the requirements.
+
+    Args:
+        requirements: A dict mapping UUIDs to a Compat (or None for any version).
+        julia_version: The Version of Julia, to check the "julia" compat of packages.
+        provider: A function taking a list of UUIDs and returning a dict mapping those
+            found to their registered versions, deps and compat, as returned by
+            `registry._find_package_versions()`. By default, they are read from the
+            registries, fetching all dependencies at once.
+        max_steps: Give up after trying this many package versions (default
+            `MAX_STEPS`).
+
+    Returns:
+        A dict mapping the UUID of every package needed (which is in the registry) to
+        its chosen version, or None if there is no solution or none was found within
+        max_steps. Packages not known to the provider (such as standard libraries) are
+        assumed compatible with anything.
+
+    Packages are assigned in the order they are needed, trying the highest compatible
+    version first, checking that each dependency still has a compatible version and
+    backtracking on conflicts to the most recent package involved. This finds the same
+    solution as Pkg in the usual case where the highest versions are compatible.
+    """
+    if provider is None:
+        provider = _registry_provider
+    if max_steps is None:
+        max_steps = MAX_STEPS
+    infos = _fetch_closure(requirements, provider)
+
+    # the versions of each package, highest first, dropping those incompatible with
+    # this Julia
+    versions = {}
+    for uuid, info in infos.items():
+        compat = info["compat"]
+        versions[uuid] = [
+            (Version.parse(ver), ver)
+            for ver in reversed(info["versions"])
+            if julia_version is None
+            or "julia" not in compat[ver]
+            or julia_version in Compat.parse(compat[ver]["julia"])
+        ]
+
+    # packages are assigned dependants first, so that each package is assigned once all
+    # the constraints on it are known (except in dependency cycles)
+    rank = _dependants_first(infos)
+
+    # the search state, changes to which are recorded in the trail so they can be undone
+    assigned = {}  # uuid -> (Version, version string, depth in stack)
+    constraints = {}  # uuid -> Compat (or None for any version)
+    sources = {}  # uuid -> depths in stack of the packages constraining it
+    trail = []
+    # (rank, uuid) of needed packages, possibly stale
+    queue = []
+
+    def need(uuid, compat, src):
+        # constrain the package, returning the depths responsible on conflict
+        if uuid not in constraints:
+            trail.append((uuid, _UNCONSTRAINED, ()))
+            heapq.heappush(queue, (rank[uuid], uuid))
+            srcs = ()
+        else:
+            trail.append((uuid, constraints[uuid], sources[uuid]))
+            srcs = sources[uuid]
+            if compat is None:
+                return None
+            if constraints[uuid] is not None:
+                compat = constraints[uuid] & compat
+        constraints[uuid] = compat
+        srcs = sources[uuid] = srcs if src is None else srcs + (src,)
+        if uuid in assigned:
+            if not (compat is None or assigned[uuid][0] in compat):
+                return set(srcs) | {assigned[uuid][2]}
+        elif not candidates(uuid):
+            return set(srcs)
+        return None
+
+    def candidates(uuid):
+        compat = constraints[uuid]
+        return [x for x in versions[uuid] if compat is None or x[0] in compat]
+
+    def undo(ntrail):
+        while len(trail) > ntrail:
+            uuid, compat, srcs = trail.pop()
+            if compat is _UNCONSTRAINED:
+                del constraints[uuid], sources[uuid]
+            else:
+                constraints[uuid] = compat
+                sources[uuid] = srcs
+
+    def unassign(uuid):
+        if assigned.pop(uuid, None) is not None:
+            heapq.heappush(queue, (rank[uuid], uuid))
+
+    def assign(depth, uuid, v, ver):
+        assigned[uuid] = (v, ver, depth)
+        info = infos[uuid]
+        compat = info["compat"][ver]
+        for name, dep in info["deps"][ver].items():
+            if dep in infos:
+                depcompat = compat.get(name)
+                if depcompat is not None:
+                    depcompat = Compat.parse(depcompat)
+                conflict = need(dep, depcompat, depth)
+                if conflict is not None:
+                    return conflict
+        return None
+
+    def next_package():
+        while queue:
+            uuid = queue[0][1]
+            if uuid in constraints and uuid not in assigned:
+                return uuid
+            heapq.heappop(queue)
+        return None
+
+    for uuid, compat in requirements.items():
+        if uuid in infos and need(uuid, compat, None) is not None:
+            return None
+
+    # depth-first search with conflict-directed backjumping, each frame is [package,
+    # untried candidates, length of trail, depths of the packages responsible for
+    # conflicts]
+    stack = []
+    steps = 0
+    while True:
+        uuid = next_package()
+        if uuid is None:
+            return {uuid: ver for (uuid, (_, ver, _)) in assigned.items()}
+        stack.append([uuid, candidates(uuid), len(trail), set(sources[uuid])])
+        while True:
+            if not stack:
+                return None
+            depth = len(stack) - 1
+            frame = stack[-1]
+            uuid, cands, ntrail, conflict = frame
+            unassign(uuid)
+            undo(ntrail)
+            if not cands:
+                # no version works, so jump back to the most recent package responsible
+                conflict.discard(depth)
+                if not conflict:
+                    return None
+                back = max(conflict)
+                conflict.discard(back)
+                stack[back][3].update(conflict)
+                for k in range(back + 1, depth):
+                    unassign(stack[k][0])
+                del stack[back + 1 :]
+                continue
+            steps += 1
+            if steps > max_steps:
+                logger.debug("gave up resolving after %d steps", max_steps)
+                return None
+            (v, ver), frame[1] = cands[0], cands[1:]
+            causes = assign(depth, uuid, v, ver)
+            if causes is None:
+                break
+            conflict.update(causes)
+
+
+def _dependants_first(infos):
+    # rank the packages so that each comes before its dependencies (if possible)
+    deps = {
+        uuid: {dep for vdeps in info["deps"].values() for dep in vdeps.values()}
+        for (uuid, info) in infos.items()
+    }
+    postorder = []
+    visited = set()
+    for root in sorted(infos):
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, iter(sorted(deps[root])))]
+        while stack:
+            uuid, it = stack[-1]
+            for dep in it:
+                if dep in infos and dep not in visited:
+                    visited.add(dep)
+                    stack.append((dep, iter(sorted(deps[dep]))))
+                    break
+            else:
+                stack.pop()
+                postorder.append(uuid)
+    return {uuid: -i for (i, uuid) in enumerate(postorder)}
+
+
+def _manifest_packages(manifest):
+    # the registered packages in a parsed manifest, or None if any are not registered
+    if "manifest_format" in manifest:
+        deps = manifest.get("deps", {})
+    else:
+        deps = manifest
+    ans = {}
+    for entries in deps.values():
+        if not isinstance(entries, list):
+            continue
+        for entry in entries:
+            if "path" in entry or "repo-url" in entry:
+                return None
+            if "git-tree-sha1" in entry and "version" in entry:
+                ans[entry["uuid"]] = entry["version"]
+    return ans
+
+
+def read_manifest(path):
+    """The registered packages in the Manifest.toml at path, as a dict mapping UUIDs to
+    versions.
+
+    Returns None if the manifest has any package tracking a path or repository.
+    """
+    with open(path, "rb") as fp:
+        return _manifest_packages(tomli.load(fp))
+
+
+def manifest_is_current(project, pkgs, julia_version):
+    """True if the Manifest.toml in project has exactly the registered package versions
+    that resolving pkgs (a list of PkgSpec) with the given Julia would give."""
+    if any(pkg.dev or pkg.path or pkg.url or pkg.rev for pkg in pkgs):
+        return False
+    manifest_path = os.path.join(project, "Manifest.toml")
+    if not os.path.isfile(manifest_path):
+        return False
+    try:
+        with open(manifest_path, "rb") as fp:
+            manifest = tomli.load(fp)
+        if manifest.get("julia_version", str(julia_version)) != str(julia_version):
+            return False
+        current = _manifest_packages(manifest)
+        if current is None:
+            return False
+        requirements = {
+            pkg.uuid: None if pkg.version is None else Compat.parse(str(pkg.version))
+            for pkg in pkgs
+        }
+        predicted = resolve_versions(requirements, julia_version)
+    except Exception:
+        logger.debug("could not predict the manifest", exc_info=True)
+        return False
+    logger.debug("predicted manifest %r, current manifest %r", predicted, current)
+    return predicted == current
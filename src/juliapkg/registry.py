@@ -1,9 +1,20 @@
+import functools
+import gzip
+import json
+import mmap
 import os
+import struct
 import tarfile
+import time
+import uuid as uuid_mod
+import zlib
 
 # we can switch to tomllib when we require python 3.11+
 import tomli
 
+from .compat import Compat, Range, Version, _parse_partial_version
+from .state import STATE, write_atomic
+
 
 def _find_registries():
     depots = os.environ.get("JULIA_DEPOT_PATH", "").split(os.pathsep)
@@ -13,16 +24,46 @@ def _find_registries():
         if not depot:
             continue
         regdir = os.path.join(depot, "registries")
+        if not os.path.isdir(regdir):
+            continue
         for fn in os.listdir(regdir):
             if fn.endswith(".toml"):
                 regmetafile = os.path.join(regdir, fn)
                 with open(regmetafile, "rb") as fp:
                     regmeta = tomli.load(fp)
                 regmeta["path"] = os.path.join(regdir, regmeta["path"])
+                regmeta["file"] = regmetafile
                 registries.append(regmeta)
     return registries
 
 
+def _registry_update_time(reg):
+    # Pkg rewrites the .toml file next to a registry tarball when it updates it, and
+    # git registries are fetched
+    regpath = reg["path"]
+    if regpath.endswith(".tar.gz"):
+        return os.path.getmtime(reg["file"])
+    fetch_head = os.path.join(regpath, ".git", "FETCH_HEAD")
+    if os.path.exists(fetch_head):
+        return os.path.getmtime(fetch_head)
+    return os.path.getmtime(regpath)
+
+
+def registries_age():
+    """The time in seconds since the least recently updated registry was updated.
+
+    Returns None if there are no registries.
+    """
+    times = []
+    for reg in _find_registries():
+        try:
+            times.append(_registry_update_time(reg))
+        except OSError:
+            return None
+    if times:
+        return max(0.0, time.time() - min(times))
+
+
 _REGISTRY_INDEX_CACHE = {}
 
 
@@ -37,8 +78,14 @@ def _load_registry_index(reg):
     if not os.path.exists(regpath):
         raise ValueError(f"registry does not exist: {regpath}")
     if regpath.endswith(".tar.gz"):
-        with tarfile.open(regpath) as reg:
-            regidx = tomli.load(reg.extractfile("Registry.toml"))
+        # stop at Registry.toml instead of listing the whole tarball
+        with tarfile.open(regpath) as tf:
+            for member in tf:
+                if member.name.removeprefix("./") == "Registry.toml":
+                    regidx = tomli.load(tf.extractfile(member))
+                    break
+            else:
+                raise ValueError(f"registry has no Registry.toml: {regpath}")
     elif os.path.isdir(regpath):
         with open(os.path.join(regpath, "Registry.toml"), "rb") as fp:
             regidx = tomli.load(fp)
@@ -48,15 +95,373 @@ def _load_registry_index(reg):
     return regidx
 
 
-def _find_uuid(pkgname):
-    uuids = {}
-    for reg in _find_registries():
+# Format of the name index of a registry, saved to {prefix}/registries/{hash}.idx:
+# - header: magic, number of slots (a power of 2), number of packages
+# - slots: offset+1 of a package in the entries, or 0 if empty
+# - entries: for each package the length of its name, its name and its UUID
+# A package is found by hashing its name to a slot and probing linearly from there.
+_NAME_INDEX_MAGIC = b"JLPKGNI1"
+_NAME_INDEX_HEADER = struct.Struct("<8sII")
+_NAME_INDEX_SLOT = struct.Struct("<I")
+_NAME_INDEX_NAME_LEN = struct.Struct("<H")
+
+_NAME_INDEX_CACHE = {}
+
+
+def _build_name_index(regidx):
+    packages = [
+        (info["name"].encode("utf8"), uuid_mod.UUID(uuid).bytes)
+        for (uuid, info) in regidx["packages"].items()
+    ]
+    nslots = 1
+    while nslots < 2 * len(packages):
+        nslots *= 2
+    slots = [0] * nslots
+    entries = bytearray()
+    for name, uuid in packages:
+        h = zlib.crc32(name) & (nslots - 1)
+        while slots[h]:
+            h = (h + 1) & (nslots - 1)
+        slots[h] = len(entries) + 1
+        entries += _NAME_INDEX_NAME_LEN.pack(len(name)) + name + uuid
+    header = _NAME_INDEX_HEADER.pack(_NAME_INDEX_MAGIC, nslots, len(packages))
+    return header + struct.pack(f"<{nslots}I", *slots) + bytes(entries)
+
+
+class _NameIndex:
+    """The name index of a registry, in memory or memory-mapped from a file."""
+
+    def __init__(self, buf):
+        self.buf = buf
+        magic, self.nslots, _ = _NAME_INDEX_HEADER.unpack_from(self.buf)
+        if magic != _NAME_INDEX_MAGIC:
+            raise ValueError("not a registry name index")
+        self.entries = _NAME_INDEX_HEADER.size + self.nslots * _NAME_INDEX_SLOT.size
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, "rb") as fp:
+            return cls(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def lookup(self, pkgname):
+        """The UUIDs of all packages called pkgname."""
+        name = pkgname.encode("utf8")
+        ans = []
+        h = zlib.crc32(name) & (self.nslots - 1)
+        while True:
+            (offset,) = _NAME_INDEX_SLOT.unpack_from(
+                self.buf, _NAME_INDEX_HEADER.size + h * _NAME_INDEX_SLOT.size
+            )
+            if not offset:
+                return ans
+            offset = self.entries + offset - 1
+            (n,) = _NAME_INDEX_NAME_LEN.unpack_from(self.buf, offset)
+            offset += _NAME_INDEX_NAME_LEN.size
+            if self.buf[offset : offset + n] == name:
+                offset += n
+                ans.append(str(uuid_mod.UUID(bytes=self.buf[offset : offset + 16])))
+            h = (h + 1) & (self.nslots - 1)
+
+
+def _prune_registry_files(registries=None):
+    # remove the files in {prefix}/registries belonging to registries which no longer
+    # exist (usually because they were updated), called after writing a new one
+    if registries is None:
+        registries = _find_registries()
+    current = {reg.get("git-tree-sha1") for reg in registries}
+    dirname = os.path.join(STATE["prefix"], "registries")
+    for fn in os.listdir(dirname):
+        for suffix in [".idx", ".versions.json"]:
+            if fn.endswith(suffix) and fn[: -len(suffix)] not in current:
+                try:
+                    os.remove(os.path.join(dirname, fn))
+                except OSError:
+                    pass
+
+
+def _load_name_index(reg, registries=None):
+    # look it up in the cache
+    reghash = reg["git-tree-sha1"]
+    nameidx = _NAME_INDEX_CACHE.get(reghash, None)
+    if nameidx is not None:
+        return nameidx
+    # load it from disk, building it if necessary
+    fn = os.path.join(STATE["prefix"], "registries", f"{reghash}.idx")
+    try:
+        nameidx = _NameIndex.open(fn)
+    except (OSError, ValueError, struct.error):
+        data = _build_name_index(_load_registry_index(reg))
+        try:
+            write_atomic(fn, data)
+            _prune_registry_files(registries)
+            nameidx = _NameIndex.open(fn)
+        except OSError:
+            # the prefix is not writable, so just keep it in memory
+            nameidx = _NameIndex(data)
+    _NAME_INDEX_CACHE[reghash] = nameidx
+    return nameidx
+
+
+def _find_uuids(pkgnames):
+    """Find the UUIDs of many packages at once.
+
+    Returns a dict mapping each name to a dict mapping each UUID to the list of
+    registries it is in.
+    """
+    ans = {pkgname: {} for pkgname in pkgnames}
+    registries = _find_registries()
+    for reg in registries:
         regpath = reg["path"]
         if not os.path.exists(regpath):
             continue
-        regidx = _load_registry_index(reg)
-        for uuid, info in regidx["packages"].items():
-            if info["name"] != pkgname:
-                continue
-            uuids.setdefault(uuid, []).append(regpath)
-    return uuids
+        nameidx = _load_name_index(reg, registries)
+        for pkgname, uuids in ans.items():
+            for uuid in nameidx.lookup(pkgname):
+                uuids.setdefault(uuid, []).append(regpath)
+    return ans
+
+
+def _find_uuid(pkgname):
+    return _find_uuids([pkgname])[pkgname]
+
+
+# upper bound for the open-ended version range "*"
+_MAX_VERSION = Version(1 << 31, 0, 0)
+
+
+def _parse_version_spec(spec):
+    """Parse a version specifier as used in a registry into a Compat.
+
+    These are lists of ranges like "1.2-1.5", "1.2-*", "1" or "*", given either as a
+    comma-separated string or a list. Unlike compat entries, "1.2" means exactly the
+    versions 1.2.x.
+    """
+    parts = spec.split(",") if isinstance(spec, str) else spec
+    clauses = []
+    for part in parts:
+        part = part.strip()
+        if part == "*":
+            clauses.append(Range(Version(0, 0, 0), _MAX_VERSION))
+            continue
+        lo, _, hi = part.partition("-")
+        v1, n1 = _parse_partial_version(lo.strip())
+        if not hi:
+            v2, n2 = v1, n1
+        elif hi.strip() == "*":
+            v2, n2 = _MAX_VERSION, 3
+        else:
+            v2, n2 = _parse_partial_version(hi.strip())
+        if v1 is None or v2 is None:
+            raise ValueError(f"invalid version specifier in registry: {spec!r}")
+        clauses.append(Range.hyphen(v1, v2, n2))
+    return Compat(clauses)
+
+
+@functools.lru_cache(maxsize=4096)
+def _version_spec(spec):
+    return _parse_version_spec(spec)
+
+
+@functools.lru_cache(maxsize=4096)
+def _version_spec_str(spec):
+    return str(_parse_version_spec(spec))
+
+
+def _expand_version_ranges(table, versions, parse=lambda x: x):
+    # table maps version ranges to dicts, returns a dict mapping each version to the
+    # merged dicts of all ranges including it
+    ans = {ver: {} for ver in versions}
+    parsed = [(ver, Version.parse(ver)) for ver in versions]
+    for spec, values in table.items():
+        compat = _version_spec(spec)
+        values = {k: parse(v) for (k, v) in values.items()}
+        for ver, v in parsed:
+            if v in compat:
+                ans[ver].update(values)
+    return ans
+
+
+def _iter_tarball(path, wanted):
+    # yield (name, contents) for the wanted regular files in a .tar.gz
+    # this only reads names and sizes from the headers, which is several times faster
+    # than tarfile on registries, whose tarballs have tens of thousands of small files
+    with gzip.open(path, "rb") as fp:
+        longname = None
+        while True:
+            header = fp.read(512)
+            if len(header) < 512 or not header.strip(b"\0"):
+                return
+            size = int(header[124:136].strip(b"\0 ") or b"0", 8)
+            kind = header[156:157]
+            if kind == b"L":
+                # GNU long name of the next file
+                longname = fp.read(size).split(b"\0", 1)[0]
+            elif kind == b"x":
+                # POSIX extended header, of which we only need the path of the next file
+                for record in fp.read(size).split(b"\n"):
+                    _, _, keyval = record.partition(b" ")
+                    if keyval.startswith(b"path="):
+                        longname = keyval[5:]
+            else:
+                if longname is None:
+                    name = header[:100].split(b"\0", 1)[0]
+                    if header[257:262] == b"ustar" and header[345]:
+                        name = header[345:500].split(b"\0", 1)[0] + b"/" + name
+                else:
+                    name, longname = longname, None
+                fn = name.decode("utf8").removeprefix("./")
+                if kind in (b"0", b"\0") and wanted(fn):
+                    yield fn, fp.read(size)
+                else:
+                    fp.seek(size, 1)
+            fp.seek(-size % 512, 1)
+
+
+def _read_registry_files(reg, fns):
+    # read the given files from the registry, in one pass if it is a tarball, fns can
+    # also be a predicate on file names (for tarballs only)
+    regpath = reg["path"]
+    ans = {}
+    if regpath.endswith(".tar.gz"):
+        wanted = fns if callable(fns) else set(fns).__contains__
+        for fn, data in _iter_tarball(regpath, wanted):
+            ans[fn] = data
+    else:
+        for fn in fns:
+            path = os.path.join(regpath, *fn.split("/"))
+            if os.path.isfile(path):
+                with open(path, "rb") as fp:
+                    ans[fn] = fp.read()
+    return ans
+
+
+def _parse_package_versions(files, path):
+    def load(fn):
+        data = files.get(f"{path}/{fn}")
+        return {} if data is None else tomli.loads(data.decode("utf8"))
+
+    versions = sorted(
+        (
+            ver
+            for (ver, info) in load("Versions.toml").items()
+            if not info.get("yanked", False)
+        ),
+        key=Version.parse,
+    )
+    return {
+        "versions": versions,
+        "deps": _expand_version_ranges(load("Deps.toml"), versions),
+        "compat": _expand_version_ranges(
+            load("Compat.toml"),
+            versions,
+            lambda x: _version_spec_str(x if isinstance(x, str) else tuple(x)),
+        ),
+    }
+
+
+_VERSIONS_CACHE = {}
+
+
+def _dependency_closure(reg, uuids, cache):
+    # the given packages and everything they may depend on in the registry, reading
+    # the Deps.toml of packages not already in the cache
+    packages = _load_registry_index(reg)["packages"]
+    depsfiles = None
+    ans = set()
+    todo = list(uuids)
+    while todo:
+        uuid = todo.pop()
+        if uuid in ans:
+            continue
+        ans.add(uuid)
+        info = cache.get(uuid)
+        if info is not None:
+            todo.extend(dep for deps in info["deps"].values() for dep in deps.values())
+            continue
+        if uuid not in packages:
+            continue
+        fn = f"{packages[uuid]['path']}/Deps.toml"
+        if reg["path"].endswith(".tar.gz"):
+            # read every Deps.toml in one pass, instead of a pass per dependency
+            if depsfiles is None:
+                depsfiles = _read_registry_files(
+                    reg, lambda fn: fn.endswith("/Deps.toml")
+                )
+            data = depsfiles.get(fn)
+        else:
+            data = _read_registry_files(reg, [fn]).get(fn)
+        if data is not None:
+            deps = tomli.loads(data.decode("utf8"))
+            todo.extend(dep for vdeps in deps.values() for dep in vdeps.values())
+    return list(ans)
+
+
+def _load_package_versions(reg, uuids, recursive=False, registries=None):
+    """The registered versions of the given packages, and their deps and compat.
+
+    Returns a dict mapping each UUID to None (if it is not in this registry) or a dict
+    with keys "versions" (the non-yanked versions in increasing order), "deps" (mapping
+    each version to a dict of dependency names to UUIDs) and "compat" (mapping each
+    version to a dict of dependency names to compat strings). If recursive, this also
+    includes every package they may depend on.
+
+    Packages are read from the registry the first time they are asked for, and then kept
+    in {prefix}/registries/{hash}.versions.json. Whenever this is written, the files of
+    registries not among registries (by default, those currently installed) are removed.
+    """
+    reghash = reg["git-tree-sha1"]
+    fn = os.path.join(STATE["prefix"], "registries", f"{reghash}.versions.json")
+    cache = _VERSIONS_CACHE.get(reghash)
+    if cache is None:
+        try:
+            with open(fn) as fp:
+                cache = json.load(fp)
+        except Exception:
+            cache = {}
+        _VERSIONS_CACHE[reghash] = cache
+    if recursive:
+        uuids = _dependency_closure(reg, uuids, cache)
+    missing = [uuid for uuid in uuids if uuid not in cache]
+    if missing:
+        packages = _load_registry_index(reg)["packages"]
+        paths = {}
+        for uuid in missing:
+            if uuid in packages:
+                paths[uuid] = packages[uuid]["path"]
+            else:
+                cache[uuid] = None
+        files = _read_registry_files(
+            reg,
+            [
+                f"{path}/{name}"
+                for path in paths.values()
+                for name in ["Versions.toml", "Deps.toml", "Compat.toml"]
+            ],
+        )
+        for uuid, path in paths.items():
+            cache[uuid] = _parse_package_versions(files, path)
+        try:
+            write_atomic(fn, json.dumps(cache))
+            _prune_registry_files(registries)
+        except OSError:
+            pass
+    return {uuid: cache[uuid] for uuid in uuids}
+
+
+def _find_package_versions(uuids, recursive=False):
+    """The registered versions of the given packages, from the first registry they are
+    in. See `_load_package_versions()`, except packages in no registry are omitted."""
+    ans = {}
+    todo = list(uuids)
+    registries = _find_registries()
+    for reg in registries:
+        if not todo:
+            break
+        if not os.path.exists(reg["path"]):
+            continue
+        infos = _load_package_versions(reg, todo, recursive, registries)
+        for uuid, info in infos.items():
+            if info is not None:
+                ans.setdefault(uuid, info)
+        todo = [uuid for uuid in todo if uuid not in ans]
+    return ans
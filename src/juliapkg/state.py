@@ -1,4 +1,6 @@
 import os
+import secrets
+import stat
 import sys
 from typing import Final
 
@@ -39,6 +41,39 @@ def get_config_bool(name, default=False):
     )
 
 
+def write_atomic(fn, data):
+    """Write data (str or bytes) to the file fn atomically.
+
+    The data is written to a temporary file in the same directory which then replaces
+    fn, so concurrent readers see either the old or the new contents, never a partial
+    file. The file keeps its permissions if it exists, otherwise it gets the usual
+    permissions for a new file.
+    """
+    dirname = os.path.dirname(os.path.abspath(fn))
+    os.makedirs(dirname, exist_ok=True)
+    binary = isinstance(data, bytes)
+    try:
+        mode = stat.S_IMODE(os.stat(fn).st_mode)
+    except OSError:
+        mode = 0o666  # less the umask
+    while True:
+        tmp = os.path.join(
+            dirname, f".tmp-{secrets.token_hex(4)}-{os.path.basename(fn)}"
+        )
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+            break
+        except FileExistsError:
+            pass
+    try:
+        with os.fdopen(fd, "wb" if binary else "w") as fp:
+            fp.write(data)
+        os.replace(tmp, fn)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
 def reset_state():
     STATE.clear()
 
@@ -90,9 +125,18 @@ def reset_state():
     STATE["meta"] = os.path.join(STATE["prefix"], "meta.json")
     STATE["install"] = os.path.join(STATE["prefix"], "install")
 
+    # lock held while resolving and while writing to the caches in the prefix
+    STATE["lock"] = os.path.join(STATE["project"], "lock.pid")
+
+    # how to find deps files
+    STATE["discovery"], _ = get_config_opts("discovery", ["scan", "metadata"], "scan")
+
     # offline
     STATE["offline"], _ = get_config_bool("offline")
 
+    # only add and remove changed packages when resolving, keeping the manifest
+    STATE["incremental"], _ = get_config_bool("incremental")
+
     # resolution
     STATE["resolved"] = False
 
@@ -0,0 +1,357 @@
+"""A long-lived Julia process for running scripts, to avoid starting Julia each time.
+
+There is at most one worker per (executable, project). It listens on a local TCP port,
+written with a random token to an info file in {prefix}/workers, and exits after being
+idle for a while. The worker owns a pidfile (using Julia's FileWatching.Pidfile) so
+there is never more than one, and clients hold a file lock while finding or starting
+it.
+
+Messages in both directions are frames: a one-byte kind, an 8-byte little-endian length
+and the payload. The client sends the token ("t"), its environment ("v", the names and
+values separated by NUL) and then the script ("s"). The worker runs the script in that
+environment, restoring its own afterwards. It replies with any output ("o" for stdout,
+"e" for stderr) and then the result ("r"), which is empty on success or else describes
+the error.
+"""
+
+import hashlib
+import json
+import os
+import secrets
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from filelock import FileLock
+
+from .compat import Version
+from .find_julia import julia_fingerprint, julia_version
+from .state import STATE, get_config, get_config_bool
+
+# how long a worker waits for another script before exiting
+WORKER_TIMEOUT = 600
+
+# how long to wait for a new worker to start listening
+WORKER_START_TIMEOUT = 120
+
+# the worker uses FileWatching.Pidfile, which is new in Julia 1.9
+WORKER_MIN_JULIA_VERSION = Version(1, 9, 0)
+
+_FRAME_HEADER = struct.Struct("<cQ")
+
+# environment variables read by Julia when it starts, so a worker started with different
+# values cannot be used
+_STARTUP_ENV = ["JULIA_DEPOT_PATH", "JULIA_LOAD_PATH", "JULIA_NUM_THREADS"]
+
+WORKER_SCRIPT = """
+import Logging, Sockets
+using FileWatching.Pidfile: mkpidlock
+const INFO_FILE, PID_FILE = ARGS[1], ARGS[2]
+const TIMEOUT = parse(Float64, ARGS[3])
+const TOKEN = pop!(ENV, "JULIAPKG_WORKER_TOKEN")
+# exit if another worker owns the pidfile
+const PIDLOCK = try
+    mkpidlock(PID_FILE; wait=false)
+catch
+    exit(0)
+end
+import Pkg
+const SERVER = Sockets.listen(Sockets.localhost, 0)
+let port = Sockets.getsockname(SERVER)[2], tmp = INFO_FILE * ".tmp"
+    touch(tmp)
+    chmod(tmp, 0o600)
+    info = "\\"pid\\": $(getpid()), \\"port\\": $(Int(port)), \\"token\\": \\"$TOKEN\\""
+    write(tmp, "{$info}")
+    mv(tmp, INFO_FILE; force=true)
+end
+
+function send(sock, lock, kind, data)
+    data = Vector{UInt8}(data)
+    Base.@lock lock begin
+        write(sock, UInt8(kind), htol(UInt64(length(data))), data)
+        flush(sock)
+    end
+end
+
+function recv(sock)
+    kind = Char(read(sock, UInt8))
+    n = ltoh(read(sock, UInt64))
+    return kind, String(read(sock, n))
+end
+
+function withclientenv(f, env)
+    saved = Dict(ENV)
+    function replaceenv(vars)
+        for name in collect(keys(ENV))
+            haskey(vars, name) || delete!(ENV, name)
+        end
+        for (name, value) in vars
+            ENV[name] = value
+        end
+    end
+    try
+        replaceenv(env)
+        f()
+    finally
+        replaceenv(saved)
+    end
+end
+
+function forward(sock, lock, kind, pipe)
+    while !eof(pipe)
+        send(sock, lock, kind, readavailable(pipe))
+    end
+end
+
+function handle(sock)
+    kind, token = recv(sock)
+    (kind == 't' && token == TOKEN) || return
+    kind, vars = recv(sock)
+    kind == 'v' || return
+    vars = isempty(vars) ? String[] : split(vars, '\0')
+    env = Dict(String(vars[i]) => String(vars[i+1]) for i in 1:2:length(vars)-1)
+    kind, script = recv(sock)
+    kind == 's' || return
+    lock = ReentrantLock()
+    out = Pipe()
+    err = Pipe()
+    Base.link_pipe!(out; reader_supports_async=true, writer_supports_async=true)
+    Base.link_pipe!(err; reader_supports_async=true, writer_supports_async=true)
+    tasks = [
+        @async(forward(sock, lock, 'o', out)),
+        @async(forward(sock, lock, 'e', err)),
+    ]
+    result = ""
+    try
+        withclientenv(env) do
+            redirect_stdout(out) do
+                redirect_stderr(err) do
+                    Logging.with_logger(Logging.ConsoleLogger(stderr)) do
+                        include_string(Module(:JuliaPkgScript), script, "juliapkg")
+                    end
+                end
+            end
+        end
+    catch e
+        result = sprint(showerror, e, catch_backtrace())
+        isempty(result) && (result = "error")
+    finally
+        close(Base.pipe_writer(out))
+        close(Base.pipe_writer(err))
+    end
+    foreach(wait, tasks)
+    send(sock, lock, 'r', result)
+end
+
+const LAST_USED = Ref(time())
+const BUSY = Ref(false)
+Timer(1; interval=1) do timer
+    if !BUSY[] && time() - LAST_USED[] > TIMEOUT
+        close(timer)
+        rm(INFO_FILE; force=true)
+        close(SERVER)
+    end
+end
+while true
+    sock = try
+        Sockets.accept(SERVER)
+    catch
+        break
+    end
+    BUSY[] = true
+    try
+        handle(sock)
+    catch
+    finally
+        close(sock)
+        LAST_USED[] = time()
+        BUSY[] = false
+    end
+end
+rm(INFO_FILE; force=true)
+close(PIDLOCK)
+"""
+
+
+class WorkerUnavailable(Exception):
+    """The Julia worker could not be started or connected to."""
+
+
+def worker_enabled():
+    return get_config_bool("worker")[0]
+
+
+def worker_supported(executable):
+    """Whether the worker can run with this Julia executable."""
+    version = julia_version(executable)
+    return version is not None and version >= WORKER_MIN_JULIA_VERSION
+
+
+def worker_timeout():
+    value, key = get_config("worker_timeout")
+    if value is None:
+        return WORKER_TIMEOUT
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"{key} must be a number of seconds")
+
+
+def _worker_files(executable, project):
+    # the info, pid, lock and log files of the worker for this executable and project,
+    # and the environment variables which Julia only reads when it starts
+    key = json.dumps(
+        [
+            executable,
+            project,
+            julia_fingerprint(executable),
+            [os.environ.get(name) for name in _STARTUP_ENV],
+        ]
+    )
+    key = hashlib.sha256(key.encode("utf8")).hexdigest()[:16]
+    dirname = os.path.join(STATE["prefix"], "workers")
+    return {
+        ext: os.path.join(dirname, f"{key}.{ext}")
+        for ext in ["json", "pid", "lock", "log"]
+    }
+
+
+def _worker_command(executable, project):
+    return [
+        executable,
+        "--project=" + project,
+        "--startup-file=no",
+        "-e",
+        WORKER_SCRIPT,
+    ]
+
+
+def _send(sock, kind, data):
+    data = data.encode("utf8")
+    sock.sendall(_FRAME_HEADER.pack(kind, len(data)) + data)
+
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("lost connection to the Julia worker")
+        buf += chunk
+    return bytes(buf)
+
+
+def _recv(sock):
+    kind, n = _FRAME_HEADER.unpack(_recv_exactly(sock, _FRAME_HEADER.size))
+    return kind, _recv_exactly(sock, n)
+
+
+def _script_env():
+    # the environment to run a script in, as for running Julia directly
+    env = os.environ.copy()
+    if sys.executable:
+        env.setdefault("JULIA_PYTHONCALL_EXE", sys.executable)
+    return "\0".join(x for item in env.items() for x in item)
+
+
+def _connect(files):
+    try:
+        with open(files["json"]) as fp:
+            info = json.load(fp)
+        sock = socket.create_connection(("127.0.0.1", info["port"]), timeout=5)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    sock.settimeout(None)
+    _send(sock, b"t", info["token"])
+    return sock
+
+
+def _detached():
+    # keyword arguments for subprocess.Popen to start a process in the background which
+    # outlives this one
+    if os.name == "nt":
+        return {
+            "creationflags": subprocess.DETACHED_PROCESS
+            | subprocess.CREATE_NEW_PROCESS_GROUP
+        }
+    else:
+        return {"start_new_session": True}
+
+
+def _start_worker(executable, project, files):
+    try:
+        os.remove(files["json"])
+    except FileNotFoundError:
+        pass
+    env = os.environ.copy()
+    env["JULIAPKG_WORKER_TOKEN"] = secrets.token_hex(16)
+    if sys.executable:
+        env.setdefault("JULIA_PYTHONCALL_EXE", sys.executable)
+    with open(files["log"], "wb") as log:
+        proc = subprocess.Popen(
+            _worker_command(executable, project)
+            + [files["json"], files["pid"], str(worker_timeout())],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            env=env,
+            **_detached(),
+        )
+    deadline = time.time() + WORKER_START_TIMEOUT
+    while not os.path.exists(files["json"]):
+        if proc.poll() is not None:
+            raise WorkerUnavailable(f"the worker exited, see {files['log']}")
+        if time.time() > deadline:
+            proc.kill()
+            raise WorkerUnavailable("timed out waiting for the worker to start")
+        time.sleep(0.05)
+
+
+def run_in_worker(script, executable, project):
+    """Run a Julia script (a list of lines) in the worker for this executable and
+    project, starting it if necessary.
+
+    The script runs with the environment of this process, as when running Julia
+    directly.
+
+    Raises WorkerUnavailable if there is no worker and one cannot be started (including
+    if Julia is older than 1.9), or if the connection to it is lost before it replies.
+    Raises an Exception if the script fails.
+    """
+    if not worker_supported(executable):
+        raise WorkerUnavailable(
+            f"the worker requires Julia {WORKER_MIN_JULIA_VERSION} or later"
+        )
+    files = _worker_files(executable, project)
+    os.makedirs(os.path.dirname(files["lock"]), exist_ok=True)
+    with FileLock(files["lock"]):
+        sock = _connect(files)
+        if sock is None:
+            _start_worker(executable, project, files)
+            sock = _connect(files)
+            if sock is None:
+                raise WorkerUnavailable("could not connect to the worker")
+    replied = False
+    with sock:
+        try:
+            _send(sock, b"v", _script_env())
+            _send(sock, b"s", "\n".join(script))
+            while True:
+                kind, data = _recv(sock)
+                replied = True
+                if kind == b"r":
+                    break
+                stream = sys.stderr if kind == b"e" else sys.stdout
+                stream.write(data.decode("utf8", errors="replace"))
+                stream.flush()
+        except OSError as err:
+            if replied:
+                raise
+            # the worker has probably just exited, so the script did not run
+            raise WorkerUnavailable(str(err))
+    if data:
+        raise Exception(
+            "Julia script failed in the worker:\n" + data.decode("utf8", "replace")
+        )
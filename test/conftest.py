@@ -0,0 +1,118 @@
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import uuid as uuid_mod
+
+import pytest
+
+import juliapkg
+from juliapkg.state import STATE
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """Point juliapkg at a fresh project in a temporary directory."""
+    project = str(tmp_path / "project")
+    prefix = os.path.join(project, "pyjuliapkg")
+    monkeypatch.setitem(STATE, "project", project)
+    monkeypatch.setitem(STATE, "project_is_shared", False)
+    monkeypatch.setitem(STATE, "prefix", prefix)
+    monkeypatch.setitem(STATE, "deps", os.path.join(prefix, "juliapkg.json"))
+    monkeypatch.setitem(STATE, "meta", os.path.join(prefix, "meta.json"))
+    monkeypatch.setitem(STATE, "install", os.path.join(prefix, "install"))
+    monkeypatch.setitem(STATE, "lock", os.path.join(project, "lock.pid"))
+    monkeypatch.setitem(STATE, "override_executable", None)
+    monkeypatch.setitem(STATE, "offline", False)
+    monkeypatch.setitem(STATE, "incremental", False)
+    monkeypatch.setitem(STATE, "discovery", "scan")
+    monkeypatch.setitem(STATE, "resolved", False)
+    monkeypatch.setitem(STATE, "executable", None)
+    monkeypatch.setitem(STATE, "version", None)
+    return project
+
+
+@pytest.fixture
+def fake_run(monkeypatch):
+    """Record every subprocess.run call, answering `julia --version` with 1.10.0."""
+    calls = []
+
+    def run(args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, 0, stdout="julia version 1.10.0\n")
+
+    monkeypatch.setattr(subprocess, "run", run)
+    monkeypatch.setattr(juliapkg.deps, "run", run)
+    monkeypatch.setattr(juliapkg.find_julia, "run", run)
+    return calls
+
+
+@pytest.fixture
+def fake_julia(project, fake_run, tmp_path, monkeypatch):
+    """A fake Julia executable to resolve the project with (see `fake_run`), with no
+    deps files other than the project's own."""
+    exe = str(tmp_path / "julia")
+    with open(exe, "w") as fp:
+        fp.write("fake julia")
+    monkeypatch.setitem(STATE, "override_executable", exe)
+    monkeypatch.setattr(sys, "path", [])
+    monkeypatch.setattr(juliapkg.deps, "editable_deps_files", lambda: [])
+    return exe
+
+
+def _write_registry(depot, packages, name="TestRegistry", treehash="0" * 40):
+    """Write a registry tarball to the registries directory in depot.
+
+    packages maps each UUID to a dict with the package "name" and optionally "files",
+    mapping file names like "Versions.toml" to their contents.
+    """
+    regdir = os.path.join(depot, "registries")
+    os.makedirs(regdir, exist_ok=True)
+    files = {"Registry.toml": "[packages]\n"}
+    for uuid, pkg in packages.items():
+        path = f"{pkg['name'][0]}/{pkg['name']}"
+        files["Registry.toml"] += (
+            f'{uuid} = {{ name = "{pkg["name"]}", path = "{path}" }}\n'
+        )
+        for fn, content in pkg.get("files", {}).items():
+            files[f"{path}/{fn}"] = content
+    with tarfile.open(os.path.join(regdir, f"{name}.tar.gz"), "w:gz") as tf:
+        for fn, content in files.items():
+            data = content.encode("utf8")
+            info = tarfile.TarInfo(fn)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    with open(os.path.join(regdir, f"{name}.toml"), "w") as fp:
+        fp.write(
+            f'git-tree-sha1 = "{treehash}"\n'
+            f'uuid = "{uuid_mod.uuid4()}"\n'
+            f'path = "{name}.tar.gz"\n'
+        )
+
+
+@pytest.fixture
+def depot(tmp_path, monkeypatch):
+    """An empty Julia depot, which is the only place registries are looked for."""
+    depot = tmp_path / "depot"
+    depot.mkdir()
+    home = tmp_path / "home"
+    home.mkdir()
+    monkeypatch.setenv("JULIA_DEPOT_PATH", str(depot))
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.setenv("USERPROFILE", str(home))
+    monkeypatch.setattr(juliapkg.registry, "_REGISTRY_INDEX_CACHE", {})
+    monkeypatch.setattr(juliapkg.registry, "_NAME_INDEX_CACHE", {})
+    monkeypatch.setattr(juliapkg.registry, "_VERSIONS_CACHE", {})
+    return str(depot)
+
+
+@pytest.fixture
+def write_registry(depot):
+    """A function writing a registry to the depot (see `_write_registry`)."""
+
+    def write_registry(packages, **kwargs):
+        _write_registry(depot, packages, **kwargs)
+        return os.path.join(depot, "registries", kwargs.get("name", "TestRegistry"))
+
+    return write_registry
@@ -57,6 +57,11 @@ class TestCLI:
         result = runner.invoke(cli, ["resolve", "--force"])
         assert result.exit_code == 0
 
+    def test_add_many_with_options(self, runner):
+        result = runner.invoke(cli, ["add", "Foo", "Bar", "--version", "1"])
+        assert result.exit_code != 0
+        assert "can only be used when adding a single package" in result.output
+
     def test_click_not_available(self):
         with patch.dict(sys.modules, {"click": None, "juliapkg.cli": None}):
             del sys.modules["juliapkg.cli"]
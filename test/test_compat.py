@@ -1,6 +1,9 @@
+import copy
+import pickle
+
 import pytest
 
-from juliapkg.compat import Compat, Range, Version
+from juliapkg.compat import Compat, Range, Version, conflict_set, pack_versions
 
 v = Version.parse
 
@@ -157,6 +160,54 @@ class TestRange:
         output = range1 & range2
         assert output == expected_output
 
+    def test_value(self):
+        r = Range(v("1.0.0"), v("2.0.0"))
+        assert hash(r) == hash(Range.parse("1"))
+        assert {r, Range.parse("^1"), Range.parse("1.0.0 - 1")} == {r}
+        # all empty ranges are equal
+        assert hash(Range(v("2.0.0"), v("1.0.0"))) == hash(
+            Range(v("0.0.0"), v("0.0.0"))
+        )
+        with pytest.raises(AttributeError):
+            r.lo = v("0.0.0")
+        assert not hasattr(r, "__dict__")
+        # the bounds are Versions, though stored internally as tuples
+        assert type(r.lo) is Version and r.lo == v("1.0.0")
+        assert r._lo == (1, 0, 0)
+        assert (1, 5, 0) in r
+        # versions may also be given as strings or dicts, as semver allows
+        assert "1.2.3" in r
+        assert "2.0.0" not in r
+        assert {"major": 1, "minor": 5, "patch": 0} in r
+        assert Range("1.0.0", "2.0.0") == r
+
+    @pytest.mark.parametrize(
+        "range", [Range.parse("1.2"), Range(v("1.0.0-rc1"), v("2.0.0"))]
+    )
+    def test_copy(self, range):
+        assert copy.copy(range) == range
+        assert copy.deepcopy(range) == range
+        r = pickle.loads(pickle.dumps(range))
+        assert r == range
+        assert r._lo == range._lo and r._hi == range._hi
+
+    def test_prerelease(self):
+        # prerelease bounds and versions are compared as semver does
+        r = Range(v("1.0.0-rc1"), v("2.0.0-rc1"))
+        assert r.lo == v("1.0.0-rc1")
+        assert v("1.0.0-beta") not in r
+        assert v("1.0.0-rc1") in r
+        assert v("1.0.0") in r
+        assert v("1.9.9") in r
+        assert v("2.0.0-alpha") in r
+        assert v("2.0.0-rc1") not in r
+        assert v("2.0.0") not in r
+        assert r & Range.parse("1") == Range(v("1.0.0"), v("2.0.0-rc1"))
+        c = Compat([r, Range.parse("3")])
+        assert v("1.0.0-rc2") in c
+        mask = c.mask([(0, 9, 0), (1, 0, 0), (2, 0, 0), (3, 1, 0)])
+        assert mask == [False, True, False, True]
+
 
 class TestCompat:
     @pytest.mark.parametrize(
@@ -268,3 +319,162 @@ class TestCompat:
     def test_and(self, compat1, compat2, expected_output):
         output = compat1 & compat2
         assert output == expected_output
+
+    @pytest.mark.parametrize(
+        "input, expected_output",
+        [
+            # overlapping and adjacent clauses are merged, and clauses are sorted
+            ("1, 1.2", "^1"),
+            ("1, 2", "1.0.0 - 2"),
+            ("2, 0.7, 1", "^0.7, 1.0.0 - 2"),
+            ("=1.2.3, 1.2.4 - 1.2.5", "1.2.3 - 1.2.5"),
+            ("0.2 - 1, 0.5 - 0.6", "0.2.0 - 1"),
+        ],
+    )
+    def test_canonical(self, input, expected_output):
+        output = Compat.parse(input)
+        assert str(output) == expected_output
+        assert output == Compat.parse(expected_output)
+        assert all(
+            clause1.hi < clause2.lo
+            for clause1, clause2 in zip(output.clauses, output.clauses[1:])
+        )
+
+    @pytest.mark.parametrize(
+        "compat1, compat2, expected_output",
+        [
+            ("1", "2", "1.0.0 - 2"),
+            ("0.7, 2", "1", "^0.7, 1.0.0 - 2"),
+            ("0.7, 2", "", "^0.7, ^2"),
+            ("1.2 - 1.4, ~1.8", "1.3 - 1.6", "1.2.0 - 1.6, ~1.8"),
+        ],
+    )
+    def test_or(self, compat1, compat2, expected_output):
+        output = Compat.parse(compat1) | Compat.parse(compat2)
+        assert output == Compat.parse(expected_output)
+        assert Compat.parse(compat2) | Compat.parse(compat1) == output
+
+    def test_contains_bisect(self):
+        c = Compat.parse("0.7, 1.2 - 1.4, =2.0.1")
+        for ver, expected in [
+            ("0.6.9", False),
+            ("0.7.0", True),
+            ("0.7.5", True),
+            ("0.8.0", False),
+            ("1.1.9", False),
+            ("1.2.0", True),
+            ("1.4.9", True),
+            ("1.5.0", False),
+            ("2.0.0", False),
+            ("2.0.1", True),
+            ("2.0.2", False),
+        ]:
+            assert (v(ver) in c) == expected
+        assert v("1.0.0") not in Compat()
+
+    def test_value(self):
+        c = Compat.parse("1, 2.3")
+        assert c == Compat([Range.parse("1"), Range.parse("2.3")])
+        assert hash(c) == hash(Compat([Range.parse("1"), Range.parse("2.3")]))
+        assert {c: 1}[Compat.parse("^1, ^2.3")] == 1
+        assert c != "1, 2.3"
+        with pytest.raises(AttributeError):
+            c.clauses = ()
+        assert not hasattr(c, "__dict__")
+        # parsing is cached, which is safe because they are immutable
+        assert Compat.parse("1, 2.3") is c
+        assert Version.parse("1.2.3") is Version.parse("1.2.3")
+        assert type(Version.parse("1.2.3").bump_minor()) is Version
+        assert "1.2.3" in Compat.parse("1")
+        assert "1.2.3-rc1" not in Compat.parse("1.2.3")
+        assert {"major": 2, "minor": 3, "patch": 1} in c
+
+    def test_copy(self):
+        c = Compat.parse("0.7, 1.2 - 1.4, =2.0.1")
+        assert copy.copy(c) == c
+        assert copy.deepcopy(c) == c
+        assert copy.deepcopy({"Foo": c}) == {"Foo": c}
+        c2 = pickle.loads(pickle.dumps(c))
+        assert c2 == c
+        assert c2._los == c._los
+        assert v("1.3.0") in c2
+
+    def test_mask(self):
+        c = Compat.parse("0.7, 1.2 - 1.4, =2.0.1")
+        vers = ["0.6.9", "0.7.5", "1.1.0", "1.4.9", "1.5.0", "2.0.1", "1.2.0"]
+        packed = pack_versions(map(v, vers))
+        assert list(packed[:6]) == [0, 6, 9, 0, 7, 5]
+        expected = [False, True, False, True, False, True, True]
+        assert c.mask(packed) == expected
+        assert c.mask([tuple(map(int, ver.split("."))) for ver in vers]) == expected
+        assert c.filter(packed) == [1, 3, 5, 6]
+        assert c.max_satisfying(packed) == 5
+        assert Compat.parse("3").max_satisfying(packed) is None
+        assert c.mask(pack_versions([])) == []
+        with pytest.raises(ValueError):
+            c.mask([1, 2, 3, 4])
+
+    def test_bounds(self):
+        c = Compat.parse("0.7, 1.2 - 1.4, =2.0.1")
+        assert c.bounds() == [
+            (v("0.7.0"), v("0.8.0")),
+            (v("1.2.0"), v("1.5.0")),
+            (v("2.0.1"), v("2.0.2")),
+        ]
+        assert all(type(lo) is Version for (lo, _) in c.bounds())
+        assert Compat().bounds() == []
+
+    def test_mask_numpy(self):
+        np = pytest.importorskip("numpy")
+        c = Compat.parse("1.2 - 1.4")
+        packed = np.array([[1, 1, 0], [1, 3, 2], [1, 5, 0]])
+        assert c.mask(packed) == [False, True, False]
+        assert c.filter(packed.ravel()) == [1]
+
+
+@pytest.mark.parametrize(
+    "compats, expected_output",
+    [
+        ({}, None),
+        ({"a": "1", "b": "1.2", "c": "~1.2.3"}, None),
+        # single ranges: the highest lower bound and lowest upper bound
+        ({"a": "1", "b": "1.2", "c": "~1.5", "d": "1.0 - 1.3"}, ["c", "d"]),
+        ({"a": "1", "b": "2"}, ["a", "b"]),
+        # an empty compat conflicts on its own
+        ({"a": "1", "b": ""}, ["b"]),
+        # multiple ranges
+        ({"a": "1, 3", "b": "2", "c": "1.5 - 2"}, ["a", "b"]),
+        ({"a": "1, 3", "b": "1.5 - 3", "c": "2 - 4"}, None),
+        ({"a": "1, 3", "b": "2, 3", "c": "1, 2"}, ["a", "b", "c"]),
+        # a conflicting pair is found before a larger conflict
+        ({"a": "1, 3", "b": "2, 3", "c": "1, 2", "d": "1.5"}, ["b", "d"]),
+        ({"a": "1, 3", "b": "2, 3", "c": "1, 2", "d": "0.1"}, ["a", "d"]),
+        ({"x": "0.1", "a": "1, 3", "b": "2, 3", "c": "1, 2"}, ["x", "a"]),
+    ],
+)
+def test_conflict_set(compats, expected_output):
+    compats = {k: Compat.parse(v) for (k, v) in compats.items()}
+    output = conflict_set(compats)
+    assert output == expected_output
+    if output is not None:
+        # a minimal conflict: no version in common, but any fewer have one
+        def common(keys):
+            ans = Compat.parse("0 - 1000")
+            for key in keys:
+                ans &= compats[key]
+            return ans
+
+        assert not common(output)
+        for key in output:
+            assert common([k for k in output if k != key])
+
+
+def test_conflict_set_large():
+    # too many compats to look for a pair, so the conflict is only minimal
+    compats = {f"x{i}": Compat.parse("0 - 10") for i in range(40)}
+    for key, value in [("a", "1, 3"), ("b", "2, 3"), ("c", "1, 2"), ("d", "1.5")]:
+        compats[key] = Compat.parse(value)
+    assert conflict_set(compats) == ["a", "b", "c"]
+    # with fewer, the pair is found
+    compats = dict(list(compats.items())[-32:])
+    assert conflict_set(compats) == ["b", "d"]
@@ -0,0 +1,313 @@
+import hashlib
+import http.server
+import io
+import json
+import os
+import shutil
+import tarfile
+import threading
+
+import pytest
+
+import juliapkg
+from juliapkg.compat import Compat
+from juliapkg.install_julia import (
+    _julia_versions_cache_files,
+    all_julia_versions,
+    best_julia_version,
+    compatible_julia_versions,
+    get_platform,
+    install_julia,
+    install_julia_tar_gz,
+)
+from juliapkg.state import STATE
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves server.files, with range requests if server.ranges is set.
+
+    Requests are recorded in server.requests as (path, range) and any path or range in
+    server.fail gets a 500 response.
+    """
+
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path)
+        rng = self.headers.get("Range")
+        server.requests.append((self.path, rng))
+        if data is None:
+            self.send_error(404)
+            return
+        if rng in server.fail or self.path in server.fail:
+            self.send_error(500)
+            return
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if rng is not None and server.ranges:
+            start, stop = rng.removeprefix("bytes=").split("-")
+            start, stop = int(start), min(int(stop) + 1, len(data))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{stop - 1}/{len(data)}")
+            data = data[start:stop]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(project, monkeypatch):
+    """A local stand-in for the Julia download server, offering Julia 1.2.3."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    # a fake Julia, with random contents so it does not compress
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode="w:gz") as tf:
+        server.julia = os.urandom(5000)
+        info = tarfile.TarInfo("julia-1.2.3/bin/julia")
+        info.size = len(server.julia)
+        tf.addfile(info, io.BytesIO(server.julia))
+    tarball = tarball.getvalue()
+    os_, arch, libc = get_platform()
+
+    def release(version, stable=True, os=os_):
+        return {
+            "stable": stable,
+            "files": [
+                {
+                    "url": f"{url}/julia-{version}.tar.gz",
+                    "version": version,
+                    "os": os,
+                    "arch": arch,
+                    "triplet": f"{arch}-{os}-{libc}",
+                    "sha256": hashlib.sha256(tarball).hexdigest(),
+                    "size": len(tarball),
+                    "kind": "archive",
+                }
+            ],
+        }
+
+    versions = {
+        "1.0.0": release("1.0.0", os="other"),
+        "1.1.0": release("1.1.0"),
+        "1.2.0": release("1.2.0"),
+        "1.2.3": release("1.2.3"),
+        "1.3.0-rc1": release("1.3.0-rc1", stable=False),
+    }
+    server.files = {
+        "/versions.json": json.dumps(versions).encode("utf8"),
+        "/julia-1.2.3.tar.gz": tarball,
+    }
+    server.requests = []
+    server.ranges = True
+    server.fail = set()
+    monkeypatch.setattr(juliapkg.install_julia, "_all_julia_versions", None)
+    monkeypatch.setattr(juliapkg.install_julia, "_julia_versions_index", None)
+    monkeypatch.setattr(
+        juliapkg.install_julia, "_julia_versions_url", f"{url}/versions.json"
+    )
+    monkeypatch.setattr(juliapkg.install_julia, "DOWNLOAD_CHUNK_SIZE", 1000)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def tarball_requests(server):
+    return [rng for (path, rng) in server.requests if path.endswith(".tar.gz")]
+
+
+def test_install_julia_ranged(server, tmp_path):
+    assert "1.2.3" in all_julia_versions()
+    ver, info = best_julia_version()
+    assert ver == "1.2.3"
+    prefix = str(tmp_path / "install")
+    install_julia(info, prefix)
+    with open(os.path.join(prefix, "bin", "julia"), "rb") as fp:
+        assert fp.read() == server.julia
+    rngs = tarball_requests(server)
+    assert len(rngs) == -(-len(server.files["/julia-1.2.3.tar.gz"]) // 1000)
+    assert all(rng is not None for rng in rngs)
+    # the staging and download directories are cleaned up
+    assert sorted(os.listdir(tmp_path)) == ["install", "project"]
+
+
+def test_install_julia_resume(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(juliapkg.install_julia, "DOWNLOAD_RETRIES", 1)
+    _, info = best_julia_version()
+    prefix = str(tmp_path / "install")
+
+    # the download is interrupted
+    server.fail.add("bytes=2000-2999")
+    with pytest.raises(Exception):
+        install_julia(info, prefix)
+    assert not os.path.exists(prefix)
+    nchunks = -(-len(server.files["/julia-1.2.3.tar.gz"]) // 1000)
+    assert len(tarball_requests(server)) == nchunks
+
+    # it is resumed, only downloading the missing chunk
+    server.fail.clear()
+    server.requests.clear()
+    install_julia(info, prefix)
+    with open(os.path.join(prefix, "bin", "julia"), "rb") as fp:
+        assert fp.read() == server.julia
+    assert tarball_requests(server) == ["bytes=2000-2999"]
+
+
+def test_install_julia_replace(server, tmp_path, monkeypatch):
+    _, info = best_julia_version()
+    prefix = str(tmp_path / "install")
+    os.makedirs(os.path.join(prefix, "bin"))
+    with open(os.path.join(prefix, "bin", "julia"), "w") as fp:
+        fp.write("old julia")
+
+    # if the new installation cannot be moved into place, the old one is kept
+    rename = os.rename
+
+    def fail_rename(src, dst):
+        if os.path.basename(src) == "julia":
+            raise PermissionError("cannot rename")
+        rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", fail_rename)
+    with pytest.raises(PermissionError):
+        install_julia(info, prefix)
+    with open(os.path.join(prefix, "bin", "julia")) as fp:
+        assert fp.read() == "old julia"
+    assert sorted(os.listdir(tmp_path)) == ["install", "project"]
+
+    # otherwise it is replaced
+    monkeypatch.setattr(os, "rename", rename)
+    install_julia(info, prefix)
+    with open(os.path.join(prefix, "bin", "julia"), "rb") as fp:
+        assert fp.read() == server.julia
+    assert sorted(os.listdir(tmp_path)) == ["install", "project"]
+
+
+def make_tarball(members):
+    # members are (name, type, linkname)
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode="w:gz") as tf:
+        for name, type, linkname in members:
+            info = tarfile.TarInfo(name)
+            info.type = type
+            info.linkname = linkname
+            tf.addfile(info, io.BytesIO(b""))
+    tarball.seek(0)
+    return tarball
+
+
+@pytest.mark.parametrize("data_filter", [True, False])
+@pytest.mark.parametrize(
+    "member",
+    [
+        ("julia-1.2.3/../../evil", tarfile.REGTYPE, ""),
+        ("{tmp_path}/evil", tarfile.REGTYPE, ""),
+        ("julia-1.2.3/evil", tarfile.SYMTYPE, "../../.."),
+        ("julia-1.2.3/evil", tarfile.SYMTYPE, "/etc"),
+        ("julia-1.2.3/evil", tarfile.LNKTYPE, "../outside"),
+    ],
+)
+def test_install_julia_tar_gz_unsafe(tmp_path, monkeypatch, data_filter, member):
+    # the archive may be extracted while downloading, before its hash is checked, so
+    # nothing may be written outside the staging directory
+    if not data_filter:
+        monkeypatch.delattr(tarfile, "data_filter", raising=False)
+    (tmp_path / "staging").mkdir()
+    dest = str(tmp_path / "staging" / "julia")
+    safe = [
+        ("julia-1.2.3/bin/julia", tarfile.REGTYPE, ""),
+        ("julia-1.2.3/lib/libjulia.so", tarfile.SYMTYPE, "libjulia.so.1"),
+    ]
+    name, type, linkname = member
+    member = (name.format(tmp_path=tmp_path), type, linkname)
+    try:
+        install_julia_tar_gz({}, make_tarball([*safe, member]), dest)
+    except Exception:
+        pass
+    else:
+        # the data filter makes absolute names relative instead
+        assert data_filter and os.path.isabs(member[0])
+        shutil.rmtree(dest)
+    assert os.listdir(tmp_path) == ["staging"]
+    assert os.listdir(tmp_path / "staging") == []
+    # but links within the directory are allowed
+    install_julia_tar_gz({}, make_tarball(safe), dest)
+    assert os.path.islink(os.path.join(dest, "lib", "libjulia.so"))
+
+
+def test_install_julia_no_ranges(server, tmp_path):
+    server.ranges = False
+    _, info = best_julia_version()
+    prefix = str(tmp_path / "install")
+    install_julia(info, prefix)
+    with open(os.path.join(prefix, "bin", "julia"), "rb") as fp:
+        assert fp.read() == server.julia
+    # the range request was refused so it is streamed instead
+    assert tarball_requests(server) == ["bytes=0-999", None]
+
+
+def test_all_julia_versions_cache(server, monkeypatch):
+    def versions_requests():
+        return [
+            (path, rng) for (path, rng) in server.requests if path == "/versions.json"
+        ]
+
+    def fresh_versions():
+        monkeypatch.setattr(juliapkg.install_julia, "_all_julia_versions", None)
+        return all_julia_versions()
+
+    # downloaded and cached on disk
+    versions = fresh_versions()
+    assert "1.2.3" in versions
+    assert len(versions_requests()) == 1
+    assert all(os.path.exists(fn) for fn in _julia_versions_cache_files())
+
+    # fresh, so not downloaded again
+    assert fresh_versions() == versions
+    assert len(versions_requests()) == 1
+
+    # stale, so revalidated with the server (which says it is not modified)
+    monkeypatch.setenv("PYTHON_JULIAPKG_VERSIONS_TTL", "0")
+    assert fresh_versions() == versions
+    assert len(versions_requests()) == 2
+
+    # stale and the server is down, so the cached copy is used
+    server.fail.add("/versions.json")
+    assert fresh_versions() == versions
+    assert len(versions_requests()) == 3
+
+
+def test_compatible_julia_versions(server, monkeypatch):
+    def compatible(compat):
+        return sorted(compatible_julia_versions(Compat.parse(compat)))
+
+    assert sorted(compatible_julia_versions()) == ["1.1.0", "1.2.0", "1.2.3"]
+    assert compatible("1") == ["1.1.0", "1.2.0", "1.2.3"]
+    assert compatible("~1.1, =1.2.3") == ["1.1.0", "1.2.3"]
+    assert compatible("1.2.1 - 1.2.2") == []
+    assert compatible("1.3") == []
+    assert os.path.exists(os.path.join(STATE["prefix"], "versions.index.json"))
+
+    # the index is loaded from disk in a new process
+    def build(*args):
+        raise AssertionError("index should not be rebuilt")
+
+    # and versions are found by binary search, not by testing each one
+    def mask(*args):
+        raise AssertionError("versions should not be tested one by one")
+
+    monkeypatch.setattr(juliapkg.install_julia, "_build_julia_versions_index", build)
+    monkeypatch.setattr(juliapkg.install_julia, "_all_julia_versions", None)
+    monkeypatch.setattr(juliapkg.install_julia, "_julia_versions_index", None)
+    monkeypatch.setattr(Compat, "mask", mask)
+    assert compatible("~1.1, =1.2.3") == ["1.1.0", "1.2.3"]
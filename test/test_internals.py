@@ -1,7 +1,41 @@
+import importlib.metadata
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+
 import pytest
+import semver
 
 import juliapkg
-from juliapkg.deps import PkgSpec
+from juliapkg.deps import META_VERSION, PkgSpec, deps_files, save_meta
+from juliapkg.find_julia import julia_fingerprint, julia_version
+from juliapkg.state import STATE
+
+
+def write_resolved_meta(exe, version="1.10.0"):
+    """Write a meta file as if the project was resolved with the given Julia."""
+    save_meta(
+        {
+            "meta_version": META_VERSION,
+            "dev": STATE["dev"],
+            "version": version,
+            "executable": exe,
+            "executable_fingerprint": julia_fingerprint(exe),
+            "deps_files": {
+                fn: {
+                    "timestamp": os.path.getmtime(fn),
+                    "hash_sha256": juliapkg.deps._get_hash(fn),
+                }
+                for fn in deps_files()
+            },
+            "pkgs": [],
+            "offline": False,
+            "override_executable": STATE["override_executable"],
+        }
+    )
 
 
 def test_openssl_compat():
@@ -83,6 +117,11 @@ def test_pkgspec_validation():
     with pytest.raises(TypeError, match="package dev must be a 'bool'"):
         PkgSpec(name="Example", uuid=spec.uuid, dev="not-a-boolean")
 
+    # Test a plain semver.Version, not only juliapkg's cached subclass
+    spec = PkgSpec(name="Example", uuid=spec.uuid, version=semver.Version(1, 2, 3))
+    assert spec.version == semver.Version(1, 2, 3)
+    assert spec.dict()["version"] == "1.2.3"
+
     # Test invalid version type
     with pytest.raises(
         TypeError, match="package version must be a 'str', 'Version', or 'None'"
@@ -104,3 +143,786 @@ def test_pkgspec_validation():
     # Test invalid rev type
     with pytest.raises(TypeError, match="package rev must be a 'str' or 'None'"):
         PkgSpec(name="Example", uuid=spec.uuid, rev=123)
+
+
+def test_add_semver_version(project):
+    uuid = "123e4567-e89b-12d3-a456-426614174000"
+    juliapkg.add("Example", uuid=uuid, version=semver.Version(1, 2, 3))
+    assert juliapkg.deps.load_cur_deps() == {
+        "packages": {"Example": {"uuid": uuid, "version": "1.2.3"}}
+    }
+
+
+def test_resolve_warm_no_subprocess(fake_julia, fake_run):
+    exe = fake_julia
+    write_resolved_meta(exe)
+
+    # a warm resolve does not run Julia at all
+    assert juliapkg.resolve() is True
+    assert fake_run == []
+    assert STATE["executable"] == exe
+    assert str(STATE["version"]) == "1.10.0"
+
+    # if the executable changes, its version is checked once and then remembered
+    with open(exe, "w") as fp:
+        fp.write("another fake julia")
+    STATE["resolved"] = False
+    assert juliapkg.resolve() is True
+    assert fake_run == [[exe, "--version"]]
+    STATE["resolved"] = False
+    assert juliapkg.resolve() is True
+    assert len(fake_run) == 1
+
+
+def test_julia_version_cache(project, fake_run, tmp_path, monkeypatch):
+    monkeypatch.setattr(juliapkg.find_julia, "JULIA_VERSION_CACHE_SIZE", 2)
+    exes = []
+    for i in range(3):
+        exe = str(tmp_path / f"julia{i}")
+        with open(exe, "w") as fp:
+            fp.write("fake julia " * (i + 1))
+        exes.append(exe)
+
+    # Julia is only run the first time each executable is seen
+    assert str(julia_version(exes[0])) == "1.10.0"
+    assert str(julia_version(exes[0])) == "1.10.0"
+    assert str(julia_version(exes[1])) == "1.10.0"
+    assert len(fake_run) == 2
+
+    # using exes[0] makes exes[1] the least recently used, so it gets evicted
+    assert str(julia_version(exes[0])) == "1.10.0"
+    assert str(julia_version(exes[2])) == "1.10.0"
+    assert len(fake_run) == 3
+    assert str(julia_version(exes[0])) == "1.10.0"
+    assert len(fake_run) == 3
+    assert str(julia_version(exes[1])) == "1.10.0"
+    assert fake_run[-1] == [exes[1], "--version"]
+    assert len(juliapkg.find_julia._load_julia_version_cache()) == 2
+
+
+@pytest.mark.skipif(os.name == "nt", reason="executables need an extension on Windows")
+def test_julia_fingerprint(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    exe = bindir / "julia"
+    exe.write_text("fake julia")
+    exe.chmod(0o755)
+    # a bare name is found in PATH, not in the current directory
+    (tmp_path / "julia").mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PATH", str(bindir))
+    assert julia_fingerprint("julia")["realpath"] == os.path.realpath(exe)
+    assert julia_fingerprint("julia") == julia_fingerprint(str(exe))
+    monkeypatch.setenv("PATH", "")
+    assert julia_fingerprint("julia") is None
+    # only regular files are fingerprinted
+    assert julia_fingerprint(str(tmp_path / "julia")) is None
+    assert julia_fingerprint(str(tmp_path / "missing")) is None
+
+
+def test_deps_files_index(project, tmp_path, monkeypatch):
+    site = tmp_path / "site"
+    (site / "pkga").mkdir(parents=True)
+    (site / "pkga" / "juliapkg.json").write_text("{}")
+    (site / "pkgb").mkdir()
+    monkeypatch.setattr(sys, "path", [str(site)])
+    stats = juliapkg.deps.DEPS_INDEX_STATS
+
+    def deps_files_and_stats(mtime):
+        os.utime(site, (mtime, mtime))
+        before = dict(stats)
+        files = sorted(
+            os.path.basename(os.path.dirname(fn))
+            for fn in deps_files()
+            if fn.startswith(os.path.normcase(str(site)))
+        )
+        return files, {k: stats[k] - before[k] for k in stats}
+
+    # first time the directory is listed, the second time it comes from the index
+    assert deps_files_and_stats(1000) == (["pkga"], {"rescanned": 1, "indexed": 0})
+    assert deps_files_and_stats(1000) == (["pkga"], {"rescanned": 0, "indexed": 1})
+    with open(juliapkg.deps._deps_index_file()) as fp:
+        assert str(site) in json.load(fp)["dirs"]
+
+    # installing a package changes the mtime so the directory is listed again
+    (site / "pkgc").mkdir()
+    (site / "pkgc" / "juliapkg.json").write_text("{}")
+    assert deps_files_and_stats(2000) == (
+        ["pkga", "pkgc"],
+        {"rescanned": 1, "indexed": 0},
+    )
+    assert deps_files_and_stats(2000) == (
+        ["pkga", "pkgc"],
+        {"rescanned": 0, "indexed": 1},
+    )
+
+    # deleted deps files are never returned, even from the index
+    os.remove(site / "pkga" / "juliapkg.json")
+    assert deps_files_and_stats(2000) == (["pkgc"], {"rescanned": 0, "indexed": 1})
+
+    # a deps file added to an existing package directory does not change the mtime of
+    # the directory, but is still found
+    (site / "pkgb" / "juliapkg.json").write_text("{}")
+    assert deps_files_and_stats(2000) == (
+        ["pkgb", "pkgc"],
+        {"rescanned": 0, "indexed": 1},
+    )
+
+
+def test_deps_files_metadata(project, tmp_path, monkeypatch):
+    site = tmp_path / "site"
+
+    def install(name, version):
+        (site / name).mkdir(parents=True)
+        (site / name / "juliapkg.json").write_text("{}")
+        info = site / f"{name}-{version}.dist-info"
+        info.mkdir()
+        (info / "METADATA").write_text(f"Name: {name}\nVersion: {version}\n")
+        (info / "RECORD").write_text(
+            f"{name}/juliapkg.json,,\n{info.name}/METADATA,,\n{info.name}/RECORD,,\n"
+        )
+
+    def found(files):
+        root = os.path.normcase(str(site))
+        return sorted(
+            os.path.basename(os.path.dirname(fn)) for fn in files if fn.startswith(root)
+        )
+
+    install("foo", "1.0")
+    # a deps file not in any RECORD is not found in this mode
+    (site / "bar").mkdir()
+    (site / "bar" / "juliapkg.json").write_text("{}")
+    monkeypatch.setattr(sys, "path", [str(site)])
+    monkeypatch.setitem(STATE, "discovery", "metadata")
+
+    dists = juliapkg.deps.distributions_info()
+    assert found(dists["files"]) == ["foo"]
+    assert found(deps_files(dists=dists)) == ["foo"]
+    # nothing in sys.path changed so the distributions are not looked at again
+    assert juliapkg.deps.distributions_info(dists) is dists
+
+    install("baz", "2.0")
+    os.utime(site, (1000, 1000))
+    dists2 = juliapkg.deps.distributions_info(dists)
+    assert dists2["fingerprint"] != dists["fingerprint"]
+    assert found(deps_files(dists=dists2)) == ["baz", "foo"]
+
+    # a directory changed but no distribution did, so the files are reused without
+    # locating them again
+    (site / "scratch").mkdir()
+    os.utime(site, (2000, 2000))
+
+    def locate_file(self, path):
+        raise AssertionError("RECORD searched again")
+
+    monkeypatch.setattr(importlib.metadata.PathDistribution, "locate_file", locate_file)
+    dists3 = juliapkg.deps.distributions_info(dists2)
+    assert dists3 is not dists2
+    assert dists3["paths"] != dists2["paths"]
+    assert dists3["fingerprint"] == dists2["fingerprint"]
+    assert dists3["files"] == dists2["files"]
+
+
+def test_find_uuid(project, write_registry, monkeypatch):
+    uuid1 = "00000000-0000-0000-0000-000000000001"
+    uuid2 = "00000000-0000-0000-0000-000000000002"
+    uuid3 = "00000000-0000-0000-0000-000000000003"
+    regpath = write_registry(
+        {uuid1: {"name": "Foo"}, uuid2: {"name": "Bar"}, uuid3: {"name": "Foo"}},
+        treehash="1" * 40,
+    )
+    regpath += ".tar.gz"
+    find_uuid = juliapkg.registry._find_uuid
+    assert find_uuid("Foo") == {uuid1: [regpath], uuid3: [regpath]}
+    assert find_uuid("Bar") == {uuid2: [regpath]}
+    assert find_uuid("Baz") == {}
+    assert os.path.exists(
+        os.path.join(STATE["prefix"], "registries", "1" * 40 + ".idx")
+    )
+
+    # a new process uses the index on disk without parsing the registry
+    def load_registry_index(reg):
+        raise AssertionError("registry should not be parsed")
+
+    monkeypatch.setattr(juliapkg.registry, "_NAME_INDEX_CACHE", {})
+    monkeypatch.setattr(juliapkg.registry, "_load_registry_index", load_registry_index)
+    assert find_uuid("Bar") == {uuid2: [regpath]}
+
+
+def test_find_uuid_read_only(project, write_registry, monkeypatch):
+    uuid1 = "00000000-0000-0000-0000-000000000001"
+    write_registry({uuid1: {"name": "Foo"}})
+
+    # if the index cannot be saved, it is only kept in memory
+    def write_atomic(fn, data):
+        raise PermissionError(fn)
+
+    monkeypatch.setattr(juliapkg.registry, "write_atomic", write_atomic)
+    assert list(juliapkg.registry._find_uuid("Foo")) == [uuid1]
+    assert list(juliapkg.registry._find_uuid("Bar")) == []
+    assert not os.path.exists(os.path.join(STATE["prefix"], "registries"))
+
+
+def test_prune_registry_files(project, write_registry, monkeypatch):
+    uuid1 = "00000000-0000-0000-0000-000000000001"
+    files = {"Versions.toml": '["1.0.0"]\n'}
+    write_registry({uuid1: {"name": "Foo", "files": files}}, treehash="1" * 40)
+    find_uuid = juliapkg.registry._find_uuid
+    find_package_versions = juliapkg.registry._find_package_versions
+    assert list(find_uuid("Foo")) == [uuid1]
+    assert list(find_package_versions([uuid1])) == [uuid1]
+    regdir = os.path.join(STATE["prefix"], "registries")
+    with open(os.path.join(regdir, "other.txt"), "w"):
+        pass
+    assert sorted(os.listdir(regdir)) == [
+        "1" * 40 + ".idx",
+        "1" * 40 + ".versions.json",
+        "other.txt",
+    ]
+    # the registry is updated, so the files of the old one are removed once the new
+    # ones are written
+    write_registry({uuid1: {"name": "Foo", "files": files}}, treehash="2" * 40)
+    assert list(find_uuid("Foo")) == [uuid1]
+    assert sorted(os.listdir(regdir)) == ["2" * 40 + ".idx", "other.txt"]
+    assert list(find_package_versions([uuid1])) == [uuid1]
+    assert sorted(os.listdir(regdir)) == [
+        "2" * 40 + ".idx",
+        "2" * 40 + ".versions.json",
+        "other.txt",
+    ]
+
+
+def test_add_many(project, write_registry, monkeypatch):
+    uuid1 = "00000000-0000-0000-0000-000000000001"
+    uuid2 = "00000000-0000-0000-0000-000000000002"
+    write_registry({uuid1: {"name": "Foo"}, uuid2: {"name": "Bar"}})
+    find_registries = juliapkg.registry._find_registries
+    calls = []
+
+    def counting_find_registries():
+        calls.append(None)
+        return find_registries()
+
+    monkeypatch.setattr(juliapkg.registry, "_find_registries", counting_find_registries)
+    juliapkg.add(["Foo", "Bar"])
+    assert juliapkg.deps.load_cur_deps() == {
+        "packages": {"Foo": {"uuid": uuid1}, "Bar": {"uuid": uuid2}}
+    }
+    # the registries are only looked at once
+    assert len(calls) == 1
+    with pytest.raises(TypeError, match="Could not find package 'Baz'"):
+        juliapkg.add(["Foo", "Baz"])
+
+
+def test_registered_versions(fake_julia, write_registry, monkeypatch, capsys):
+    uuid1 = "00000000-0000-0000-0000-000000000001"
+    uuid2 = "00000000-0000-0000-0000-000000000002"
+    versions = """
+        ["0.1.0"]
+        ["0.2.0"]
+        ["1.0.0"]
+        ["1.1.0"]
+        ["1.2.0"]
+        yanked = true
+    """
+    write_registry(
+        {
+            uuid1: {
+                "name": "Foo",
+                "files": {
+                    "Versions.toml": versions,
+                    "Deps.toml": '["0.2-1"]\nBar = "' + uuid2 + '"\n',
+                    "Compat.toml": '["0-0.1"]\njulia = "1"\n["0.2-1"]\nBar = "1.2-2"\n',
+                },
+            },
+            uuid2: {"name": "Bar", "files": {"Versions.toml": '["1.0.0"]\n'}},
+        }
+    )
+    infos = juliapkg.registry._find_package_versions([uuid1, "not-a-uuid"])
+    assert list(infos) == [uuid1]
+    foo = infos[uuid1]
+    assert foo["versions"] == ["0.1.0", "0.2.0", "1.0.0", "1.1.0"]
+    assert foo["deps"]["0.1.0"] == {}
+    assert foo["deps"]["1.1.0"] == {"Bar": uuid2}
+    assert foo["compat"]["0.1.0"] == {"julia": "^1"}
+    assert foo["compat"]["1.0.0"] == {"Bar": "1.2.0 - 2"}
+
+    # find_requirements rejects compat which no registered version satisfies
+    juliapkg.add("Foo", uuid=uuid1, version="0.2, 1")
+    _, pkgs = juliapkg.deps.find_requirements()
+    assert [(pkg.name, pkg.version) for pkg in pkgs] == [("Foo", "^0.2, ^1")]
+    juliapkg.add("Foo", uuid=uuid1, version="1.2")
+    # only when the registries are fresh, because otherwise they will be updated and
+    # may then have a compatible version
+    monkeypatch.setenv("PYTHON_JULIAPKG_REGISTRY_MAX_AGE", "3600")
+    with pytest.raises(Exception, match="no registered version of 'Foo'"):
+        juliapkg.deps.find_requirements()
+    monkeypatch.setenv("PYTHON_JULIAPKG_REGISTRY_MAX_AGE", "0")
+    capsys.readouterr()
+    _, pkgs = juliapkg.deps.find_requirements()
+    assert [(pkg.name, pkg.version) for pkg in pkgs] == [("Foo", "^1.2")]
+    out = capsys.readouterr().out
+    assert "WARNING: no registered version of 'Foo'" in out
+    assert "registries may be out of date" in out
+    # or when offline, since they will not be updated
+    monkeypatch.setitem(STATE, "offline", True)
+    with pytest.raises(Exception, match="no registered version of 'Foo'"):
+        juliapkg.deps.find_requirements()
+
+
+@pytest.mark.parametrize(
+    "format", [tarfile.USTAR_FORMAT, tarfile.GNU_FORMAT, tarfile.PAX_FORMAT]
+)
+def test_iter_tarball(tmp_path, format):
+    names = [
+        "Registry.toml",
+        "A/Abc/Versions.toml",
+        "é/Compat.toml",
+        "y" * 30 + "/z" * 45,
+    ]
+    if format != tarfile.USTAR_FORMAT:
+        names.append("x" * 150 + "/Deps.toml")
+    path = str(tmp_path / "registry.tar.gz")
+    with tarfile.open(path, "w:gz", format=format) as tf:
+        for i, name in enumerate(names):
+            data = os.urandom(300 * i)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+        info = tarfile.TarInfo("A")
+        info.type = tarfile.DIRTYPE
+        tf.addfile(info)
+    with tarfile.open(path) as tf:
+        files = {m.name: tf.extractfile(m).read() for m in tf if m.isfile()}
+    assert dict(juliapkg.registry._iter_tarball(path, lambda fn: True)) == files
+    assert list(juliapkg.registry._iter_tarball(path, names[1:2].__contains__)) == [
+        (names[1], files[names[1]])
+    ]
+
+
+def test_resolve_incremental(project, fake_julia, depot, monkeypatch):
+    uuid1 = "00000000-0000-0000-0000-000000000001"
+    uuid2 = "00000000-0000-0000-0000-000000000002"
+    monkeypatch.setitem(STATE, "incremental", True)
+    scripts = []
+
+    def run_julia(script, **kwargs):
+        scripts.append(script)
+        with open(os.path.join(project, "Manifest.toml"), "w") as fp:
+            fp.write("# fake manifest\n")
+
+    monkeypatch.setattr(juliapkg.deps, "run_julia", run_julia)
+
+    # the first resolve is from scratch
+    juliapkg.add("Foo", uuid=uuid1)
+    assert juliapkg.resolve()
+    assert "Pkg.Registry.update()" in scripts[-1]
+
+    # then only the changes are applied, keeping the manifest
+    juliapkg.rm("Foo")
+    juliapkg.add("Bar", uuid=uuid2, version="1.2")
+    assert juliapkg.resolve()
+    assert len(scripts) == 2
+    assert scripts[-1] == [
+        "import Pkg",
+        "Pkg.rm([",
+        f'  Pkg.PackageSpec(name="Foo", uuid="{uuid1}"),',
+        "])",
+        "Pkg.add([",
+        f'  Pkg.PackageSpec(name="Bar", uuid="{uuid2}"),',
+        "])",
+        "Pkg.precompile()",
+    ]
+    with open(os.path.join(project, "Project.toml")) as fp:
+        project_toml = fp.read()
+    assert "Foo" in project_toml and 'Bar = "^1.2"' in project_toml
+
+    # if that fails, it falls back to resolving from scratch
+    def run_julia_once(script, **kwargs):
+        monkeypatch.setattr(juliapkg.deps, "run_julia", run_julia)
+        raise Exception("oops")
+
+    monkeypatch.setattr(juliapkg.deps, "run_julia", run_julia_once)
+    juliapkg.add("Bar", uuid=uuid2, version="1.3")
+    assert juliapkg.resolve()
+    assert len(scripts) == 3
+    assert "Pkg.Registry.update()" in scripts[-1]
+
+
+def test_registry_max_age(fake_julia, write_registry, monkeypatch):
+    regfile = write_registry({}) + ".toml"
+    scripts = []
+    monkeypatch.setattr(
+        juliapkg.deps, "run_julia", lambda script, **kw: scripts.append(script)
+    )
+
+    # by default the registries are always updated
+    assert juliapkg.resolve(force=True)
+    assert "Pkg.Registry.update()" in scripts[-1]
+    assert juliapkg.deps.load_meta()["registry_updated"] is True
+
+    # but not if they were updated recently
+    monkeypatch.setenv("PYTHON_JULIAPKG_REGISTRY_MAX_AGE", "3600")
+    assert juliapkg.resolve(force=True)
+    assert "Pkg.Registry.update()" not in scripts[-1]
+    meta = juliapkg.deps.load_meta()
+    assert meta["registry_updated"] is False
+    assert 0 <= meta["registry_age"] < 3600
+
+    # or they are stale
+    old = os.path.getmtime(regfile) - 7200
+    os.utime(regfile, (old, old))
+    assert juliapkg.resolve(force=True)
+    assert "Pkg.Registry.update()" in scripts[-1]
+    assert juliapkg.deps.load_meta()["registry_updated"] is True
+
+
+def test_precompile_policy(fake_julia, depot, monkeypatch):
+    uuid1 = "00000000-0000-0000-0000-000000000001"
+    exe = fake_julia
+    scripts = []
+    monkeypatch.setattr(
+        juliapkg.deps, "run_julia", lambda script, **kw: scripts.append(script)
+    )
+    started = []
+    monkeypatch.setattr(
+        juliapkg.deps, "_start_deferred_precompile", lambda: started.append(True)
+    )
+    juliapkg.add("Foo", uuid=uuid1)
+
+    def resolve(**env):
+        for key, value in env.items():
+            monkeypatch.setenv(f"PYTHON_JULIAPKG_{key}", value)
+        assert juliapkg.resolve(force=True)
+        return scripts[-1]
+
+    # by default everything is precompiled
+    script = resolve()
+    assert script[-1] == "Pkg.precompile()"
+    assert not any("ENV" in line for line in script)
+
+    # named packages only, with a number of tasks
+    script = resolve(PRECOMPILE="Foo, Bar", PRECOMPILE_TASKS="3")
+    assert script[1:3] == [
+        'ENV["JULIA_NUM_PRECOMPILE_TASKS"] = "3"',
+        'ENV["JULIA_PKG_PRECOMPILE_AUTO"] = "0"',
+    ]
+    assert script[-1] == (
+        'VERSION < v"1.8" ? Pkg.precompile() : Pkg.precompile(["Foo", "Bar"])'
+    )
+
+    # not at all
+    script = resolve(PRECOMPILE="no")
+    assert not any("Pkg.precompile" in line for line in script)
+
+    # deferred to the background
+    marker = os.path.join(STATE["prefix"], "precompile.json")
+    script = resolve(PRECOMPILE="deferred")
+    assert not any("Pkg.precompile" in line for line in script)
+    assert started == [True]
+    with open(marker) as fp:
+        info = json.load(fp)
+    assert info["executable"] == exe
+    assert info["script"][-1] == "Pkg.precompile()"
+
+    # which a later resolve picks up
+    STATE["resolved"] = False
+    assert juliapkg.resolve()
+    assert started == [True, True]
+    # but not a dry run, such as from status()
+    STATE["resolved"] = False
+    assert juliapkg.resolve(dry_run=True)
+    assert started == [True, True]
+
+    # or it is run explicitly
+    assert juliapkg.deps.run_deferred_precompile()
+    assert scripts[-1] == info["script"]
+    assert not os.path.exists(marker)
+    assert not juliapkg.deps.run_deferred_precompile()
+
+    # if it fails, it is not started again in the background
+    resolve(PRECOMPILE="deferred")
+    assert started == [True, True, True]
+
+    def fail(script, **kw):
+        raise Exception("precompile failed")
+
+    monkeypatch.setattr(juliapkg.deps, "run_julia", fail)
+    with pytest.raises(Exception, match="precompile failed"):
+        juliapkg.deps.run_deferred_precompile(wait=False, retry=False)
+    with open(marker) as fp:
+        assert json.load(fp)["failed"] is True
+    STATE["resolved"] = False
+    assert juliapkg.resolve()
+    assert started == [True, True, True]
+    assert not juliapkg.deps.run_deferred_precompile(wait=False, retry=False)
+    # but precompile() retries it
+    monkeypatch.setattr(
+        juliapkg.deps, "run_julia", lambda script, **kw: scripts.append(script)
+    )
+    juliapkg.precompile()
+    assert scripts[-1] == info["script"]
+    assert not os.path.exists(marker)
+
+    # if deferring is turned off, the marker is removed instead
+    resolve(PRECOMPILE="deferred")
+    assert os.path.exists(marker)
+    monkeypatch.setenv("PYTHON_JULIAPKG_PRECOMPILE", "no")
+    STATE["resolved"] = False
+    n = len(started)
+    assert juliapkg.resolve()
+    assert len(started) == n
+    assert not os.path.exists(marker)
+    # and also when installing with another policy
+    resolve(PRECOMPILE="deferred")
+    resolve(PRECOMPILE="Foo")
+    assert not os.path.exists(marker)
+
+    monkeypatch.setenv("PYTHON_JULIAPKG_PRECOMPILE", ",")
+    with pytest.raises(ValueError, match="PYTHON_JULIAPKG_PRECOMPILE must be"):
+        juliapkg.deps.precompile_policy()
+
+
+def test_start_deferred_precompile(project, monkeypatch):
+    spawned = []
+    monkeypatch.setattr(juliapkg.deps, "Popen", lambda args, **kw: spawned.append(args))
+    marker = juliapkg.deps._precompile_marker()
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with open(marker + ".log", "w") as fp:
+        fp.write("earlier output\n")
+
+    # many processes starting at once only start one background process
+    juliapkg.deps._start_deferred_precompile()
+    juliapkg.deps._start_deferred_precompile()
+    assert len(spawned) == 1
+    # and do not truncate its log
+    with open(marker + ".log") as fp:
+        assert fp.read() == "earlier output\n"
+
+    # once it has taken the lock, and finished, another may be started
+    assert not juliapkg.deps.run_deferred_precompile(wait=False, retry=False)
+    juliapkg.deps._start_deferred_precompile()
+    assert len(spawned) == 2
+
+    # or if it never started
+    juliapkg.deps._start_deferred_precompile()
+    assert len(spawned) == 2
+    os.utime(marker + ".starting", (1000, 1000))
+    juliapkg.deps._start_deferred_precompile()
+    assert len(spawned) == 3
+
+
+def test_resolve_lock_free(fake_julia, fake_run, depot, monkeypatch):
+    from filelock import FileLock
+
+    exe = fake_julia
+    write_resolved_meta(exe)
+    os.makedirs(STATE["project"], exist_ok=True)
+    other = FileLock(STATE["lock"], is_singleton=False)
+
+    # while another process holds the lock, a warm resolve still does not wait
+    with other.acquire(timeout=0):
+        assert juliapkg.resolve() is True
+        # nor does it record the new fingerprint, since the other process may be
+        # resolving
+        with open(exe, "w") as fp:
+            fp.write("another fake julia")
+        STATE["resolved"] = False
+        assert juliapkg.resolve() is True
+        assert fake_run == [[exe, "--version"]]
+        assert juliapkg.deps.load_meta()["executable_fingerprint"] != (
+            julia_fingerprint(exe)
+        )
+    # but it does once the lock is free
+    STATE["resolved"] = False
+    assert juliapkg.resolve() is True
+    assert len(fake_run) == 2
+    assert juliapkg.deps.load_meta()["executable_fingerprint"] == (
+        julia_fingerprint(exe)
+    )
+
+    # a real resolve removes the meta file before changing the project
+    seen = []
+    monkeypatch.setattr(
+        juliapkg.deps,
+        "run_julia",
+        lambda script, **kw: seen.append(os.path.exists(STATE["meta"])),
+    )
+    juliapkg.add("Foo", uuid="00000000-0000-0000-0000-000000000001")
+    assert juliapkg.resolve(force=True)
+    assert seen == [False]
+    assert juliapkg.deps.load_meta() is not None
+
+    # a partially written meta file is treated as missing
+    with open(STATE["meta"], "w") as fp:
+        fp.write('{"meta_version": ')
+    assert juliapkg.deps.load_meta() is None
+
+
+def test_write_atomic(project, tmp_path, monkeypatch):
+    from juliapkg.state import write_atomic
+
+    fn = str(tmp_path / "file.json")
+    write_atomic(fn, "one")
+    with open(fn) as fp:
+        assert fp.read() == "one"
+    if os.name != "nt":
+        umask = os.umask(0)
+        os.umask(umask)
+        assert os.stat(fn).st_mode & 0o777 == 0o666 & ~umask
+        # existing permissions are kept
+        os.chmod(fn, 0o640)
+        write_atomic(fn, b"two")
+        assert os.stat(fn).st_mode & 0o777 == 0o640
+
+    # if writing fails part way, the old file is intact and no temporary file remains
+    juliapkg.deps.write_cur_deps({"packages": {}}, target=fn)
+    with open(fn) as fp:
+        old = fp.read()
+
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError, match="disk full"):
+        juliapkg.deps.write_cur_deps({"packages": {"Foo": {}}}, target=fn)
+    with open(fn) as fp:
+        assert fp.read() == old
+    assert os.listdir(tmp_path) == ["file.json"]
+
+
+def test_meta_header(fake_julia, fake_run, tmp_path, monkeypatch):
+    exe = fake_julia
+    depsfile = tmp_path / "pkg" / "juliapkg.json"
+    depsfile.parent.mkdir()
+    depsfile.write_text("{}")
+    monkeypatch.setattr(sys, "path", [str(depsfile.parent)])
+    write_resolved_meta(exe)
+
+    # the header is the first line and has no details
+    with open(STATE["meta"]) as fp:
+        header = json.loads(fp.readline())
+    assert "deps_files" not in header
+    assert header == juliapkg.deps.load_meta(details=False)
+    assert list(juliapkg.deps.load_meta()["deps_files"]) == [str(depsfile)]
+
+    loads = []
+    load_meta = juliapkg.deps.load_meta
+
+    def spy(details=True):
+        loads.append(details)
+        return load_meta(details)
+
+    monkeypatch.setattr(juliapkg.deps, "load_meta", spy)
+
+    # usually only the header is read
+    assert juliapkg.deps.can_skip_resolve()
+    assert loads == [False]
+
+    # if a deps file is touched, the details are read and its timestamp updated
+    os.utime(depsfile, (0, os.path.getmtime(depsfile) + 10))
+    loads.clear()
+    assert juliapkg.deps.can_skip_resolve()
+    assert loads[:2] == [False, True]
+    loads.clear()
+    assert juliapkg.deps.can_skip_resolve()
+    assert loads == [False]
+
+    # if it changes, we must resolve
+    depsfile.write_text('{"julia": "1"}')
+    os.utime(depsfile, (0, os.path.getmtime(depsfile) + 20))
+    assert not juliapkg.deps.can_skip_resolve()
+
+
+def test_juliaup_versions(project, fake_run, tmp_path, monkeypatch):
+    from juliapkg.compat import Compat
+    from juliapkg.find_julia import ju_find_julia_noinstall, ju_list_julia_versions
+
+    monkeypatch.setattr(juliapkg.find_julia, "get_short_arch", lambda: "x64")
+
+    def run(args, **kwargs):
+        stdout = "\n".join(
+            [
+                " Channel  Version",
+                " release  1.10.4+0.x64.linux.gnu",
+                " 1.10     1.10.4+0.x64.linux.gnu",
+                " 1.9      1.9.4+0.x64.linux.gnu",
+                " 1.9-x86  1.9.4+0.x86.linux.gnu",
+                " beta     1.11.0-rc1+0.x64.linux.gnu",
+                " 1.6      1.6.7+0.x64.linux.gnu",
+            ]
+        )
+        return subprocess.CompletedProcess(args, 0, stdout=stdout.encode("utf-8"))
+
+    monkeypatch.setattr(juliapkg.find_julia, "run", run)
+    assert ju_list_julia_versions() == {
+        "1.10.4": ["release", "1.10"],
+        "1.9.4": ["1.9"],
+        "1.6.7": ["1.6"],
+    }
+    assert ju_list_julia_versions(Compat.parse("1.7 - 1.9, ~1.6.5")) == {
+        "1.9.4": ["1.9"],
+        "1.6.7": ["1.6"],
+    }
+
+    # installed versions, the highest compatible one is checked and returned
+    monkeypatch.setattr(juliapkg.find_julia, "run", subprocess.run)
+    judir = tmp_path / "juliaup"
+    judir.mkdir()
+    installed = {}
+    for ver in ["1.10.0", "1.9.4", "1.11.0-rc1"]:
+        installed[f"{ver}+0.x64.linux.gnu"] = {"Path": f"julia-{ver}"}
+        bindir = judir / f"julia-{ver}" / "bin"
+        bindir.mkdir(parents=True)
+        (bindir / "julia").write_text(ver)
+    (judir / "juliaup.json").write_text(json.dumps({"InstalledVersions": installed}))
+    monkeypatch.setenv("JULIAUP_DEPOT_PATH", str(tmp_path))
+    exe, ver = ju_find_julia_noinstall(Compat.parse("1.8 - 1.10"))
+    assert exe == str(judir / "julia-1.10.0" / "bin" / "julia")
+    assert str(ver) == "1.10.0"
+    assert ju_find_julia_noinstall(Compat.parse("~1.7")) is None
+
+
+def test_requirement_conflicts(project, tmp_path, monkeypatch, capsys):
+    uuid1 = "00000000-0000-0000-0000-000000000001"
+    dirs = []
+    for i, (version, julia) in enumerate(
+        [("1, 3", "1"), ("1.5 - 3", "1.9"), ("2, 3", None), ("1, 2", "~1.6")]
+    ):
+        dirname = tmp_path / f"pkg{i}"
+        dirname.mkdir()
+        deps = {"packages": {"Foo": {"uuid": uuid1, "version": version}}}
+        if julia is not None:
+            deps["julia"] = julia
+        (dirname / "juliapkg.json").write_text(json.dumps(deps))
+        dirs.append(str(dirname))
+    monkeypatch.setattr(sys, "path", dirs)
+    monkeypatch.setattr(juliapkg.deps, "editable_deps_files", lambda: [])
+    fns = [os.path.join(d, "juliapkg.json") for d in dirs]
+
+    # the error says which entries conflict
+    with pytest.raises(Exception) as excinfo:
+        juliapkg.deps.find_requirements()
+    lines = str(excinfo.value).splitlines()
+    assert lines[0] == "'version' entries for Foo have empty intersection:"
+    assert lines[5] == "of which these conflict:"
+    assert set(lines[6:]) == {
+        f"- '1, 3' at {fns[0]}",
+        f"- '2, 3' at {fns[2]}",
+        f"- '1, 2' at {fns[3]}",
+    }
+
+    # and so does status
+    conflicts = juliapkg.deps.find_conflicts()
+    assert len(conflicts) == 2
+    assert conflicts[0] == str(excinfo.value)
+    assert set(conflicts[1].splitlines()[-2:]) == {
+        f"- '^1.9' at {fns[1]}",
+        f"- '~1.6' at {fns[3]}",
+    }
+    capsys.readouterr()
+    juliapkg.status()
+    out = capsys.readouterr().out
+    assert "Not resolved" in out
+    assert "Conflict: 'version' entries for Foo have empty intersection:" in out
+    assert f"\n  - '1, 3' at {fns[0]}\n" in out
@@ -0,0 +1,176 @@
+import os
+
+import juliapkg
+from juliapkg.compat import Compat, Version
+from juliapkg.deps import PkgSpec
+from juliapkg.preresolve import manifest_is_current, read_manifest, resolve_versions
+from juliapkg.state import STATE
+
+A = "00000000-0000-0000-0000-00000000000a"
+B = "00000000-0000-0000-0000-00000000000b"
+C = "00000000-0000-0000-0000-00000000000c"
+STDLIB = "00000000-0000-0000-0000-0000000000ff"
+
+
+def package(versions):
+    # versions maps each version to (deps, compat)
+    return {
+        "versions": list(versions),
+        "deps": {ver: deps for (ver, (deps, _)) in versions.items()},
+        "compat": {ver: compat for (ver, (_, compat)) in versions.items()},
+    }
+
+
+REGISTRY = {
+    A: package(
+        {
+            "1.0.0": ({"B": B}, {"B": "1"}),
+            "2.0.0": ({"B": B, "C": C}, {"B": "1", "C": "1"}),
+        }
+    ),
+    B: package(
+        {
+            "1.0.0": ({"Stdlib": STDLIB}, {}),
+            "1.1.0": ({}, {}),
+            "2.0.0": ({}, {}),
+        }
+    ),
+    C: package(
+        {
+            "1.0.0": ({"B": B}, {"B": "2"}),
+            "1.1.0": ({}, {"julia": "1.11"}),
+        }
+    ),
+}
+
+
+def provider(uuids):
+    provider.calls.append(uuids)
+    return {uuid: REGISTRY[uuid] for uuid in uuids if uuid in REGISTRY}
+
+
+def test_resolve_versions():
+    def resolve(reqs, julia_version="1.10.0"):
+        provider.calls = []
+        return resolve_versions(
+            {uuid: Compat.parse(c) if c else None for (uuid, c) in reqs.items()},
+            Version.parse(julia_version),
+            provider,
+        )
+
+    # highest versions which are compatible
+    assert resolve({B: None}) == {B: "2.0.0"}
+    assert resolve({B: "1"}) == {B: "1.1.0"}
+    # the dependencies are fetched in batches
+    assert resolve({A: None, B: "1"}) == {A: "1.0.0", B: "1.1.0"}
+    assert provider.calls == [sorted([A, B]), sorted([C, STDLIB])]
+    # A 2.0.0 needs C which needs B 2 (or julia 1.11) so it backtracks to A 1.0.0
+    assert resolve({A: None}) == {A: "1.0.0", B: "1.1.0"}
+    assert resolve({A: "2"}) is None
+    assert resolve({A: None}, "1.11.0") == {A: "2.0.0", B: "1.1.0", C: "1.1.0"}
+    # unknown packages (like stdlibs) are ignored
+    assert resolve({B: "=1.0.0", STDLIB: None}) == {B: "1.0.0"}
+
+
+def test_manifest_is_current(project, write_registry):
+    write_registry(
+        {
+            A: {
+                "name": "A",
+                "files": {
+                    "Versions.toml": '["1.0.0"]\n["1.1.0"]\n',
+                    "Deps.toml": f'["1"]\nB = "{B}"\n',
+                    "Compat.toml": '["1"]\nB = "1"\n',
+                },
+            },
+            B: {"name": "B", "files": {"Versions.toml": '["1.0.0"]\n["2.0.0"]\n'}},
+        }
+    )
+    os.makedirs(project)
+    manifest = os.path.join(project, "Manifest.toml")
+
+    def write_manifest(a, b, julia_version="1.10.0"):
+        with open(manifest, "w") as fp:
+            fp.write(
+                f'julia_version = "{julia_version}"\n'
+                'manifest_format = "2.0"\n'
+                f'[[deps.A]]\nuuid = "{A}"\nversion = "{a}"\n'
+                'git-tree-sha1 = "0000"\n'
+                f'[[deps.B]]\nuuid = "{B}"\nversion = "{b}"\n'
+                'git-tree-sha1 = "0000"\n'
+                f'[[deps.Stdlib]]\nuuid = "{STDLIB}"\n'
+            )
+
+    pkgs = [PkgSpec("A", A)]
+    ver = Version.parse("1.10.0")
+    assert not manifest_is_current(project, pkgs, ver)
+    write_manifest("1.1.0", "1.0.0")
+    assert read_manifest(manifest) == {A: "1.1.0", B: "1.0.0"}
+    assert manifest_is_current(project, pkgs, ver)
+    assert not manifest_is_current(project, [PkgSpec("A", A, version="=1.0.0")], ver)
+    assert not manifest_is_current(project, [PkgSpec("A", A, dev=True)], ver)
+    assert not manifest_is_current(project, pkgs, Version.parse("1.11.0"))
+    write_manifest("1.0.0", "1.0.0")
+    assert not manifest_is_current(project, pkgs, ver)
+    assert manifest_is_current(project, [PkgSpec("A", A, version="=1.0.0")], ver)
+
+
+def test_registry_closure(project, write_registry, monkeypatch):
+    def dep(name, uuid):
+        return {
+            "name": name,
+            "files": {
+                "Versions.toml": '["1.0.0"]\n',
+                "Deps.toml": "" if uuid is None else f'["1"]\nX = "{uuid}"\n',
+            },
+        }
+
+    write_registry({A: dep("A", B), B: dep("B", C), C: dep("C", None)})
+    # the whole closure is found in two passes over the registry
+    reads = []
+    read = juliapkg.registry._read_registry_files
+    monkeypatch.setattr(
+        juliapkg.registry,
+        "_read_registry_files",
+        lambda reg, fns: reads.append(fns) or read(reg, fns),
+    )
+    assert resolve_versions({A: None}) == {A: "1.0.0", B: "1.0.0", C: "1.0.0"}
+    assert len(reads) == 2
+    # and then it is cached
+    monkeypatch.setattr(juliapkg.registry, "_VERSIONS_CACHE", {})
+    assert resolve_versions({B: None}) == {B: "1.0.0", C: "1.0.0"}
+    assert len(reads) == 2
+
+
+def test_resolve_skips_julia(project, fake_julia, write_registry, monkeypatch):
+    write_registry(
+        {A: {"name": "A", "files": {"Versions.toml": '["1.0.0"]\n["1.1.0"]\n'}}}
+    )
+    juliapkg.add("A", uuid=A, version="1")
+    ran = []
+    monkeypatch.setattr(juliapkg.deps, "run_julia", lambda *a, **k: ran.append(a))
+
+    # the first resolve must run Julia, which would write the manifest
+    assert juliapkg.resolve(force=True)
+    assert len(ran) == 1
+    with open(os.path.join(project, "Manifest.toml"), "w") as fp:
+        fp.write(
+            'julia_version = "1.10.0"\nmanifest_format = "2.0"\n'
+            f'[[deps.A]]\nuuid = "{A}"\nversion = "1.1.0"\ngit-tree-sha1 = "0"\n'
+        )
+
+    # now the manifest is as predicted, so Julia is not run
+    STATE["resolved"] = False
+    juliapkg.deps.save_meta(dict(juliapkg.deps.load_meta(), deps_files={}))
+    assert juliapkg.resolve()
+    assert len(ran) == 1
+
+    # but it is run if the manifest is not as predicted
+    STATE["resolved"] = False
+    juliapkg.deps.save_meta(dict(juliapkg.deps.load_meta(), deps_files={}))
+    with open(os.path.join(project, "Manifest.toml")) as fp:
+        manifest = fp.read()
+    with open(os.path.join(project, "Manifest.toml"), "w") as fp:
+        fp.write(manifest.replace("1.1.0", "1.0.0"))
+    assert juliapkg.resolve()
+    assert len(ran) == 2
@@ -0,0 +1,251 @@
+import json
+import os
+import shutil
+import socket
+import sys
+import time
+
+import pytest
+
+import juliapkg
+from juliapkg.compat import Version
+from juliapkg.find_julia import julia_version
+from juliapkg.worker import (
+    WORKER_MIN_JULIA_VERSION,
+    WorkerUnavailable,
+    _worker_files,
+    run_in_worker,
+)
+
+# a stand-in for the Julia worker, speaking the same protocol
+FAKE_WORKER = """
+import json, os, socket, struct, sys, time
+info_file, pid_file, timeout = sys.argv[1], sys.argv[2], float(sys.argv[3])
+token = os.environ.pop("JULIAPKG_WORKER_TOKEN")
+with open(pid_file, "a") as fp:
+    fp.write(f"{os.getpid()}\\n")
+header = struct.Struct("<cQ")
+
+def recv(conn):
+    buf = b""
+    while len(buf) < header.size:
+        buf += conn.recv(header.size - len(buf))
+    kind, n = header.unpack(buf)
+    buf = b""
+    while len(buf) < n:
+        buf += conn.recv(n - len(buf))
+    return kind, buf.decode()
+
+def send(conn, kind, data):
+    data = data.encode()
+    conn.sendall(header.pack(kind, len(data)) + data)
+
+server = socket.create_server(("127.0.0.1", 0))
+server.settimeout(timeout)
+with open(info_file + ".tmp", "w") as fp:
+    json.dump({"port": server.getsockname()[1], "token": token}, fp)
+os.replace(info_file + ".tmp", info_file)
+while True:
+    try:
+        conn, _ = server.accept()
+    except socket.timeout:
+        break
+    with conn:
+        conn.settimeout(None)
+        assert recv(conn) == (b"t", token)
+        kind, env = recv(conn)
+        assert kind == b"v"
+        env = env.split("\\0")
+        env = dict(zip(env[::2], env[1::2]))
+        kind, script = recv(conn)
+        assert kind == b"s"
+        if script == "exit()":
+            # as if the worker exited before replying
+            continue
+        if script.startswith("ENV "):
+            send(conn, b"o", env.get(script[4:], "unset") + "\\n")
+            send(conn, b"r", "")
+            continue
+        send(conn, b"o", f"ran {script!r} in {os.getpid()}\\n")
+        if script == "exit(1)":
+            continue
+        if "error" in script:
+            send(conn, b"e", "uh oh\\n")
+            send(conn, b"r", "ERROR: " + script)
+        else:
+            send(conn, b"r", "")
+os.remove(info_file)
+"""
+
+
+@pytest.fixture
+def fake_worker(project, tmp_path, monkeypatch):
+    """Run the fake worker instead of Julia, with a short idle timeout."""
+    script = tmp_path / "fake_worker.py"
+    script.write_text(FAKE_WORKER)
+    exe = str(tmp_path / "julia")
+    with open(exe, "w") as fp:
+        fp.write("fake julia")
+    monkeypatch.setattr(
+        juliapkg.worker,
+        "_worker_command",
+        lambda executable, project: [sys.executable, str(script)],
+    )
+    monkeypatch.setattr(juliapkg.worker, "julia_version", lambda exe: Version(1, 10, 0))
+    monkeypatch.setenv("PYTHON_JULIAPKG_WORKER_TIMEOUT", "1")
+    return exe
+
+
+def worker_pids(exe, project):
+    with open(_worker_files(exe, project)["pid"]) as fp:
+        return fp.read().split()
+
+
+def test_run_in_worker(fake_worker, project, capsys):
+    exe = fake_worker
+    run_in_worker(["println(1)"], exe, project)
+    (pid,) = worker_pids(exe, project)
+    assert capsys.readouterr().out == f"ran 'println(1)' in {pid}\n"
+
+    # the same worker runs the next script
+    run_in_worker(["x = 1", "println(x)"], exe, project)
+    assert capsys.readouterr().out == f"ran 'x = 1\\nprintln(x)' in {pid}\n"
+
+    # errors are raised
+    with pytest.raises(Exception, match="ERROR: error()"):
+        run_in_worker(["error()"], exe, project)
+    out = capsys.readouterr()
+    assert out.err == "uh oh\n"
+    assert worker_pids(exe, project) == [pid]
+
+    # the worker exits when idle, and another is started
+    info_file = _worker_files(exe, project)["json"]
+    deadline = time.time() + 10
+    while os.path.exists(info_file) and time.time() < deadline:
+        time.sleep(0.1)
+    assert not os.path.exists(info_file)
+    run_in_worker(["println(2)"], exe, project)
+    assert len(worker_pids(exe, project)) == 2
+
+
+def test_worker_env(fake_worker, project, capsys, monkeypatch):
+    exe = fake_worker
+    # scripts run with the current environment
+    monkeypatch.setenv("JULIAPKG_TEST_VAR", "1")
+    run_in_worker(["ENV JULIAPKG_TEST_VAR"], exe, project)
+    assert capsys.readouterr().out == "1\n"
+    monkeypatch.setenv("JULIAPKG_TEST_VAR", "2")
+    run_in_worker(["ENV JULIAPKG_TEST_VAR"], exe, project)
+    assert capsys.readouterr().out == "2\n"
+    monkeypatch.delenv("JULIAPKG_TEST_VAR")
+    run_in_worker(["ENV JULIAPKG_TEST_VAR"], exe, project)
+    assert capsys.readouterr().out == "unset\n"
+    (pid,) = worker_pids(exe, project)
+    # but Julia only reads the depot path when it starts, so another worker is used
+    monkeypatch.setenv("JULIA_DEPOT_PATH", "/elsewhere")
+    run_in_worker(["ENV JULIA_DEPOT_PATH"], exe, project)
+    assert capsys.readouterr().out == "/elsewhere\n"
+    (pid2,) = worker_pids(exe, project)
+    assert pid2 != pid
+
+
+def test_worker_lost(fake_worker, project, capsys):
+    exe = fake_worker
+    # losing the connection before any reply means the worker is unavailable
+    with pytest.raises(WorkerUnavailable, match="lost connection"):
+        run_in_worker(["exit()"], exe, project)
+    # but afterwards the script may have partly run, so it is an error
+    with pytest.raises(Exception, match="lost connection") as excinfo:
+        run_in_worker(["exit(1)"], exe, project)
+    assert not isinstance(excinfo.value, WorkerUnavailable)
+    assert capsys.readouterr().out.startswith("ran 'exit(1)'")
+
+
+def test_run_julia_worker(fake_worker, project, capsys, monkeypatch):
+    exe = fake_worker
+    monkeypatch.setenv("PYTHON_JULIAPKG_WORKER", "yes")
+    juliapkg.deps.run_julia(["println(1)"], executable=exe, project=project)
+    assert capsys.readouterr().out.startswith("ran 'println(1)'")
+
+    # if the worker cannot start, Julia is run directly
+    monkeypatch.setattr(
+        juliapkg.worker,
+        "_worker_command",
+        lambda executable, project: [sys.executable, "-c", "pass"],
+    )
+    monkeypatch.setattr(juliapkg.worker, "_connect", lambda files: None)
+    runs = []
+    monkeypatch.setattr(juliapkg.deps, "run", lambda args, **kw: runs.append(args))
+    juliapkg.deps.run_julia(["println(1)"], executable=exe, project=project)
+    assert runs[0][0] == exe
+    with pytest.raises(WorkerUnavailable):
+        run_in_worker(["println(1)"], exe, project)
+
+
+def test_worker_old_julia(fake_worker, project, capsys, monkeypatch):
+    exe = fake_worker
+    monkeypatch.setenv("PYTHON_JULIAPKG_WORKER", "yes")
+    monkeypatch.setattr(juliapkg.worker, "julia_version", lambda exe: Version(1, 8, 5))
+    with pytest.raises(WorkerUnavailable, match="requires Julia 1.9.0"):
+        run_in_worker(["println(1)"], exe, project)
+    # so Julia is run directly, without trying to start a worker
+    runs = []
+    monkeypatch.setattr(juliapkg.deps, "run", lambda args, **kw: runs.append(args))
+    juliapkg.deps.run_julia(["println(1)"], executable=exe, project=project)
+    assert runs[0][0] == exe
+    assert not os.path.exists(_worker_files(exe, project)["pid"])
+    assert "unavailable" not in capsys.readouterr().out
+
+
+@pytest.fixture
+def julia():
+    """A real Julia executable which can run the worker, or skip."""
+    exe = shutil.which("julia")
+    if exe is None:
+        pytest.skip("julia is not available")
+    version = julia_version(exe)
+    if version is None or version < WORKER_MIN_JULIA_VERSION:
+        pytest.skip(f"julia {version} is too old for the worker")
+    return exe
+
+
+def test_real_worker(julia, project, capsys, monkeypatch):
+    exe = julia
+    os.makedirs(project, exist_ok=True)
+    monkeypatch.setenv("PYTHON_JULIAPKG_WORKER_TIMEOUT", "3")
+    monkeypatch.setenv("JULIAPKG_TEST_VAR", "1")
+    run_in_worker(['println("hello ", ENV["JULIAPKG_TEST_VAR"])'], exe, project)
+    assert capsys.readouterr().out == "hello 1\n"
+    files = _worker_files(exe, project)
+    with open(files["json"]) as fp:
+        info = json.load(fp)
+
+    # the same worker runs the next script, in the new environment, and output to
+    # stderr is forwarded too
+    monkeypatch.setenv("JULIAPKG_TEST_VAR", "2")
+    run_in_worker(
+        ['println(ENV["JULIAPKG_TEST_VAR"], " ", getpid())', 'println(stderr, "oops")'],
+        exe,
+        project,
+    )
+    out = capsys.readouterr()
+    assert out.out == f"2 {info['pid']}\n"
+    assert out.err == "oops\n"
+
+    # errors are raised
+    with pytest.raises(Exception, match="Julia script failed in the worker"):
+        run_in_worker(['error("uh oh")'], exe, project)
+
+    # a connection with the wrong token is closed without running anything
+    with socket.create_connection(("127.0.0.1", info["port"]), timeout=30) as sock:
+        juliapkg.worker._send(sock, b"t", "not the token")
+        assert sock.recv(1) == b""
+    run_in_worker(["x = 1"], exe, project)
+    with open(files["json"]) as fp:
+        assert json.load(fp)["pid"] == info["pid"]
+
+    # the worker exits when idle
+    deadline = time.time() + 30
+    while os.path.exists(files["json"]) and time.time() < deadline:
+        time.sleep(0.1)
+    assert not os.path.exists(files["json"])